@@ -16,12 +16,13 @@ __license__ = 'BSD'
 __copyright__ = 'Copyright 2012 Samizdat Drafting Co.'
 
 __all__ = ['Couch', 'Database', 'Document', 'relax', 'HTTPError', 'Conflict', 
-           'NotFound', 'PreconditionFailed', 'ServerError', 'Unauthorized']
+           'NotFound', 'PreconditionFailed', 'ServerError', 'Unauthorized', 'CircuitOpen', 'hooks']
 
 from .config import defaults
 from .couchdb import Couch, Database, Document
+from .io import hooks
 from .exceptions import HTTPError, PreconditionFailed, ServerError, \
-                        NotFound, Unauthorized, Conflict
+                        NotFound, Unauthorized, Conflict, CircuitOpen
 
 def relax(_func_) :
     """
@@ -8,6 +8,7 @@ All of the user-serviceable parts.
 from __future__ import with_statement
 import sys
 import os
+import re
 
 ## {{{ http://code.activestate.com/recipes/576693/ (r9)
 # Backport of OrderedDict() class that runs on Python 2.4, 2.5, 2.6, 2.7 and pypy.
@@ -309,10 +310,28 @@ class Document(adict):
         
     Inherits from `odict` to preserve key-ordering when converting to/from
     json and from `adict` to allow for dot-syntax access to dictionary items.
+
+    Docs fetched from the server remember the state they were loaded in (and are
+    brought up to date after being saved) so that `is_dirty` can tell whether they've
+    been changed since, including changes made deep within nested lists and dicts.
     """
+    _original = None
+
     def __init__(self, *args, **kw):
         super(Document, self).__init__(*args, **kw)
 
+    def is_dirty(self):
+        """Whether the doc has been modified since it was loaded from (or last saved to)
+        the server. Docs that didn't come from the server are always dirty.
+        """
+        original = self._original
+        return original is None or not dict.__eq__(self, original)
+
+    def mark_clean(self):
+        """Treat the doc's current contents as its unmodified state (by keeping a deep
+        copy of them to compare against)"""
+        self.__dict__['_original'] = dict((k, _clone(v)) for k, v in dict.iteritems(self))
+
     def __repr__(self):
         # preview=''
         preview = [u'%s:%s'%(k,v) for k,v in self.iteritems() if k not in ('_id','_rev')]
@@ -325,6 +344,198 @@ class Document(adict):
                 self.get('_rev',u'???-').split('-')[0], preview)).encode('utf8')
 
 
+# couchdb always leads with the _id and _rev, so they can be read without a full decode
+_HEADER = re.compile(r'\s*\{\s*"_id"\s*:\s*"((?:[^"\\]|\\.)*)"\s*(?:,\s*"_rev"\s*:\s*"([^"\\]*)")?')
+
+class LazyDocument(Document):
+    """A Document that holds onto the JSON it was fetched as and decodes it on demand.
+
+    Only the `_id` and `_rev` are read when the doc is created. The rest of the fields
+    are decoded the first time one of them is accessed (into plain dicts and lists,
+    which is cheap) and each field is then converted to `defaults.types.dict` objects
+    when it's first read. Docs that are saved without having been modified are sent as
+    the original JSON rather than being re-encoded.
+
+    Since the fields aren't stored until they've been decoded, use `dict(doc.items())`
+    rather than `dict(doc)` to make a plain copy of a doc that may still be undecoded.
+
+    Usage:
+        defaults.types.doc = LazyDocument
+    """
+    def __init__(self, *args, **kw):
+        self.__dict__.update(_raw=None, _header=None, _plain=None)
+        source = args[0] if len(args)==1 and not kw else None
+        if raw_json(source) is not None:
+            # share the other doc's json rather than decoding it to copy the fields
+            super(LazyDocument, self).__init__(source._summary())
+            self.__dict__.update(_raw=source._raw, _header=source._header)
+        else:
+            super(LazyDocument, self).__init__(*args, **kw)
+
+    @classmethod
+    def from_json(cls, raw):
+        """Create a doc from the JSON text of a CouchDB document (without decoding it)"""
+        header = _HEADER.match(raw)
+        summary = []
+        if header is not None:
+            for key, value in zip(('_id', '_rev'), header.groups()):
+                if value is None:
+                    continue
+                if '\\' in value:
+                    from .config import json
+                    value = json.decode(u'"%s"' % value)
+                summary.append((key, value if isinstance(value, unicode) else value.decode('utf-8')))
+        doc = cls(summary)
+        doc.__dict__.update(_raw=raw, _header=header)
+        return doc
+
+    def _summary(self):
+        return [(k, dict.__getitem__(self, k)) for k in ('_id', '_rev') if dict.__contains__(self, k)]
+
+    def _undecoded(self, key=None):
+        # true for an undecoded doc (and a key other than the _id & _rev it was created with)
+        if self._raw is None or self._plain is not None:
+            return False
+        return key is None or not dict.__contains__(self, key)
+
+    def _load(self):
+        if not self._undecoded():
+            return
+        from .config import json
+        fields = json.decode(self._raw, object_hook=None)
+        self.__dict__['_plain'] = set(k for k,v in fields.iteritems() if isinstance(v, (dict, list)))
+        for key, value in fields.iteritems():
+            Document.__setitem__(self, key, value)
+        Document.mark_clean(self)
+
+    def is_dirty(self):
+        return not self._undecoded() and Document.is_dirty(self)
+    is_dirty.__doc__ = Document.is_dirty.__doc__
+
+    def mark_clean(self):
+        if self._undecoded():
+            return
+        if self._raw is not None and self.is_dirty():
+            self.__dict__.update(_raw=None, _header=None)
+        Document.mark_clean(self)
+    mark_clean.__doc__ = Document.mark_clean.__doc__
+
+    def __getitem__(self, key):
+        if self._undecoded(key):
+            self._load()
+        plain = self._plain
+        if plain is not None and key in plain:
+            plain.discard(key)
+            dict.__setitem__(self, key, _promote(dict.__getitem__(self, key)))
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        header = self._header
+        if header is not None and key in ('_id', '_rev') and dict.__contains__(self, key):
+            if value == dict.__getitem__(self, key):
+                return
+            if key == '_rev' and header.group(2) is not None and isinstance(value, basestring) \
+                             and re.match(r'^[^"\\]*$', value):
+                # track new revisions by editing the json's header in place
+                raw, rev = self._raw, value
+                if isinstance(raw, str) and isinstance(rev, unicode):
+                    rev = rev.encode('utf-8')
+                raw = raw[:header.start(2)] + rev + raw[header.end(2):]
+                self.__dict__.update(_raw=raw, _header=_HEADER.match(raw))
+                dict.__setitem__(self, key, value)
+                if self._original is not None:
+                    self._original[key] = value
+                return
+        self._load()
+        Document.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._load()
+        Document.__delitem__(self, key)
+
+    def __contains__(self, key):
+        if self._undecoded(key):
+            self._load()
+        return dict.__contains__(self, key)
+    has_key = __contains__
+
+    def __iter__(self):
+        self._load()
+        return Document.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __nonzero__(self):
+        return self._undecoded() or dict.__len__(self) > 0
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._load()
+        Document.clear(self)
+
+    def popitem(self, last=True):
+        self._load()
+        return Document.popitem(self, last)
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDocument) and self._raw is not None and self._raw == other._raw \
+                                           and not (self.is_dirty() or other.is_dirty()):
+            return True
+        self._load()
+        return Document.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        self._load()
+        return self.__class__, ([[k, self[k]] for k in self],)
+
+
+def _promote(value):
+    # convert the plain dicts in a freshly decoded value to the configured dict type
+    if type(value) is dict:
+        from .config import defaults
+        return defaults.types.dict([(k, _promote(v)) for k, v in value.iteritems()])
+    if type(value) is list:
+        return [_promote(v) for v in value]
+    return value
+
+def _clone(value):
+    # copy a json-style value deeply enough that changes to the original won't show up
+    if isinstance(value, dict):
+        return dict((k, _clone(v)) for k, v in dict.iteritems(value))
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+def _copy(value):
+    # copy a decoded json value all the way down, keeping its dict types (unmodified lazy
+    # docs just share their json, which can't change)
+    if raw_json(value) is not None:
+        return type(value)(value)
+    if isinstance(value, dict):
+        return type(value)((k, _copy(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+def raw_json(doc):
+    """Return the JSON a lazily decoded doc was fetched as (or None if it has been modified)"""
+    if isinstance(doc, LazyDocument) and doc._raw is not None and not doc.is_dirty():
+        return doc._raw
+
+
 class View(object):
     """Iterable representation of a set of results from a view query
     
@@ -422,7 +633,10 @@ class Row(dict):
         doc = self.get('doc')
         if doc:
             from .config import defaults
-            return defaults.types.doc(doc)
+            doc = defaults.types.doc(doc)
+            if isinstance(doc, Document):
+                doc.mark_clean()
+            return doc
 
 
 class Status(adict):
@@ -442,6 +656,15 @@ class Status(adict):
         
         error (cls): the class of the exception (or `None`). This is redundant but allows
         for the syntax ``if status.error is NotFound`` in callback functions.
+        
+        length (int): the size of the response body in bytes
+
+        wire_length (int): the size of the response body as it was transferred (only
+        present if the server compressed it)
+        
+        timings (dict): a breakdown of where the request's time went (see 
+        corduroy.io.client_timings). Only collected while instrumentation hooks are
+        registered or if `defaults.http.timings` is True.
     """
     def __init__(self, code, exc=None, headers=None):
         super(Status, self).__init__(dict(
@@ -449,7 +672,9 @@ class Status(adict):
             error = exc.__class__ if exc else None,
             headers = headers,
             code = code,
-            ok = code<400
+            ok = code<400,
+            length = 0,
+            timings = None
         ))
 
     def __repr__(self):
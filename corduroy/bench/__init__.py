@@ -0,0 +1,257 @@
+# encoding: utf-8
+"""
+corduroy.bench
+
+Reproducible timings of the client's hot paths (with regression checks against a
+stored baseline).
+
+Usage:
+    python -m corduroy.bench -o results.json           # run everything
+    python -m corduroy.bench -b baseline.json json.*   # compare a subset to a baseline
+"""
+
+from __future__ import with_statement
+import gc
+import sys
+import time
+import platform
+from fnmatch import fnmatch
+from optparse import OptionParser
+from ..atoms import adict, odict
+from ..config import json
+from .. import __version__ as VERSION
+
+registry = odict()
+
+def benchmark(name, group='micro'):
+    """Register a benchmark.
+
+    The decorated function is a factory that does any expensive setup and returns the
+    zero-argument callable to be timed. It's passed an `Environment` through which
+    end-to-end benchmarks can reach a (fake) server. Any figures in the callable's
+    `extra` dict (e.g., bytes per call) are included in the results.
+
+    Usage:
+        @benchmark('odict.construct')
+        def odict_construct(env):
+            items = [('k%i' % i, i) for i in range(20)]
+            return lambda: odict(items)
+    """
+    def register(factory):
+        registry[name] = adict(name=name, group=group, factory=factory,
+                               doc=(factory.__doc__ or '').strip())
+        return factory
+    return register
+
+
+class Environment(object):
+    """Lazily starts the fake server that the end-to-end benchmarks run against"""
+    def __init__(self, url=None, latency=0):
+        self.url = url
+        self.latency = latency
+        self._fake = None
+        self._couch = None
+        self._dbs = []
+        self._servers = []
+
+    @property
+    def couch(self):
+        if self._couch is None:
+            from ..couchdb import Couch
+            if self.url is None:
+                from ..fakecouch import FakeCouch
+                self._fake = FakeCouch(latency=self.latency).start()
+                self.url = self._fake.url
+            self._couch = Couch(self.url)
+        return self._couch
+
+    def db(self, name):
+        """Return a freshly created database (deleted again when the run is over)"""
+        name = 'corduroy_bench_%s' % name
+        if name in self.couch:
+            self.couch.delete(name)
+        self._dbs.append(name)
+        return self.couch.create(name)
+
+    def server(self, **options):
+        """Start an additional fake server (e.g., with a constrained `bandwidth`) that's
+        stopped when the run is over"""
+        from ..fakecouch import FakeCouch
+        fake = FakeCouch(**options).start()
+        self._servers.append(fake)
+        return fake
+
+    def close(self):
+        for name in self._dbs:
+            self.couch.delete(name)
+        self._dbs = []
+        for fake in self._servers:
+            fake.stop()
+        self._servers = []
+        if self._fake is not None:
+            self._fake.stop()
+            self._fake = None
+
+
+def measure(func, repeat=5, min_time=0.1):
+    """Time a callable, returning per-call statistics (in seconds).
+
+    The number of calls per sample is grown until a sample takes at least `min_time`,
+    then `repeat` samples are taken (with a garbage collection between each).
+    """
+    loops = 1
+    while True:
+        began = time.time()
+        for i in xrange(loops):
+            func()
+        elapsed = time.time() - began
+        if elapsed >= min_time or loops >= 10**7:
+            break
+        loops *= 10 if elapsed < min_time/10 else 2
+
+    samples = []
+    for r in xrange(repeat):
+        gc.collect()
+        began = time.time()
+        for i in xrange(loops):
+            func()
+        samples.append((time.time() - began) / loops)
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    stdev = (sum((s-mean)**2 for s in samples) / len(samples)) ** 0.5
+    return adict(loops=loops, repeat=repeat, best=samples[0], median=samples[len(samples)//2],
+                 mean=mean, stdev=stdev, ops=1.0/samples[0] if samples[0] else None)
+
+
+def _load():
+    from . import micro, client
+
+def select(patterns=None):
+    """Return the registered benchmarks whose names (or groups) match any of the given
+    shell-style patterns"""
+    _load()
+    if not patterns:
+        return registry.values()
+    return [b for b in registry.values() if any(fnmatch(b.name, p) or b.group == p for p in patterns)]
+
+
+def run(patterns=None, repeat=5, min_time=0.1, url=None, report=None):
+    """Run the selected benchmarks.
+
+    Kwargs:
+        patterns (list): names (or shell-style patterns, or group names) of the benchmarks
+        to run. All of them are run by default.
+
+        repeat (int): the number of samples to take of each benchmark
+
+        min_time (float): the minimum duration (in seconds) of each sample
+
+        url (str): the server to run the end-to-end benchmarks against (an in-process
+        fake is used by default)
+
+        report (function w/ signature ƒ(name, stats)): called as each benchmark finishes
+
+    Returns:
+        dict. The timings (keyed by benchmark name) along with a description of the
+        environment they were collected in.
+    """
+    env = Environment(url)
+    results = odict()
+    try:
+        for bench in select(patterns):
+            func = bench.factory(env)
+            stats = measure(func, repeat=repeat, min_time=min_time)
+            stats.update(getattr(func, 'extra', {}))
+            stats.group = bench.group
+            results[bench.name] = stats
+            if report:
+                report(bench.name, stats)
+    finally:
+        env.close()
+    meta = dict(corduroy=VERSION, python=platform.python_version(),
+                implementation=platform.python_implementation(), platform=platform.platform(),
+                json=json_module(), server=url or 'fake', timestamp=time.time())
+    return dict(meta=meta, results=results)
+
+
+def json_module():
+    from ..config import _json
+    return '%s %s' % (_json.__name__, getattr(_json, '__version__', ''))
+
+
+def compare(results, baseline, threshold=0.10):
+    """Compare the best timings of two runs.
+
+    Returns:
+        list. One dict per benchmark present in both runs, with the `ratio` of the
+        current to the baseline timing and a `verdict` of 'slower', 'faster', or 'same'
+        (depending on whether the change exceeds the `threshold` fraction).
+    """
+    current, previous = results['results'], baseline['results']
+    out = []
+    for name, stats in current.items():
+        if name not in previous or not previous[name]['best']:
+            continue
+        ratio = stats['best'] / previous[name]['best']
+        verdict = 'same'
+        if ratio > 1 + threshold:
+            verdict = 'slower'
+        elif ratio < 1 / (1 + threshold):
+            verdict = 'faster'
+        out.append(adict(name=name, ratio=ratio, verdict=verdict, best=stats['best'],
+                         baseline=previous[name]['best']))
+    return out
+
+
+def _fmt(secs):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('µs', 1e6)):
+        if secs >= 1/scale:
+            return '%.3g%s' % (secs*scale, unit)
+    return '%.3gns' % (secs*1e9)
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m corduroy.bench [options] [benchmark patterns...]')
+    parser.add_option('-o', '--output', help='write the results to a json file')
+    parser.add_option('-b', '--baseline', help='compare the results to a previous run')
+    parser.add_option('-t', '--threshold', type='float', default=0.10,
+                      help='the slowdown (as a fraction) that counts as a regression [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=5, help='samples per benchmark [%default]')
+    parser.add_option('-m', '--min-time', type='float', default=0.1,
+                      help='minimum seconds per sample [%default]')
+    parser.add_option('-u', '--url', help='run the end-to-end benchmarks against a real server')
+    parser.add_option('-l', '--list', action='store_true', help='list the benchmarks and exit')
+    opts, patterns = parser.parse_args(argv)
+
+    if opts.list:
+        for bench in select(patterns):
+            print '%-28s %-8s %s' % (bench.name, bench.group, bench.doc)
+        return 0
+
+    def report(name, stats):
+        extra = ''.join(' %s=%s' % (k, v) for k, v in sorted(stats.items())
+                        if k not in ('loops', 'repeat', 'best', 'median', 'mean', 'stdev', 'ops', 'group'))
+        print '%-28s %10s %10s ±%-8s %12s ops/s%s' % (name, _fmt(stats.best), _fmt(stats.median),
+                                                       _fmt(stats.stdev), '%.0f' % stats.ops, extra)
+        sys.stdout.flush()
+
+    print '%-28s %10s %10s %9s %18s' % ('benchmark', 'best', 'median', 'stdev', 'throughput')
+    results = run(patterns, repeat=opts.repeat, min_time=opts.min_time, url=opts.url, report=report)
+    if opts.output:
+        with file(opts.output, 'w') as f:
+            f.write(json.encode(results, indent=2))
+
+    if opts.baseline:
+        with file(opts.baseline) as f:
+            baseline = json.decode(f.read())
+        changes = compare(results, baseline, opts.threshold)
+        print '\ncompared to %s:' % opts.baseline
+        for c in changes:
+            if c.verdict != 'same':
+                print '  %-28s %6s %5.2fx (%s → %s)' % (c.name, c.verdict, c.ratio, _fmt(c.baseline), _fmt(c.best))
+        regressions = [c for c in changes if c.verdict == 'slower']
+        if regressions:
+            print '%i regression%s beyond %i%%' % (len(regressions), '' if len(regressions)==1 else 's',
+                                                    opts.threshold*100)
+            return 1
+        print '  no regressions beyond %i%%' % (opts.threshold*100)
+    return 0
@@ -0,0 +1,4 @@
+import sys
+from corduroy.bench import main
+
+sys.exit(main())
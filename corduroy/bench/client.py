@@ -0,0 +1,144 @@
+# encoding: utf-8
+"""
+corduroy.bench.client
+
+End-to-end benchmarks of the blocking client (against corduroy.fakecouch by default).
+The views are written in python, so a real server needs couchdb-python's view server.
+"""
+
+from . import benchmark
+from .micro import sample_doc
+from ..config import defaults
+from ..couchdb import Couch, Database
+from ..patch import PatchQueue
+
+VIEW = "def fun(doc):\n    yield doc['_id'], None"
+
+@benchmark('db.get', group='client')
+def db_get(env):
+    """fetch a single doc"""
+    db = env.db('get')
+    db.save(sample_doc(rev=False))
+    return lambda: db.get('doc-000000')
+
+@benchmark('db.save', group='client')
+def db_save(env):
+    """update a single doc"""
+    db = env.db('save')
+    doc = sample_doc(rev=False)
+    db.save(doc)
+    return lambda: db.save(doc)
+
+@benchmark('db.save.bulk', group='client')
+def db_save_bulk(env):
+    """update 100 docs through _bulk_docs"""
+    db = env.db('bulk')
+    docs = [sample_doc(i, rev=False) for i in range(100)]
+    db.save(docs)
+    return lambda: db.save(docs)
+
+@benchmark('db.save.unmodified', group='client')
+def db_save_unmodified(env):
+    """save 100 fetched docs (10 of them changed) with skip_unmodified"""
+    db = env.db('unmodified')
+    db.save([sample_doc(i, rev=False) for i in range(100)])
+    docs = db.get(['doc-%06i' % i for i in range(100)])
+    def call():
+        for doc in docs[::10]:
+            doc['n1'] += 1
+        db.save(docs, skip_unmodified=True)
+    return call
+
+@benchmark('db.view', group='client')
+def db_view(env):
+    """query 100 rows of a view"""
+    db = env.db('view')
+    docs = [sample_doc(i, rev=False) for i in range(100)]
+    db.save(docs)
+    db.save({'_id':'_design/bench', 'views':{'ids':{'map':VIEW}}})
+    return lambda: db.view('bench/ids', limit=100)
+
+@benchmark('db.view.docs', group='client')
+def db_view_docs(env):
+    """query 100 rows of a view with include_docs"""
+    db = env.db('view_docs')
+    docs = [sample_doc(i, rev=False) for i in range(100)]
+    db.save(docs)
+    db.save({'_id':'_design/bench', 'views':{'ids':{'map':VIEW}}})
+    return lambda: db.view('bench/ids', limit=100, include_docs=True)
+
+def hot_doc(env, name, update):
+    """Bump a counter in a 200k doc over a 2MB/s link (recording the body bytes that
+    crossed the network per call)"""
+    fake = env.server(bandwidth=2*1024*1024)
+    db = Couch(fake.url).create(name)
+    db = Database(db.resource, patches=PatchQueue(window=0, language='python'))
+    doc = dict(sample_doc(rev=False), blob='x'*200000, n=0)
+    db.save(doc)
+    db.patch(doc['_id'], {'n':0}) # install the handler
+    def call():
+        doc['n'] += 1
+        update(db, doc)
+    before = fake.stats.bytes_in + fake.stats.bytes_out
+    call()
+    call.extra = dict(wire_bytes=fake.stats.bytes_in + fake.stats.bytes_out - before)
+    return call
+
+@benchmark('db.save.hot', group='client')
+def db_save_hot(env):
+    """change one field of a 200k doc by saving all of it"""
+    return hot_doc(env, 'save_hot', lambda db, doc: db.save(doc))
+
+@benchmark('db.patch', group='client')
+def db_patch(env):
+    """change one field of a 200k doc with a patch"""
+    return hot_doc(env, 'patch_hot', lambda db, doc: db.patch(doc['_id'], {'n':doc['n']}))
+
+
+def over_slow_link(env, name, compress, setup, op, bandwidth=2*1024*1024):
+    """Time `op` against a server on a bandwidth-limited link with or without gzip
+    (recording the body bytes that crossed the network per call)"""
+    fake = env.server(bandwidth=bandwidth, gzip=True)
+    db = Couch(fake.url).create(name)
+    setup(db)
+    def call():
+        saved = defaults.http.gzip, defaults.http.gzip_threshold
+        defaults.http.gzip, defaults.http.gzip_threshold = compress, 1024 if compress else None
+        try:
+            op(db)
+        finally:
+            defaults.http.gzip, defaults.http.gzip_threshold = saved
+    before = fake.stats.bytes_in + fake.stats.bytes_out
+    call()
+    call.extra = dict(wire_bytes=fake.stats.bytes_in + fake.stats.bytes_out - before)
+    return call
+
+def fill(db):
+    db.save([sample_doc(i, rev=False) for i in range(200)])
+
+def view_all(db):
+    db.view('_all_docs', include_docs=True)
+
+def save_all(db, docs=[sample_doc(i) for i in range(200)]):
+    # replicator-style writes of fixed revisions, so repeated calls don't pile up
+    db.save([dict(doc) for doc in docs], new_edits=False)
+
+@benchmark('gzip.view.plain', group='gzip')
+def gzip_view_plain(env):
+    """200 docs via include_docs over a 2MB/s link, uncompressed"""
+    return over_slow_link(env, 'view_plain', False, fill, view_all)
+
+@benchmark('gzip.view.gzip', group='gzip')
+def gzip_view_gzip(env):
+    """200 docs via include_docs over a 2MB/s link, gzipped"""
+    return over_slow_link(env, 'view_gzip', True, fill, view_all)
+
+@benchmark('gzip.bulk.plain', group='gzip')
+def gzip_bulk_plain(env):
+    """save 200 docs over a 2MB/s link, uncompressed"""
+    return over_slow_link(env, 'bulk_plain', False, lambda db: None, save_all)
+
+@benchmark('gzip.bulk.gzip', group='gzip')
+def gzip_bulk_gzip(env):
+    """save 200 docs over a 2MB/s link, gzipped"""
+    return over_slow_link(env, 'bulk_gzip', True, lambda db: None, save_all)
@@ -0,0 +1,164 @@
+# encoding: utf-8
+"""
+corduroy.bench.micro
+
+Benchmarks of the pure-python pieces of a request (no server required).
+"""
+
+import random
+from . import benchmark
+from ..atoms import odict, adict, Document, LazyDocument, View
+from ..config import defaults, json
+from ..exceptions import ConflictResolution
+from ..io import urljoin, serialize_doc, serialize_bulk, decode_rows
+
+random.seed(1984)
+
+def sample_doc(i=0, fields=20, rev=True):
+    """A ~1kb doc with a mix of strings, numbers, lists, and nested objects"""
+    doc = odict([('_id', 'doc-%06i' % i)])
+    if rev:
+        doc['_rev'] = '1-%032x' % random.getrandbits(128)
+    for f in range(fields):
+        kind = f % 4
+        if kind == 0:
+            doc['s%i' % f] = u'value %i of doc %i ☃' % (f, i)
+        elif kind == 1:
+            doc['n%i' % f] = random.random() * 1000
+        elif kind == 2:
+            doc['l%i' % f] = range(f)
+        else:
+            doc['o%i' % f] = dict(a=f, b=[1, 2, 3], c=dict(d=u'nested'))
+    return doc
+
+def sample_view(rows=1000, include_docs=False):
+    results = dict(total_rows=rows*2, offset=0, rows=[])
+    for i in range(rows):
+        row = dict(id='doc-%06i' % i, key=['k', i], value=dict(rev='1-abc', n=i))
+        if include_docs:
+            row['doc'] = sample_doc(i)
+        results['rows'].append(row)
+    return results
+
+
+@benchmark('odict.construct')
+def odict_construct(env):
+    """odict from a list of 20 pairs"""
+    items = sample_doc().items()
+    return lambda: odict(items)
+
+@benchmark('adict.construct')
+def adict_construct(env):
+    """adict from a list of 20 pairs"""
+    items = sample_doc().items()
+    return lambda: adict(items)
+
+@benchmark('adict.getattr')
+def adict_getattr(env):
+    """attribute-style lookup of an existing key"""
+    doc = adict(sample_doc())
+    return lambda: doc.s0
+
+@benchmark('document.construct')
+def document_construct(env):
+    """Document from a list of 20 pairs"""
+    items = sample_doc().items()
+    return lambda: Document(items)
+
+@benchmark('json.decode.doc')
+def json_decode_doc(env):
+    """decode a ~1kb doc (with the adict object hook)"""
+    text = json.encode(sample_doc())
+    return lambda: json.decode(text)
+
+@benchmark('json.decode.view')
+def json_decode_view(env):
+    """decode a 1000-row view response"""
+    text = json.encode(sample_view())
+    return lambda: json.decode(text)
+
+@benchmark('json.encode.doc')
+def json_encode_doc(env):
+    """encode a ~1kb doc"""
+    doc = sample_doc()
+    return lambda: json.encode(doc)
+
+@benchmark('urljoin.path')
+def urljoin_path(env):
+    """build a doc url"""
+    return lambda: urljoin('http://127.0.0.1:5984/', 'some_db', 'doc-000001')
+
+@benchmark('urljoin.query')
+def urljoin_query(env):
+    """build a view url with query options"""
+    return lambda: urljoin('http://127.0.0.1:5984/some_db', '_design', 'app', '_view', 'by_date',
+                           startkey='["2012",1]', endkey='["2012",12]', limit=100,
+                           include_docs=True, descending=False)
+
+@benchmark('serialize_doc')
+def serialize_one(env):
+    """serialize a ~1kb doc for a PUT"""
+    doc = sample_doc()
+    return lambda: serialize_doc(doc)
+
+@benchmark('serialize_bulk')
+def serialize_many(env):
+    """serialize 100 docs for a _bulk_docs POST"""
+    docs = [sample_doc(i) for i in range(100)]
+    return lambda: serialize_bulk({'docs':docs})
+
+@benchmark('view.construct')
+def view_construct(env):
+    """View (and its Rows) from a decoded 1000-row response"""
+    results = json.decode(json.encode(sample_view()))
+    return lambda: View('app/by_date', {}, results)
+
+@benchmark('view.construct.docs')
+def view_construct_docs(env):
+    """View from a 1000-row response with include_docs, touching each row's doc"""
+    results = json.decode(json.encode(sample_view(include_docs=True)))
+    return lambda: [row.doc for row in View('app/by_date', {}, results)]
+
+@benchmark('conflict_resolution')
+def conflict_resolution(env):
+    """reconcile a 100-doc _bulk_docs response (10 conflicts) with the originals"""
+    docs = [sample_doc(i) for i in range(100)]
+    response = [dict(id=d['_id'], rev='2-%032x' % i) if i % 10 else
+                dict(id=d['_id'], error='conflict', reason='Document update conflict.')
+                for i, d in enumerate(docs)]
+    # the originals get updated in place, so each call works on fresh (shallow) copies
+    return lambda: ConflictResolution(None, response, [dict(d) for d in docs])
+
+def lazily(fn):
+    """Run `fn` with LazyDocument as the doc type"""
+    def call():
+        saved, defaults.types.doc = defaults.types.doc, LazyDocument
+        try:
+            return fn()
+        finally:
+            defaults.types.doc = saved
+    return call
+
+def couch_layout(results):
+    """Encode a view response the way couchdb does (one row per line)"""
+    head = json.encode(dict((k, v) for k, v in results.items() if k != 'rows'))
+    rows = u',\r\n'.join(json.encode(row) for row in results['rows'])
+    return u'%s,"rows":[\r\n%s\r\n]}\n' % (head[:-1], rows)
+
+@benchmark('lazy.view.docs')
+def lazy_view_docs(env):
+    """decode a 1000-row include_docs response with lazy docs, reading each doc's _id"""
+    text = couch_layout(sample_view(include_docs=True))
+    return lazily(lambda: [row.doc['_id'] for row in View('app/by_date', {}, decode_rows(text))])
+
+@benchmark('eager.view.docs')
+def eager_view_docs(env):
+    """decode the same response with regular Documents, reading each doc's _id"""
+    text = couch_layout(sample_view(include_docs=True))
+    return lambda: [row.doc['_id'] for row in View('app/by_date', {}, decode_rows(text))]
+
+@benchmark('lazy.serialize_bulk')
+def lazy_serialize_bulk(env):
+    """serialize 100 unmodified lazy docs for a _bulk_docs POST"""
+    docs = [LazyDocument.from_json(json.encode(sample_doc(i))) for i in range(100)]
+    return lambda: serialize_bulk({'docs':docs})
@@ -0,0 +1,459 @@
+# encoding: utf-8
+"""
+corduroy.cache
+
+Remembering things so the server doesn't have to repeat itself.
+"""
+
+from __future__ import with_statement
+import os
+import time
+from hashlib import md5
+from base64 import b64encode
+from .atoms import odict, adict, Status, raw_json
+from .exceptions import NotFound
+from .config import defaults, json
+
+class LRU(object):
+    """A dict-like store that forgets its least recently used entries.
+
+    Entries are evicted once there are more than `entries` of them or (if a byte limit
+    is given and sizes are passed to `put`) once their total size exceeds `bytes`.
+    """
+    def __init__(self, entries=1000, bytes=None):
+        self.max_entries = entries
+        self.max_bytes = bytes
+        self.size = 0
+        self._data = odict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data.keys())
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        entry = self._data.pop(key)
+        self._data[key] = entry
+        return entry[0]
+
+    def put(self, key, value, nbytes=0):
+        self.pop(key)
+        self._data[key] = (value, nbytes)
+        self.size += nbytes
+        while self._data and (len(self._data) > self.max_entries or \
+                              (self.max_bytes and self.size > self.max_bytes)):
+            _, (_, evicted) = self._data.popitem(last=False)
+            self.size -= evicted
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value, nbytes = self._data.pop(key)
+        self.size -= nbytes
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def items(self):
+        return [(k, v[0]) for k, v in self._data.items()]
+
+
+def attachment_digest(content, chunk_size=None):
+    """Compute the `md5-…` digest couch stores for an attachment's bytes.
+
+    Args:
+        content (str, file): the attachment data. Files are read in chunks and then
+        returned to their original position.
+
+    Returns:
+        a (digest, length) tuple or (None, None) if the content isn't rewindable
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if isinstance(content, basestring):
+        return 'md5-%s'%b64encode(md5(content).digest()), len(content)
+    if not hasattr(content, 'seek') or not hasattr(content, 'tell'):
+        return None, None
+
+    chunk_size = chunk_size or defaults.http.chunk_size
+    hasher, length = md5(), 0
+    start = content.tell()
+    while True:
+        chunk = content.read(chunk_size)
+        if not chunk: break
+        hasher.update(chunk)
+        length += len(chunk)
+    content.seek(start)
+    return 'md5-%s'%b64encode(hasher.digest()), length
+
+
+class DigestIndex(object):
+    """Skips attachment uploads whose bytes are already on the server.
+
+    Before an attachment is sent, its md5 digest is compared against the stub in
+    the doc's `_attachments` dict (as fetched from the server) and against the
+    digests of recent uploads made through this index. If either matches the doc's
+    current _rev, the upload is skipped.
+
+    Attributes:
+        stats (dict): counts of `uploads` and `skipped` attachments along with the
+        `bytes_sent` and `bytes_saved` by skipping
+    """
+    def __init__(self, entries=10000, path=None):
+        """Initialize the index.
+
+        Kwargs:
+            entries (int): the number of recent uploads to remember
+
+            path (str): optional filename the index will be loaded from (if it exists)
+            and written to when calling `.save()`
+        """
+        self.path = path
+        self.stats = adict(uploads=0, skipped=0, bytes_sent=0, bytes_saved=0)
+        self._lru = LRU(entries=entries)
+        if path and os.path.exists(path):
+            with file(path) as f:
+                for key, rev, digest in json.decode(f.read()):
+                    self._lru.put(tuple(key), (rev, digest))
+
+    def __len__(self):
+        return len(self._lru)
+
+    def save(self, path=None):
+        """Write the index to disk as json"""
+        path = path or self.path
+        entries = [[list(key), rev, digest] for key, (rev, digest) in self._lru.items()]
+        with file(path, 'w') as f:
+            f.write(json.encode(entries).encode('utf-8'))
+
+    def known(self, db_name, doc, filename, digest):
+        """Return whether the doc's current revision already has these bytes attached"""
+        if not digest or '_rev' not in doc:
+            return False
+        stub = doc.get('_attachments', {}).get(filename)
+        if hasattr(stub, 'get') and stub.get('stub') and stub.get('digest') == digest:
+            return True
+        return self._lru.get((db_name, doc.get('_id'), filename)) == (doc['_rev'], digest)
+
+    def skip(self, nbytes):
+        self.stats.skipped += 1
+        self.stats.bytes_saved += nbytes or 0
+
+    def record(self, db_name, doc, filename, digest, nbytes):
+        """Remember the digest of an attachment that was just written at doc['_rev']"""
+        self.stats.uploads += 1
+        self.stats.bytes_sent += nbytes or 0
+        if digest:
+            self._lru.put((db_name, doc['_id'], filename), (doc['_rev'], digest))
+
+    def prepare(self, db_name, docs):
+        """Replace file attachments the server already has with stubs before a save.
+
+        Returns:
+            a list of (doc, filename, digest, length) tuples for attachments that will be
+            uploaded (to be passed to `.commit` once the save completes)
+        """
+        uploads = []
+        for doc in docs:
+            if raw_json(doc) is not None:
+                continue # an unmodified lazy doc can't be holding any files
+            attachments = doc.get('_attachments') or {}
+            for fn, info in attachments.items():
+                if hasattr(info, 'read'):
+                    content = info
+                elif hasattr(info, 'get') and hasattr(info.get('data'), 'read'):
+                    content = info['data']
+                else:
+                    continue
+                digest, length = attachment_digest(content)
+                if self.known(db_name, doc, fn, digest):
+                    attachments[fn] = dict(stub=True)
+                    self.skip(length)
+                else:
+                    uploads.append((doc, fn, digest, length))
+        return uploads
+
+    def commit(self, db_name, uploads, results):
+        """Record the uploads from a save whose results are in a ConflictResolution"""
+        resolved = getattr(results, 'resolved', {})
+        for doc, fn, digest, length in uploads:
+            if doc.get('_id') in resolved:
+                self.record(db_name, resolved[doc['_id']], fn, digest, length)
+
+
+class FeedFollower(object):
+    """Base class for caches that can be kept in sync with a database's _changes feed.
+
+    Subclasses receive each batch of changes through their `_apply` method.
+    """
+    seq = None
+    feed = None
+    heartbeat = 30
+
+    def follow(self, db, heartbeat=30, **options):
+        """Keep the cache in sync with a database's _changes feed.
+        
+        The feed starts from the database's current update_seq and is delivered
+        asynchronously, so a tornado ioloop (or gevent) needs to be running. Until the
+        feed's first heartbeat or change arrives (and whenever it's been disconnected)
+        the cache isn't trusted and reads are revalidated with the server as usual. If
+        the server closes the feed, it's reopened from the last seq applied.
+        
+        Args:
+            db (Database): the database whose changes should be tracked
+            
+        Kwargs:
+            heartbeat (int): seconds between keepalives. If the feed falls silent for 
+            twice this long, the cache stops trusting it.
+            
+            Other kwargs are passed along to the ChangesFeed (e.g., `filter`)
+        """
+        self.unfollow()
+        self.heartbeat = heartbeat
+        self.seq = db.info()['update_seq']
+        self.feed = db.changes(feed='continuous', since=self.seq, heartbeat=heartbeat, 
+                               latency=0, callback=self._apply, reconnect=True, **options)
+        return self.feed
+
+    def unfollow(self):
+        """Disconnect from the changes feed"""
+        if self.feed is not None:
+            self.feed.reconnect = False
+            if self.feed.listening:
+                self.feed.stop()
+            self.feed = None
+        self.seq = None
+
+    def trusted(self, min_seq=None):
+        """Return whether the feed is connected and up to date.
+        
+        Kwargs:
+            min_seq (int): only trust the cache if it has applied at least this seq
+        """
+        feed = self.feed
+        if feed is None or not feed.listening or feed.last_heard is None:
+            return False
+        if time.time() - feed.last_heard > 2*self.heartbeat:
+            return False
+        return min_seq is None or self.seq >= min_seq
+
+    def _apply(self, seq, changes):
+        raise NotImplementedError
+
+
+class DocCache(FeedFollower):
+    """Keeps decoded docs around so repeat reads don't have to download them again.
+
+    Each cached doc is stored along with its ETag and later requests for the same
+    ID are sent with an `If-None-Match` header. When the server responds with a
+    `304 Not Modified`, the cached copy is returned without any json decoding.
+    Each caller gets its own copy of the doc, so changes made to it (saved or not)
+    never show up in later reads.
+    
+    Calling `.follow(db)` subscribes the cache to the database's _changes feed. 
+    Entries are then evicted as soon as a change to their doc arrives and, for as
+    long as the feed stays connected, cached docs are served straight from memory 
+    without a revalidation request.
+
+    Attributes:
+        stats (dict): counts of cache `hits` (served after a 304 or from a followed
+        cache), `misses` (full downloads), conditional requests sent 
+        (`revalidations`), and entries evicted by the changes feed (`invalidations`)
+        
+        seq (int): the most recent update_seq applied from the changes feed (or None
+        if the cache isn't following a feed)
+    """
+    def __init__(self, entries=1000, bytes=16*1024*1024):
+        """Initialize the cache.
+
+        Kwargs:
+            entries (int): the maximum number of docs to hold onto
+
+            bytes (int): the maximum total size (as measured by the responses' 
+            Content-Length) of the cached docs
+        """
+        self.stats = adict(hits=0, misses=0, revalidations=0, invalidations=0)
+        self._lru = LRU(entries=entries, bytes=bytes)
+        self._changed = LRU(entries=entries)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._lru
+
+    def lookup(self, doc_id):
+        """Return the (etag, doc) pair for a cached doc or None"""
+        return self._lru.get(doc_id)
+
+    def store(self, doc_id, etag, doc, nbytes=0, seq=None):
+        """Add a doc to the cache.
+        
+        Kwargs:
+            seq (int): the feed's seq at the time the doc was requested. If a change
+            to the doc has arrived since then, the response might already be stale
+            and won't be cached.
+        """
+        if seq is not None and self._changed.get(doc_id, seq) > seq:
+            return
+        if etag:
+            self._lru.put(doc_id, (etag, doc), nbytes)
+
+    def evict(self, doc_id):
+        self._lru.pop(doc_id)
+
+    def clear(self):
+        self._lru.clear()
+
+    def _apply(self, seq, changes):
+        for change in changes:
+            self._changed.put(change['id'], change.get('seq', seq))
+            if change['id'] in self._lru:
+                self.evict(change['id'])
+                self.stats.invalidations += 1
+        self.seq = seq
+
+
+class ViewCache(object):
+    """Keeps the results of recent view queries keyed by view name and query options.
+
+    Cached results are revalidated with the view's ETag (which changes whenever the
+    index is updated) so a repeat query costs a round trip but no download or json
+    decoding. Results younger than `ttl` seconds are returned without contacting the
+    server at all. Within a further `stale` seconds, async queries get the cached
+    results immediately while a revalidation runs in the background (the client-side
+    analogue of ``stale='update_after'``).
+
+    Attributes:
+        stats (dict): per-view counts of `hits`, `misses`, `revalidations`, and
+        results served `stale`. See also `.hit_rate(view)`.
+    """
+    def __init__(self, entries=500, bytes=16*1024*1024, ttl=0, stale=0):
+        """Initialize the cache.
+
+        Kwargs:
+            entries (int): the maximum number of result sets to hold onto
+
+            bytes (int): the maximum total size of the cached responses
+
+            ttl (int): seconds during which results are trusted without revalidation
+
+            stale (int): seconds past the ttl during which results may be served while
+            being refreshed in the background
+        """
+        self.ttl = ttl
+        self.stale = stale
+        self.stats = adict()
+        self._lru = LRU(entries=entries, bytes=bytes)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def key(self, name, options, keys=None):
+        """Build the cache key for a query from its (encoded) options"""
+        return (name, tuple(sorted(options.items())), json.encode(keys) if keys else None)
+
+    def lookup(self, key):
+        return self._lru.get(key)
+
+    def store(self, key, etag, results, nbytes=0):
+        if etag:
+            entry = adict(etag=etag, results=results, stored=time.time(), refreshing=False)
+            self._lru.put(key, entry, nbytes)
+
+    def revalidated(self, key, entry):
+        """Mark an entry as current after the server responded with a 304"""
+        entry.stored = time.time()
+        entry.refreshing = False
+
+    def fresh(self, entry):
+        return time.time() - entry.stored < self.ttl
+
+    def servable(self, entry):
+        """Return whether an expired entry can be served while it's being refreshed"""
+        return not entry.refreshing and time.time() - entry.stored < self.ttl + self.stale
+
+    def count(self, name, counter):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = adict(hits=0, misses=0, revalidations=0, stale=0)
+        stats[counter] += 1
+
+    def hit_rate(self, name):
+        """The fraction of queries to a view that were answered from the cache"""
+        stats = self.stats.get(name)
+        if not stats or not stats.hits+stats.misses:
+            return 0.0
+        return float(stats.hits) / (stats.hits+stats.misses)
+
+    def clear(self):
+        self._lru.clear()
+
+
+class NegativeCache(FeedFollower):
+    """Remembers which docs (or databases) turned out not to exist.
+
+    Once a lookup has ended in a NotFound, repeating it within `ttl` seconds raises
+    the same error without a round trip. Entries are forgotten when the key is
+    written through the same client and, if the cache is following a _changes feed,
+    as soon as a change to the doc arrives.
+
+    Attributes:
+        stats (dict): counts of 404 round trips `avoided`, NotFounds `stored`, and
+        entries dropped because the doc was written (`invalidations`)
+    """
+    def __init__(self, entries=10000, ttl=60):
+        """Initialize the cache.
+
+        Kwargs:
+            entries (int): the maximum number of missing keys to remember
+
+            ttl (int): seconds before a key is worth asking the server about again
+        """
+        self.ttl = ttl
+        self.stats = adict(avoided=0, stored=0, invalidations=0)
+        self._lru = LRU(entries=entries)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __contains__(self, key):
+        return self.missing(key, count=False) is not None
+
+    def missing(self, key, count=True):
+        """Return a NotFound Status for a key known to be missing (or None)"""
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        expires, reason = entry
+        if time.time() > expires:
+            self._lru.pop(key)
+            return None
+        if count:
+            self.stats.avoided += 1
+        return Status(404, exc=NotFound(reason), headers={})
+
+    def remember(self, key, exc=None):
+        """Record that a lookup of `key` ended in a NotFound"""
+        self.stats.stored += 1
+        self._lru.put(key, (time.time()+self.ttl, str(exc or '')))
+
+    def forget(self, key):
+        if self._lru.pop(key) is not None:
+            self.stats.invalidations += 1
+
+    def clear(self):
+        self._lru.clear()
+
+    def _apply(self, seq, changes):
+        for change in changes:
+            self.forget(change['id'])
+        self.seq = seq
@@ -26,6 +26,17 @@ defaults = adict({
                 "max_clients":10,
                 "max_redirects":6,
                 "timeout":60*60,
+                "chunk_size":64*1024,
+                "spool_size":1024*1024,
+                "timings":False,
+                "trace":None,
+                "retries":None,
+                "hedge":None,
+                "breaker":None,
+                "limiter":None,
+                "gzip":True,
+                "gzip_level":6,
+                "gzip_threshold":None,
                 "io_loop":None
             })
          })
@@ -44,7 +55,20 @@ class json(object):
         :return: the corresponding Python data structure
         :rtype: object
         """
-        return _json.loads(string, object_hook=defaults.types.dict, **opts)
+        opts.setdefault('object_hook', defaults.types.dict)
+        return _json.loads(string, **opts)
+
+    @classmethod
+    def decode_at(cls, string, pos, **opts):
+        """Decode the JSON value that begins partway through a string.
+
+        :param string: the string containing the value
+        :param pos: the index at which the value begins
+        :return: the decoded value and the index just past its end
+        :rtype: tuple
+        """
+        opts.setdefault('object_hook', defaults.types.dict)
+        return _json.JSONDecoder(**opts).raw_decode(string, pos)
 
     @classmethod
     def encode(cls, obj, **opts):
@@ -6,12 +6,17 @@ Basic python mapping of the CouchDB HTTP api.
 """
 
 import os, re
+import time
 import mimetypes
 from urlparse import urlsplit, urlunsplit
-from .io import Resource, ChangesFeed, quote, urlencode, is_relaxed
+from .io import Resource, ChangesFeed, MultipartSink, quote, urlencode, is_relaxed, hooks, \
+                url_template, decode_doc, decode_rows, relaxed_task, IO
 from .exceptions import HTTPError, PreconditionFailed, NotFound, ServerError, Unauthorized, \
                         Conflict, ConflictResolution
-from .atoms import View, Row, Document, Status, adict, odict
+from .atoms import View, Row, Document, Status, adict, odict, raw_json, _copy
+from .cluster import Cluster
+from .cache import DigestIndex, DocCache, ViewCache, NegativeCache, attachment_digest
+from .patch import PatchQueue
 from .config import defaults, json
 
 
@@ -24,7 +29,8 @@ class Couch(object):
     
     Useful for creating/deleting DBs and dealing with system-level functionality such
     as replication and task monitoring."""
-    def __init__(self, url=None, auth=None, full_commit=True):
+    def __init__(self, url=None, auth=None, full_commit=True, missing_cache=False, retries=None, 
+                       urls=None, hedge=None, breaker=None):
         """Initialize the server object.
         
         Args:
@@ -34,22 +40,61 @@ class Couch(object):
 
         Kwargs:
             full_commit (bool): include the X-Couch-Full-Commit header
+
+            missing_cache (bool, NegativeCache): if True (or an existing NegativeCache), 
+            remember the names of databases that turned out not to exist rather than
+            asking the server again. Databases created through this object are 
+            forgotten immediately.
+
+            retries (RetryPolicy): repeat requests that fail with a transient error 
+            (when it's safe to do so) according to the given corduroy.io.RetryPolicy. 
+            Overrides `defaults.http.retries` and is inherited by the server's Databases.
+
+            urls (list, Cluster): the nodes of a cluster to spread requests across (in 
+            place of a single `url`). Pass a corduroy.cluster.Cluster to choose how 
+            they're balanced and health-checked. Databases inherit the cluster.
+
+            hedge (HedgePolicy): send a duplicate of any read that's slower than usual
+            and use whichever response arrives first (see corduroy.io.HedgePolicy).
+            Overrides `defaults.http.hedge` and is inherited by the server's Databases.
+
+            breaker (CircuitBreaker): fail fast with CircuitOpen while the server (or one
+            of its databases) is erroring or unresponsive (see corduroy.io.CircuitBreaker).
+            Overrides `defaults.http.breaker` and is inherited by the server's Databases.
         """        
+        cluster = None
+        if urls is not None:
+            cluster = urls if isinstance(urls, Cluster) else Cluster(urls)
+            url, auth = cluster.primary, auth or cluster.credentials
         if url is None or isinstance(url, basestring):
             self.resource = Resource(url, auth=auth)
         else:
             self.resource = url # treat as a Resource object
+        if retries is not None:
+            self.resource.retries = retries
+        if cluster is not None:
+            self.resource.cluster = cluster
+        if hedge is not None:
+            self.resource.hedge = hedge
+        if breaker is not None:
+            self.resource.breaker = breaker
         if not full_commit:
             self.resource.headers['X-Couch-Full-Commit'] = 'false'
+        self.missing_cache = NegativeCache() if missing_cache is True else (missing_cache if missing_cache is not False else None)
 
     def __contains__(self, name):
         """Return whether the server contains a database with the specified
         name. (synchronous)
         """
+        missing = self.missing_cache
+        if missing is not None and missing.missing(name):
+            return False
         try:
             self.resource.head(validate_dbname(name))
             return True
-        except NotFound:
+        except NotFound, e:
+            if missing is not None:
+                missing.remember(name, e)
             return False
 
     def __iter__(self):
@@ -80,8 +125,17 @@ class Couch(object):
     def __getitem__(self, name):
         """Return a `Database` object representing the database with thespecified name.
         (synchronous)"""
+        missing = self.missing_cache
+        status = missing.missing(name) if missing is not None else None
+        if status:
+            raise status.exception
         db = Database(self.resource(name))
-        db.resource.head() # actually make a request to the database
+        try:
+            db.resource.head() # actually make a request to the database
+        except NotFound, e:
+            if missing is not None:
+                missing.remember(name, e)
+            raise
         return db
 
     def config(self, name=None, value=None, delete=False, callback=None):
@@ -188,8 +242,17 @@ class Couch(object):
         Raises:
             NotFound (when database does not exists and create_if_missing==False)
         """
+        missing = self.missing_cache
+        known_missing = missing.missing(name) if missing is not None else None
+        if known_missing:
+            if create_if_missing:
+                return self.create(name, callback=callback)
+            return _short_circuit(None, known_missing, callback)
+
         _db = Database(self.resource(name))
         def handle_missing(data, status):
+            if status.error is NotFound and missing is not None:
+                missing.remember(name, status.exception)
             if status.ok:
                 data = _db
             elif status.error is NotFound and create_if_missing:
@@ -203,7 +266,9 @@ class Couch(object):
         else:
             try:
                 return _db.resource.get_json(process=handle_missing)
-            except NotFound:
+            except NotFound, e:
+                if missing is not None:
+                    missing.remember(name, e)
                 if not create_if_missing: raise
                 return self.create(name)
 
@@ -227,6 +292,8 @@ class Couch(object):
             if status.ok: 
                 db = Database(self.resource(name))
                 data = db
+                if self.missing_cache is not None:
+                    self.missing_cache.forget(name)
             return data, status
         return self.resource.put_json(validate_dbname(name), process=postproc, callback=callback)
 
@@ -299,7 +366,8 @@ class Database(object):
     """Represents a single DB on a couch server. 
     
     This is the primary class for interacting with documents, views, changes, et al."""
-    def __init__(self, name, auth=None):
+    def __init__(self, name, auth=None, dedupe=False, cache=False, view_cache=False, missing_cache=False, 
+                       retries=None, hedge=None, breaker=None, patches=False):
         """Initialize the database object.
         
         Args:
@@ -307,6 +375,42 @@ class Database(object):
             (to which the host specified in corduroy.defaults will be prepended)
             
             auth (tuple): optional login information. e.g., ('username', 'password')
+
+        Kwargs:
+            dedupe (bool, DigestIndex): if True (or an existing DigestIndex), skip uploading
+            attachments whose bytes are already attached to the doc's current revision.
+            Stats on the skipped uploads can be found in `db.dedupe.stats`
+
+            cache (bool, str, DocCache): if True (or an existing DocCache), hold onto recently
+            fetched docs and revalidate them with conditional GETs rather than downloading
+            them again. If 'changes', the cache will follow the database's _changes feed
+            and serve docs from memory without revalidating them. Hit/miss counts can
+            be found in `db.cache.stats`
+
+            view_cache (bool, ViewCache): if True (or an existing ViewCache), hold onto the
+            results of recent view queries and revalidate them using the view's ETag.
+            Per-view hit rates can be found in `db.view_cache.stats`
+
+            missing_cache (bool, str, NegativeCache): if True (or an existing NegativeCache),
+            remember which doc IDs turned out not to exist and raise NotFound for them
+            without a round trip until the doc is saved through this object. If 'changes',
+            docs created by other clients are also noticed via the _changes feed. The 
+            number of requests avoided can be found in `db.missing_cache.stats`
+
+            retries (RetryPolicy): repeat requests that fail with a transient error 
+            according to the given corduroy.io.RetryPolicy (see Couch.__init__). Docs
+            rejected individually by _bulk_docs with a transient error are resent on 
+            their own.
+
+            hedge (HedgePolicy): duplicate reads that are slower than usual according to
+            the given corduroy.io.HedgePolicy (see Couch.__init__)
+
+            breaker (CircuitBreaker): fail fast with CircuitOpen while the database is
+            erroring or unresponsive (see Couch.__init__)
+
+            patches (bool, PatchQueue): if True (or an existing corduroy.patch.PatchQueue),
+            coalesce calls to `patch` that touch the same doc within a short window into a
+            single request. Counts of the requests saved can be found in `db.patches.stats`
         """        
         if isinstance(name, basestring):
             self.resource = Resource(name, auth=auth)
@@ -314,8 +418,23 @@ class Database(object):
             self.resource = name
         else:
             raise ValueError('expected str, got %s'%type(name))
+        if retries is not None:
+            self.resource.retries = retries
+        if hedge is not None:
+            self.resource.hedge = hedge
+        if breaker is not None:
+            self.resource.breaker = breaker
             
         self.name = validate_dbname(self.resource.url.split('/')[-1], encoded=True)
+        self.dedupe = DigestIndex() if dedupe is True else (dedupe if dedupe is not False else None)
+        self.cache = DocCache() if cache in (True, 'changes') else (cache if cache is not False else None)
+        if cache == 'changes':
+            self.cache.follow(self)
+        self.view_cache = ViewCache() if view_cache is True else (view_cache if view_cache is not False else None)
+        self.missing_cache = NegativeCache() if missing_cache in (True, 'changes') else (missing_cache if missing_cache is not False else None)
+        if missing_cache == 'changes':
+            self.missing_cache.follow(self)
+        self.patches = PatchQueue() if patches is True else (patches if patches is not False else None)
         self._uuids = []
 
     def __repr__(self):
@@ -325,10 +444,15 @@ class Database(object):
         """Return whether the database contains a document with the specified
         ID. (synchronous)
         """
+        missing = self.missing_cache
+        if missing is not None and missing.missing(id):
+            return False
         try:
-            data, status = _doc_resource(self.resource, id).head()
+            _doc_resource(self.resource, id).head()
             return True
-        except NotFound:
+        except NotFound, e:
+            if missing is not None:
+                missing.remember(id, e)
             return False
 
     def __iter__(self):
@@ -356,14 +480,15 @@ class Database(object):
         
         def postproc(data, status):
             result = resource.delete_json(rev=status.headers['etag'].strip('"'))
+            if self.cache is not None:
+                self.cache.evict(id)
             return result, status
         return resource.head(process=postproc)
 
     def __getitem__(self, id):
         """Return the document with the specified ID. (synchronous)
         """
-        data = _doc_resource(self.resource, id).get_json()
-        return defaults.types.doc(data)
+        return self.get(id)
 
     def __setitem__(self, id, content):
         """Create or update a document with the specified ID. (synchronous)
@@ -513,7 +638,7 @@ class Database(object):
         """Perform a bulk fetch of documents (ici il y avoir des dragons)"""
         
         propterhoc = process or NOOP
-        def posthoc(view, status):
+        def unpack(view, status):
             # pull the docs out of their rows and build a list of docs and Nones
             # depending on whether the fetch was successful
             data = view
@@ -533,7 +658,8 @@ class Database(object):
                         ))
                         
                     data = doc_stubs
-            return propterhoc(data, status)
+            return data, status
+        posthoc = _chain(unpack, propterhoc)
 
 
         if doc_ids is False:
@@ -541,6 +667,15 @@ class Database(object):
             # to be containing a string gets passed as the doc id. best not to do a full-db get in response...)
             options.setdefault('limit',50)
             return self.view('_all_docs', include_docs=include_docs, process=posthoc, callback=callback, **options)
+
+        size = _chunk_size(self.resource, len(doc_ids), callback, **options)
+        if size:
+            # fetch a long list of ids in several smaller requests if the server's struggling
+            def send(ids, callback=None):
+                return self.view('_all_docs', keys=ids, include_docs=include_docs, process=unpack, 
+                                 callback=callback, **options)
+            finish = _chain(propterhoc, callback) if callback else propterhoc
+            return _in_chunks(doc_ids, size, send, finish, callback)
         return self.view('_all_docs',keys=doc_ids, include_docs=include_docs, process=posthoc, callback=callback, **options)
 
     def get(self, id_or_ids=False, callback=None, **options):
@@ -556,6 +691,16 @@ class Database(object):
         
             revs_info (bool): if true, add a _revs_info attribute to the returned doc
 
+            min_seq (int): when using a changes-following cache, only serve the doc from
+            memory if the cache has caught up to at least this update_seq
+
+            attachments (bool): if true, include the contents of the doc's attachments
+            (base64-encoded in each `_attachments` entry's `data` field)
+            
+            stream (bool): when used with `attachments=True`, request the doc and its 
+            attachments as a multipart response. Each attachment's `data` field will then
+            be a file-like object holding the raw bytes rather than a base64 string
+
             When called with a list of IDs, all standard view options can be applied
             (see Database.view for a complete listing).
 
@@ -570,17 +715,65 @@ class Database(object):
         Raises:
             NotFound (when a single ID is requested and no corresponding doc is found)
         """
+        stream = options.pop('stream', False)
         if not isinstance(id_or_ids, basestring):
             return self._bulk_get(id_or_ids, callback=callback, **options)
         
+        # plain fetches can be revalidated against a previously cached copy (or 
+        # skipped entirely if the cache is being kept up to date by the changes feed)
+        min_seq = options.pop('min_seq', None)
+        plain = not (options or stream)
+        missing = self.missing_cache if plain else None
+        if missing is not None:
+            known_missing = missing.missing(id_or_ids)
+            if known_missing:
+                return _short_circuit(None, known_missing, callback)
+        cache = self.cache if plain else None
+        cached = cache.lookup(id_or_ids) if cache is not None else None
+        if cached and cache.trusted(min_seq):
+            cache.stats.hits += 1
+            return _short_circuit(_loaded(_copy(cached[1])), Status(304, headers={}), callback)
+        seq = cache.seq if cache is not None else None
+        
         def postproc(data, status):
             if status.ok:
-                if isinstance(data, (list,tuple)):
+                if status.code == 304 and cached:
+                    cache.stats.hits += 1
+                    data = _loaded(_copy(cached[1]))
+                elif isinstance(data, (list,tuple)):
                     data = [defaults.types.doc(d) for d in data]
                 else:
-                    data = defaults.types.doc(data)
+                    if cache is not None:
+                        cache.stats.misses += 1
+                        cache.store(id_or_ids, status.headers.get('etag'), _copy(data), 
+                                    int(status.headers.get('content-length') or 0), seq=seq)
+                    data = _loaded(data)
+            elif status.error is NotFound:
+                gone(status.exception)
             return data, status
-        return _doc_resource(self.resource, id_or_ids).get_json(process=postproc, callback=callback, **options)
+
+        def gone(exc):
+            if cache is not None:
+                cache.evict(id_or_ids)
+            if missing is not None:
+                missing.remember(id_or_ids, exc)
+
+        headers = None
+        if cached:
+            headers = {'If-None-Match':cached[0]}
+            cache.stats.revalidations += 1
+        if stream and options.get('attachments'):
+            headers = {'Accept':'multipart/related, application/json'}
+            stream = MultipartSink()
+        else:
+            stream = None
+        try:
+            return _doc_resource(self.resource, id_or_ids).get_json(process=postproc, callback=callback, 
+                                                                    headers=headers, stream=stream, 
+                                                                    decode=decode_doc, **options)
+        except NotFound, e:
+            gone(e)
+            raise
 
 
     def _solo_save(self, doc, force=False, merge=None, callback=None, **options):
@@ -628,12 +821,47 @@ class Database(object):
             else:
                 raise TypeError('expected dict, got %s' % type(doc))
 
+        policy = self.resource.retry_policy
+        attempt = [1]
+
+        def resend(data, status, pending):
+            # repost just the docs that failed transiently, then slot their results into
+            # the original response before looking for conflicts
+            info = adict(method='POST', url=self.resource('_bulk_docs').url, attempt=attempt[0],
+                         delay=policy.delay(attempt[0], status))
+            info.template = url_template(info.url)
+            hooks.fire('on_retry', info, status)
+            attempt[0] += 1
+            content = dict(options, docs=[to_post[i] for i in pending])
+
+            def merge_results(results, resent):
+                if resent.ok:
+                    for i, result in zip(pending, results):
+                        data[i] = result
+                return bulkproc(data, status)
+
+            if callback:
+                post = lambda: self.resource.post_json('_bulk_docs', body=content, callback=merge_results, **options)
+                return self.resource.io.timeout(info.delay, post)
+            time.sleep(info.delay)
+            try:
+                results = self.resource.post_json('_bulk_docs', body=content, **options)
+            except HTTPError, e:
+                return merge_results(None, e.status)
+            return merge_results(results, Status(201))
+
         def bulkproc(data, status):
             # print "[%i]"%status.code
             handle_remaining = callback or NOOP
+            if status.ok and policy:
+                pending = policy.transient_docs(data)
+                if pending and policy.permit(attempt[0]):
+                    return resend(data, status, pending)
             if status.ok:
                 conflicts = ConflictResolution(self, data, docs)
                 data = conflicts
+                if hooks and conflicts.pending:
+                    hooks.fire('on_conflict', conflicts)
                 if conflicts.pending:
                     if force:
                         return conflicts.overwrite(callback=callback), status
@@ -643,6 +871,15 @@ class Database(object):
             # no conflicts, returning after the single round-trip
             return handle_remaining(data, status)
         
+        size = _chunk_size(self.resource, len(to_post), callback, **options)
+        if size:
+            # split up large saves if the server's struggling (with the results reassembled
+            # before conflicts are dealt with)
+            def send(chunk, callback=None):
+                return self.resource.post_json('_bulk_docs', body=dict(options, docs=chunk), 
+                                               callback=callback, **options)
+            return _in_chunks(to_post, size, send, bulkproc, callback, failed=_failed_writes)
+
         content = dict(docs=to_post)
         content.update(options)
 
@@ -651,7 +888,7 @@ class Database(object):
         else: proc = bulkproc
         return self.resource.post_json('_bulk_docs', body=content, process=proc, callback=cb, **options)
     
-    def save(self, doc_or_docs=None, merge=None, force=False, callback=None, **options):
+    def save(self, doc_or_docs=None, merge=None, force=False, callback=None, skip_unmodified=False, **options):
         """Create a new document or update an existing document.
         
         Args:
@@ -676,6 +913,10 @@ class Database(object):
             fetched and the `merge` function will be called for each local/remote pair. The
             merge function should return either a dict-like object to be written to the database
             or (in case the write attempt should be abandoned) None.
+
+            skip_unmodified (bool): if True, Documents that haven't been changed since they
+            were loaded from (or last saved to) the server won't be sent. They'll be listed
+            in the return value's `.resolved` property as if they had been written.
             
         Side Effects:
             All docs passed as arguments will have their _id and/or _rev updated to reflect a 
@@ -704,9 +945,29 @@ class Database(object):
                 gen_callback = callback # supplied by gen.Task
                 def unpack_results(data, status):
                     gen_callback(data) if status.ok else gen_callback(status.exception)
-                self.save(doc_or_docs, merge=merge, force=force, callback=unpack_results, **options)
+                self.save(doc_or_docs, merge=merge, force=force, callback=unpack_results, 
+                          skip_unmodified=skip_unmodified, **options)
             return gen.Task(multipass)
 
+        # leave out any docs that match the server's copy
+        unmodified = []
+        if skip_unmodified:
+            docs = doc_or_docs if isinstance(doc_or_docs, (list, tuple)) else [doc_or_docs]
+            unmodified = [doc for doc in docs if isinstance(doc, Document) and not doc.is_dirty()]
+            if unmodified:
+                skipped = set(id(doc) for doc in unmodified)
+                doc_or_docs = [doc for doc in docs if id(doc) not in skipped]
+                def report_unmodified(data, status):
+                    if status.ok:
+                        for doc in unmodified:
+                            data.resolved[doc['_id']] = doc
+                    return data, status
+                if not doc_or_docs:
+                    data, status = report_unmodified(ConflictResolution(self, [], []), Status(200, headers={}))
+                    return _short_circuit(data, status, callback)
+                if callback:
+                    callback = _chain(report_unmodified, callback)
+
         # look for missing _id fields
         orphans = []
         _save = None
@@ -721,8 +982,32 @@ class Database(object):
             raise TypeError('expected dict or list, got %s' % type(doc_or_docs))
 
         # raise an exception if the docs arg isn't serializeable, would be nice to
-        # know if this is as wasteful as it feels...
-        json.encode(doc_or_docs)
+        # know if this is as wasteful as it feels... (file objects in _attachments
+        # are sent separately so they get a pass, as do unmodified lazy docs since
+        # they'll be sent as the json they arrived as)
+        docs = doc_or_docs if isinstance(doc_or_docs, (list, tuple)) else [doc_or_docs]
+        json.encode([doc for doc in docs if raw_json(doc) is None], default=_skip_files)
+
+        # swap in stubs for any attachments the server already has and make a note
+        # of the ones that get uploaded once the save completes
+        uploads = None
+        if self.dedupe is not None:
+            uploads = self.dedupe.prepare(self.name, docs)
+
+        # once the write completes, update the upload index and make sure subsequent 
+        # reads from the cache don't return the old versions
+        def saved(data, status):
+            if status.ok:
+                if uploads:
+                    self.dedupe.commit(self.name, uploads, data)
+                for doc in docs:
+                    if self.cache is not None:
+                        self.cache.evict(doc.get('_id'))
+                    if self.missing_cache is not None:
+                        self.missing_cache.forget(doc.get('_id'))
+            return data, status
+        if callback:
+            callback = _chain(saved, callback)
 
         # fill in missing _ids with cached/fetched uuids then proceed with the save
         if len(orphans) > len(self._uuids):
@@ -739,14 +1024,20 @@ class Database(object):
             cb = proc = None
             if callback: cb = decorate_uuids
             else: proc = decorate_uuids
-            return _couch.resource.get_json('_uuids', callback=cb, process=proc, count=max(len(orphans), defaults.uuid_cache))
+            result = _couch.resource.get_json('_uuids', callback=cb, process=proc, count=max(len(orphans), defaults.uuid_cache))
             
         else:
             if orphans:
                 for doc, uuid in zip(orphans, self._uuids):
                     doc['_id'] = uuid
                 self._uuids = self._uuids[len(orphans):]
-            return _save(doc_or_docs, force=force, merge=merge, callback=callback, **options)
+            result = _save(doc_or_docs, force=force, merge=merge, callback=callback, **options)
+
+        if not callback:
+            saved(result, Status(200))
+            if unmodified:
+                report_unmodified(result, Status(200))
+        return result
 
     def copy(self, source, dest, callback=None):
         """Copy a given document to create a new document or overwrite an old one.
@@ -811,9 +1102,15 @@ class Database(object):
         if doc['_id'] is None:
             raise ValueError('document ID cannot be None')
         headers={'Content-Type': 'application/json'}
+
+        def postproc(data, status):
+            if status.ok and self.cache is not None:
+                self.cache.evict(doc['_id'])
+            return data, status
         
         # TODO *could* have it return the doc but with _deleted=True appended...
-        return _doc_resource(self.resource, doc['_id']).delete_json(rev=doc['_rev'], headers=headers, callback=callback)
+        return _doc_resource(self.resource, doc['_id']).delete_json(rev=doc['_rev'], headers=headers, 
+                                                                    process=postproc, callback=callback)
 
 
     def revisions(self, id, callback=None, **options):
@@ -889,7 +1186,7 @@ class Database(object):
         resource = _doc_resource(self.resource, doc['_id'])
         return resource.delete_json(filename, rev=doc['_rev'], process=postproc, callback=callback)
 
-    def get_attachment(self, id_or_doc, filename, callback=None):
+    def get_attachment(self, id_or_doc, filename, stream=None, callback=None):
         """Return an attachment from the specified doc and filename.
         
         Args:
@@ -897,15 +1194,24 @@ class Database(object):
             
             filename (str): the name of the attachment to retrieve
             
+        Kwargs:
+            stream (bool, file): if True, the attachment will be written to a temporary
+            file in `defaults.http.chunk_size` pieces rather than being read into memory
+            all at once. Alternatively, pass any object with a `write` method (e.g., an
+            open file) and the data will be streamed directly into it.
+            
         Returns:
             str. The raw attachment data as a bytestring
+            
+            When streaming, returns a file-like object (either the `stream` argument 
+            itself or a temporary file rewound to the beginning of the data)
         """
         if isinstance(id_or_doc, basestring):
             _id = id_or_doc
         else:
             _id = id_or_doc['_id']
             
-        return _doc_resource(self.resource, _id).get(filename, callback=callback)
+        return _doc_resource(self.resource, _id).get(filename, stream=stream, callback=callback)
 
     def put_attachment(self, doc, content, filename=None, content_type=None, callback=None):
         """Create or replace an attachment.
@@ -938,6 +1244,13 @@ class Database(object):
             content_type = ';'.join(
                 filter(None, mimetypes.guess_type(filename))
             )
+
+        digest = length = None
+        if self.dedupe is not None:
+            digest, length = attachment_digest(content)
+            if self.dedupe.known(self.name, doc, filename, digest):
+                self.dedupe.skip(length)
+                return _short_circuit(doc, Status(304, headers={}), callback)
             
         def postproc(data, status):
             if status.ok:
@@ -946,6 +1259,8 @@ class Database(object):
                 _attch[filename] = dict(content_type=content_type, stub=True, added=True)
                 doc['_attachments'] = _attch
                 data = doc
+                if self.dedupe is not None:
+                    self.dedupe.record(self.name, doc, filename, digest, length)
             return data, status
         resource = _doc_resource(self.resource, doc['_id'])
         headers={'Content-Type': content_type}
@@ -1068,6 +1383,50 @@ class Database(object):
             headers['Content-Type'] = 'application/x-www-form-urlencoded'
         return func(callback=callback, body=body, headers=headers, **options)
         
+    def patch(self, id, fields, callback=None):
+        """Update some of a document's fields without sending the rest of it.
+
+        The fields are applied on the server by a generic update handler (which is added
+        to the `_design/corduroy` doc the first time it's needed), so neither the doc's
+        current contents nor its _rev have to be known. The doc is created if it doesn't
+        exist yet and is left alone (without a new revision) if none of the values differ.
+        The handler is written in javascript unless the database's PatchQueue specifies
+        another `language`.
+
+        Args:
+            id (str): the _id of the doc to update
+
+            fields (dict): the top-level fields to set and their new values
+
+        Returns:
+            dict. The doc's `id` along with its `rev` after the update
+
+        Raises:
+            Conflict (if the doc kept changing out from under the handler)
+
+            ValueError (if `_design/corduroy` already exists in a different language than
+            the one the handler is written in)
+        """
+        if not callback and is_relaxed():
+            return relaxed_task(lambda cb: self.patch(id, fields, callback=cb))
+        if '_id' in fields or '_rev' in fields:
+            raise ValueError('patches can only set a doc\'s own fields, not its _id or _rev')
+        queue = self.patches or PatchQueue(window=0)
+
+        def patched(data, status):
+            if status.ok:
+                if self.cache is not None:
+                    self.cache.evict(id)
+                if self.missing_cache is not None:
+                    self.missing_cache.forget(id)
+            if callback:
+                callback(data, status)
+        if callback:
+            return queue.patch(self, id, fields, callback=patched)
+        data = queue.patch(self, id, fields)
+        patched(data, Status(200, headers={}))
+        return data
+
     def changes(self, callback=None, **opts):
         """Retrieve a list of changes from the database or begin listening to
         a continuous feed.
@@ -1233,20 +1592,162 @@ class Database(object):
         propterhoc = options.get('process',NOOP)
         if propterhoc is not NOOP:
             del options['process']
+        cache = self.view_cache
+        key = entry = None
+        stale = False
         def posthoc(data, status):
             if status.ok:
+                if status.code == 304 and entry is not None:
+                    cache.revalidated(key, entry)
+                    data = _copy(entry.results)
+                elif cache is not None:
+                    cache.store(key, status.headers.get('etag'), _copy(data), status.length)
+                if cache is not None and not stale:
+                    cache.count(name, 'hits' if status.code == 304 else 'misses')
                 data = View(name, options, data)
+            elif entry is not None:
+                entry.refreshing = False
             return propterhoc(data, status)
 
         viewkeys = options.pop('keys', None)
         opts = _encode_view_options(options)
+        decode = decode_rows if options.get('include_docs') else None
+        headers = None
+        if cache is not None:
+            key = cache.key(name, opts, viewkeys)
+            entry = cache.lookup(key)
+        if entry is not None:
+            if cache.fresh(entry):
+                cache.count(name, 'hits')
+                data, status = propterhoc(View(name, options, _copy(entry.results)), Status(304, headers={}))
+                return _short_circuit(data, status, callback)
+            if callback and cache.servable(entry):
+                # hand off the stale results right away and refresh them in the background
+                cache.count(name, 'hits')
+                cache.count(name, 'stale')
+                entry.refreshing = stale = True
+                callback, respond = NOOP, callback
+                _short_circuit(*propterhoc(View(name, options, _copy(entry.results)), Status(304, headers={})),
+                               callback=respond)
+            cache.count(name, 'revalidations')
+            headers = {'If-None-Match':entry.etag}
+
         if viewkeys:
-            return self.resource(*path).post_json(body=dict(keys=viewkeys), process=posthoc, callback=callback, **opts)
+            return self.resource(*path).post_json(body=dict(keys=viewkeys), headers=headers, process=posthoc, 
+                                                  callback=callback, decode=decode, **opts)
         else:
-            return self.resource(*path).get_json(process=posthoc, callback=callback, **opts)
-
-
-
+            return self.resource(*path).get_json(headers=headers, process=posthoc, callback=callback, 
+                                                 decode=decode, **opts)
+
+
+
+
+def _loaded(data):
+    """Wrap a doc fetched from the server, noting its state for dirty-tracking"""
+    doc = defaults.types.doc(data)
+    if isinstance(doc, Document):
+        doc.mark_clean()
+    return doc
+
+def _chain(process, callback):
+    """Run a postprocessing step on a response before handing it off to a callback"""
+    def chained(data, status):
+        data, status = process(data, status)
+        return callback(data, status)
+    return chained
+
+def _chunk_size(resource, count, callback=None, **options):
+    """The number of items per request when a bulk operation should be split up (or None)"""
+    limiter = defaults.http.limiter
+    if not limiter or not count:
+        return None
+    if options.get('all_or_nothing') or options.get('new_edits') is False:
+        # the caller is counting on the whole batch being handled in one request
+        return None
+    size = limiter.chunk_size(resource.url)
+    if count <= size or (not callback and is_relaxed()):
+        return None
+    return size
+
+def _in_chunks(items, size, send, process, callback=None, failed=None):
+    """Perform a bulk request as a series of smaller ones, passing their concatenated 
+    results to `process` as though they'd arrived in a single response.
+
+    Every chunk is sent even if some of them fail. The results for a failed chunk are
+    filled in by `failed` so the ones that succeeded still get processed (unless all of
+    them failed, in which case the first failure is reported as usual).
+
+    Args:
+        send (function w/ signature ƒ(items, callback=None)): performs the request for a
+        single chunk of items
+
+        process (function w/ signature ƒ(data, status)): the postprocessing step for the
+        combined response (which is also responsible for calling the `callback`, if any)
+
+        failed (function w/ signature ƒ(items, status)): returns the per-item results to
+        stand in for a chunk whose request failed
+    """
+    failed = failed or (lambda chunk, status: [None] * len(chunk))
+    chunks = [items[i:i+size] for i in xrange(0, len(items), size)]
+    results = [None] * len(chunks)
+    failures = []
+
+    def combined(status):
+        if len(failures) == len(chunks):
+            return None, failures[0]
+        for i, chunk in enumerate(chunks):
+            if results[i] is None:
+                results[i] = failed(chunk, failures[0])
+        return sum(results, []), status
+
+    if callback:
+        remaining = [len(chunks)]
+        def collector(i):
+            def collect(data, status):
+                remaining[0] -= 1
+                if status.ok:
+                    results[i] = data
+                else:
+                    failures.append(status)
+                if not remaining[0]:
+                    return process(*combined(status if status.ok else Status(201, headers={})))
+            return collect
+        # the concurrency limiter decides how many of these are in flight at once
+        for i, chunk in enumerate(chunks):
+            send(chunk, callback=collector(i))
+        return
+
+    for i, chunk in enumerate(chunks):
+        try:
+            results[i] = send(chunk)
+        except Exception, e:
+            failures.append(getattr(e, 'status', None) or Status(599, exc=e, headers={}))
+    data, status = combined(Status(201, headers={}))
+    if not status.ok:
+        raise status.exception
+    data, status = process(data, status)
+    return data
+
+def _failed_writes(docs, status):
+    """Stand-in _bulk_docs results for a chunk of docs whose request failed (so they end
+    up in the ConflictResolution's `pending` dict rather than being lost track of)"""
+    info = status.get('response') if isinstance(status.get('response'), dict) else {}
+    reason = info.get('reason') or (str(status.exception) if status.exception else '')
+    return [dict(id=doc.get('_id'), error=info.get('error', 'request_failed'), reason=reason) for doc in docs]
+
+def _short_circuit(data, status, callback=None):
+    """Deliver a result computed without a round trip the same way a response would be
+    (with async callbacks run on the next pass through the event loop rather than before
+    the call that made the request has returned)"""
+    if callback:
+        IO().timeout(0, lambda *_: callback(data, status))
+        return
+    if not status.ok:
+        raise status.exception
+    if is_relaxed():
+        from tornado import gen
+        return gen.Task(lambda callback: callback(data))
+    return data
 
 def _doc_resource(base, doc_id):
     """Return the resource for the given document id.
@@ -1271,6 +1772,12 @@ def _path_from_name(name, type):
     return ['_design', design, type, name]
 
 
+def _skip_files(obj):
+    """Placeholder encoding for file objects when checking whether a doc is serializeable"""
+    if hasattr(obj, 'read'):
+        return None
+    raise TypeError('%r is not JSON serializable' % obj)
+
 def _encode_view_options(options):
     """Encode any items in the options dict that are sent as a JSON string to a
     view/list function.
@@ -29,6 +29,11 @@ class ServerError(HTTPError):
     to a request.
     """
 
+class CircuitOpen(ServerError):
+    """Exception raised (without contacting the server) when a request is turned away by
+    a CircuitBreaker because its host or database has been failing.
+    """
+
 class Unauthorized(HTTPError):
     """Exception raised when the server requires authentication credentials
     but either none are provided, or they are incorrect.
@@ -92,7 +97,11 @@ class ConflictResolution(Conflict):
                 if isinstance(orig, dict):
                     if 'rev' in result:
                         orig['_rev'] = result['rev'] # if batch=ok we won't get one                    
-                    doc = defaults.types.doc(orig.items())
+                        if isinstance(orig, Document):
+                            orig.mark_clean()
+                    doc = defaults.types.doc(orig)
+                    if isinstance(doc, Document) and isinstance(orig, Document) and not orig.is_dirty():
+                        doc.mark_clean()
                     orig_idx = self._originals.index(orig)
                     self._originals[orig_idx] = doc
                     self.resolved[result['id']] = doc
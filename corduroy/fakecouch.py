@@ -0,0 +1,1461 @@
+# encoding: utf-8
+"""
+corduroy.fakecouch
+
+An in-memory CouchDB stand-in for tests and benchmarks.
+"""
+
+from __future__ import with_statement
+import re
+import sys
+import time
+import uuid
+import random
+import socket
+import threading
+import zlib
+import atexit
+import weakref
+from textwrap import dedent
+from base64 import b64encode, b64decode
+from collections import deque
+from hashlib import md5
+from urllib import unquote
+from urlparse import urlsplit, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from .atoms import adict, odict
+from .config import defaults
+from . import __version__ as VERSION
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+VALID_DB_NAME = re.compile(r'^[a-z][a-z0-9_$()+/-]*$')
+SPECIAL_DOC_FIELDS = set(['_id', '_rev', '_attachments', '_deleted', '_revisions', '_revs_info',
+                          '_conflicts', '_deleted_conflicts', '_local_seq'])
+JSON_PARAMS = set(['key', 'keys', 'startkey', 'start_key', 'endkey', 'end_key', 'limit', 'skip',
+                   'descending', 'include_docs', 'inclusive_end', 'group', 'group_level',
+                   'reduce', 'update_seq', 'doc_ids', 'conflicts', 'attachments', 'revs',
+                   'revs_info', 'local_seq', 'heartbeat', 'timeout'])
+
+class CouchError(Exception):
+    """An error response (with the same json body couch would send)"""
+    def __init__(self, code, error, reason=''):
+        super(CouchError, self).__init__(reason)
+        self.code, self.error, self.reason = code, error, reason
+
+
+def collate(value):
+    """Sort key approximating couch's view collation (null < false < true < numbers <
+    strings < arrays < objects, with strings compared case-insensitively first)"""
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value.lower(), value.swapcase())
+    if isinstance(value, (list, tuple)):
+        return (5, [collate(v) for v in value])
+    if isinstance(value, dict):
+        return (6, [(collate(k), collate(v)) for k, v in value.items()])
+    return (7, value)
+
+
+_compiled = {}
+def is_python(src):
+    """Whether a function's source is python (the only kind the fake can run)"""
+    return hasattr(src, '__call__') or dedent(src).lstrip().startswith(('def ', 'import ', 'from '))
+
+def compile_function(src):
+    """Turn python source (couchdb-python style, e.g. ``def fun(doc): yield doc['x'], None``)
+    into a callable. Map functions may also call `emit(key, value)` instead of yielding."""
+    if hasattr(src, '__call__'):
+        return src
+    if src in _compiled:
+        return _compiled[src]
+    if not is_python(src):
+        raise CouchError(501, 'not_implemented', 'the fake server only runs python functions')
+    namespace = {'emit':_emit, 'log':lambda msg: None}
+    before = set(namespace)
+    try:
+        exec dedent(src) in namespace
+    except Exception, e:
+        raise CouchError(400, 'compilation_error', 'Expression does not eval to a function. (%s)' % e)
+    funcs = [v for k, v in namespace.items() if k not in before and hasattr(v, '__call__')]
+    if not funcs:
+        raise CouchError(400, 'compilation_error', 'Expression does not eval to a function.')
+    _compiled[src] = funcs[-1]
+    return funcs[-1]
+
+_emitted = threading.local()
+def _emit(key, value):
+    _emitted.rows.append((key, value))
+
+def run_map(func, doc):
+    """Call a map function and collect its (key, value) pairs (whether yielded or emitted)"""
+    _emitted.rows = []
+    result = func(doc)
+    rows = _emitted.rows
+    if result is not None:
+        rows.extend(result)
+    return rows
+
+
+def builtin_reduce(name, keys, values, rereduce):
+    if name == '_count':
+        return sum(values) if rereduce else len(values)
+    if name == '_sum':
+        return sum(values)
+    if name == '_stats':
+        if not rereduce:
+            values = [dict(sum=v, count=1, min=v, max=v, sumsqr=v*v) for v in values]
+        return dict(sum=sum(v['sum'] for v in values), count=sum(v['count'] for v in values),
+                    min=min(v['min'] for v in values), max=max(v['max'] for v in values),
+                    sumsqr=sum(v['sumsqr'] for v in values))
+    raise CouchError(400, 'query_parse_error', 'unknown builtin reduce function: %s' % name)
+
+
+class _Doc(object):
+    __slots__ = ('id', 'revs', 'body', 'deleted', 'seq', 'attachments', 'history', 'conflicts')
+    def __init__(self, doc_id):
+        self.id = doc_id
+        self.revs = []
+        self.body = {}
+        self.deleted = False
+        self.seq = 0
+        self.attachments = odict()
+        self.history = {}   # rev -> (revs, body, deleted, attachments) of earlier revisions
+        self.conflicts = [] # the losing leaf revs
+
+    def archive(self):
+        if self.revs:
+            self.history[self.rev] = (list(self.revs), self.body, self.deleted, self.attachments)
+
+    def revision(self, rev):
+        """Return a read-only copy of the doc as of an earlier revision (or None)"""
+        if rev == self.rev:
+            return self
+        if rev not in self.history:
+            return None
+        old = _Doc(self.id)
+        old.revs, old.body, old.deleted, old.attachments = self.history[rev]
+        old.seq = self.seq
+        return old
+
+    @property
+    def rev(self):
+        return self.revs[0] if self.revs else None
+
+    @property
+    def pos(self):
+        return int(self.rev.split('-')[0]) if self.revs else 0
+
+
+class _Database(object):
+    def __init__(self, name, lock):
+        self.name = name
+        self.docs = {}
+        self.local = {}
+        self.seq = 0
+        self.by_seq = {}
+        self.security = {}
+        self.revs_limit = 1000
+        self.indexes = {}
+        self.created = time.time()
+        self.changed = threading.Condition(lock)
+
+    @property
+    def doc_count(self):
+        return sum(1 for d in self.docs.itervalues() if not d.deleted)
+
+
+class FakeCouch(object):
+    """An in-memory CouchDB stand-in served over http from a background thread.
+
+    Covers server/db info, docs (including attachments, COPY, revs, and multipart
+    requests and responses), `_bulk_docs`, `_all_docs`, views and temp views (with the
+    map/reduce functions written in python rather than javascript), `_changes` (normal,
+    longpoll, and continuous feeds), `_uuids`, and the assorted maintenance endpoints.
+    Javascript functions (including show/list/update handlers) are answered with a
+    `501 not_implemented` error.
+
+    Views use couchdb-python's conventions, with map functions defined as e.g.
+    ``def fun(doc): yield doc['x'], 1`` (calling `emit(key, value)` works too). Sources
+    are recognized as python by their shape, so the ddoc's declared `language` is ignored.
+
+    Latency, bandwidth, and failures can be injected to see how the client copes.
+
+    Usage:
+        with FakeCouch(latency=0.005) as couch:
+            db = Couch(couch.url).create('test')
+            ...
+
+    Attributes:
+        stats (dict): counts of `requests` served along with the `failures` and dropped
+        connections (`drops`) that were injected, and the body bytes received (`bytes_in`)
+        and sent (`bytes_out`) as they crossed the network
+
+        log (deque): the (method, path) of the most recent 1000 requests
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=None, failure_rate=0,
+                 failure_code=500, drop_rate=0, gzip=False):
+        """Configure the server (call `.start()` to begin listening).
+
+        Kwargs:
+            host (str): the interface to bind to
+
+            port (int): the port to listen on (0 picks a free one)
+
+            latency (float, tuple): seconds to wait before answering each request (or a
+            (min, max) range to pick from at random)
+
+            bandwidth (int): the maximum rate (in bytes per second) at which request 
+            bodies will be read and response bodies sent
+
+            failure_rate (float): the fraction of requests to answer with `failure_code`
+
+            failure_code (int): the http status used for injected failures
+
+            drop_rate (float): the fraction of connections to close without responding
+
+            gzip (bool): compress json responses for clients that accept it (gzipped
+            request bodies are always understood, as they are by couch itself)
+        """
+        self.host, self.port = host, port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.drop_rate = drop_rate
+        self.gzip = gzip
+        self.stats = adict(requests=0, failures=0, drops=0, bytes_in=0, bytes_out=0)
+        self.log = deque(maxlen=1000)
+        self.config = {'couchdb':{'max_document_size':'4294967296'}, 'httpd':{},
+                       'query_servers':{}}
+        self.stopping = False
+        self._lock = threading.RLock()
+        self._dbs = {}
+        self._failures = deque()
+        self._server = None
+        self._thread = None
+        self._defaults = None
+        for name in ('_users', '_replicator'):
+            self._dbs[name] = _Database(name, self._lock)
+
+    def __enter__(self):
+        if self._server is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://%s:%i' % (self.host, self.port)
+
+    def start(self):
+        """Begin serving requests from a daemon thread"""
+        self.stopping = False
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs=dict(poll_interval=0.05))
+        self._thread.daemon = True
+        self._thread.start()
+        _running.add(self)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop serving (closing any open changes feeds) and wait up to `timeout` seconds
+        for the requests in progress to finish. Servers still running when the interpreter
+        exits are stopped automatically."""
+        if self._server is None:
+            return
+        self.stopping = True
+        with self._lock:
+            for db in self._dbs.values():
+                db.changed.notify_all()
+        server, self._server = self._server, None
+        server.shutdown()
+        self._thread.join(timeout)
+        server.finish(timeout)
+        server.server_close()
+        _running.discard(self)
+        self.uninstall()
+
+    def install(self):
+        """Point corduroy.defaults at this server (so `Couch()` and `Database('name')`
+        connect to it)"""
+        if self._defaults is None:
+            self._defaults = (defaults.host, defaults.port)
+        defaults.host, defaults.port = 'http://%s' % self.host, self.port
+        return self
+
+    def uninstall(self):
+        if self._defaults is not None:
+            defaults.host, defaults.port = self._defaults
+            self._defaults = None
+        return self
+
+    def reset(self):
+        """Delete all databases"""
+        with self._lock:
+            self._dbs = dict((n, _Database(n, self._lock)) for n in ('_users', '_replicator'))
+
+    def fail(self, count=1, code=None, drop=False):
+        """Make the next `count` requests fail (with `code` or by dropping the connection)"""
+        with self._lock:
+            for i in range(count):
+                self._failures.append('drop' if drop else (code or self.failure_code))
+
+    def _fault(self):
+        """Decide whether the current request should be sabotaged"""
+        with self._lock:
+            if self._failures:
+                return self._failures.popleft()
+        if self.drop_rate and random.random() < self.drop_rate:
+            return 'drop'
+        if self.failure_rate and random.random() < self.failure_rate:
+            return self.failure_code
+        return None
+
+    def _delay(self):
+        latency = self.latency
+        if isinstance(latency, (list, tuple)):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    #
+    # server-level api
+    #
+    def _db(self, name, create=False):
+        db = self._dbs.get(name)
+        if db is None:
+            raise CouchError(404, 'not_found', 'no_db_file')
+        return db
+
+    def create_db(self, name):
+        with self._lock:
+            if name in self._dbs:
+                raise CouchError(412, 'file_exists', 'The database could not be created, the file already exists.')
+            if not VALID_DB_NAME.match(name):
+                raise CouchError(400, 'illegal_database_name', 'Name: \'%s\'. Only lowercase characters (a-z), '
+                                 'digits (0-9), and any of the characters _, $, (, ), +, -, and / are allowed. '
+                                 'Must begin with a letter.' % name)
+            self._dbs[name] = _Database(name, self._lock)
+
+    def delete_db(self, name):
+        with self._lock:
+            db = self._db(name)
+            del self._dbs[name]
+            db.changed.notify_all()
+
+    def db_info(self, name):
+        db = self._db(name)
+        return dict(db_name=name, doc_count=db.doc_count,
+                    doc_del_count=sum(1 for d in db.docs.itervalues() if d.deleted),
+                    update_seq=db.seq, purge_seq=0, compact_running=False, disk_size=0,
+                    data_size=0, instance_start_time='%i' % (db.created*1e6),
+                    disk_format_version=6, committed_update_seq=db.seq)
+
+    def replicate(self, source, target, create_target=False, doc_ids=None, **options):
+        """One-shot replication between two dbs on this server"""
+        source, target = [unquote(urlsplit(url).path.strip('/')) for url in (source, target)]
+        with self._lock:
+            src = self._db(source)
+            if target not in self._dbs:
+                if not create_target:
+                    raise CouchError(404, 'not_found', 'Could not open target database')
+                self.create_db(target)
+            dst = self._dbs[target]
+            written = 0
+            for doc in sorted(src.docs.values(), key=lambda d: d.seq):
+                if doc_ids is not None and doc.id not in doc_ids:
+                    continue
+                mine = dst.docs.get(doc.id)
+                if mine is not None and (mine.rev == doc.rev or mine.pos > doc.pos):
+                    continue
+                copy = dst.docs.setdefault(doc.id, _Doc(doc.id))
+                copy.revs, copy.body, copy.deleted = list(doc.revs), dict(doc.body), doc.deleted
+                copy.attachments = odict((k, dict(v)) for k, v in doc.attachments.items())
+                self._bump(dst, copy)
+                written += 1
+            return dict(ok=True, session_id=uuid.uuid4().hex, source_last_seq=src.seq,
+                        history=[dict(docs_written=written, missing_found=written)])
+
+    #
+    # docs
+    #
+    def _bump(self, db, doc):
+        db.by_seq.pop(doc.seq, None)
+        db.seq += 1
+        doc.seq = db.seq
+        db.by_seq[doc.seq] = doc.id
+        db.changed.notify_all()
+
+    def render_doc(self, doc, attachments=False, revs=False, revs_info=False, local_seq=False, follows=False,
+                   conflicts=False):
+        out = odict([('_id', doc.id), ('_rev', doc.rev)])
+        out.update(doc.body)
+        if doc.deleted:
+            out['_deleted'] = True
+        if doc.attachments:
+            atts = odict()
+            for name, att in doc.attachments.items():
+                info = odict(content_type=att['content_type'], revpos=att['revpos'],
+                             digest=att['digest'], length=len(att['data']))
+                if follows:
+                    info['follows'] = True
+                elif attachments:
+                    info['data'] = b64encode(att['data'])
+                else:
+                    info['stub'] = True
+                atts[name] = info
+            out['_attachments'] = atts
+        if revs:
+            out['_revisions'] = dict(start=doc.pos, ids=[r.split('-', 1)[1] for r in doc.revs])
+        if revs_info:
+            out['_revs_info'] = [dict(rev=r, status='available' if i == 0 else 'missing')
+                                 for i, r in enumerate(doc.revs)]
+        if local_seq:
+            out['_local_seq'] = doc.seq
+        if conflicts and doc.conflicts:
+            out['_conflicts'] = list(doc.conflicts)
+        return out
+
+    def get_doc(self, db_name, doc_id, rev=None):
+        db = self._db(db_name)
+        if doc_id.startswith('_local/'):
+            body = db.local.get(doc_id)
+            if body is None:
+                raise CouchError(404, 'not_found', 'missing')
+            return body
+        doc = db.docs.get(doc_id)
+        if doc is None:
+            raise CouchError(404, 'not_found', 'missing')
+        if rev is not None:
+            doc = doc.revision(rev)
+            if doc is None:
+                raise CouchError(404, 'not_found', 'missing')
+        elif doc.deleted:
+            raise CouchError(404, 'not_found', 'deleted')
+        return doc
+
+    def update_doc(self, db_name, body, new_edits=True, follows=None, branch=False):
+        """Write a doc (as a dict) and return its (id, rev). Attachments flagged with
+        `follows` are pulled in order from the `follows` list of bytestrings. With
+        `branch`, an out-of-date _rev creates a conflict rather than being rejected."""
+        with self._lock:
+            db = self._db(db_name)
+            if not isinstance(body, dict):
+                raise CouchError(400, 'bad_request', 'Document must be a JSON object')
+            doc_id = body.get('_id') or uuid.uuid4().hex
+            if not isinstance(doc_id, basestring):
+                raise CouchError(400, 'bad_request', 'Document id must be a string')
+            for field in body:
+                if field.startswith('_') and field not in SPECIAL_DOC_FIELDS:
+                    raise CouchError(400, 'doc_validation', 'Bad special document member: %s' % field)
+
+            if doc_id.startswith('_local/'):
+                current = db.local.get(doc_id)
+                if current is not None and body.get('_rev') != current['_rev']:
+                    raise CouchError(409, 'conflict', 'Document update conflict.')
+                pos = int(current['_rev'].split('-')[1]) + 1 if current else 1
+                rev = '0-%i' % pos
+                if body.get('_deleted'):
+                    db.local.pop(doc_id, None)
+                else:
+                    stored = dict(body)
+                    stored.update(_id=doc_id, _rev=rev)
+                    db.local[doc_id] = stored
+                return doc_id, rev
+            if doc_id.startswith('_') and not doc_id.startswith('_design/'):
+                raise CouchError(400, 'bad_request', 'Only reserved document ids may start with underscore.')
+
+            doc = db.docs.get(doc_id)
+            rev = body.get('_rev')
+            conflicted = branch and doc is not None and rev != doc.rev
+            if conflicted:
+                pass
+            elif new_edits:
+                if doc is None or (doc.deleted and rev is None):
+                    if rev is not None and doc is None:
+                        raise CouchError(409, 'conflict', 'Document update conflict.')
+                elif rev != doc.rev:
+                    raise CouchError(409, 'conflict', 'Document update conflict.')
+            elif rev is None:
+                raise CouchError(400, 'bad_request', 'new_edits=false requires a _rev')
+
+            fields = dict((k, v) for k, v in body.items() if not k.startswith('_'))
+            attachments = odict()
+            pos = (doc.pos if doc is not None else 0) + 1
+            if conflicted:
+                pos = int(rev.split('-')[0]) + 1 if rev else 1
+            follows = list(follows or [])
+            for name, info in (body.get('_attachments') or {}).items():
+                if info.get('stub'):
+                    if doc is None or name not in doc.attachments:
+                        raise CouchError(412, 'missing_stub', 'Invalid attachment stub in %s for %s' % (doc_id, name))
+                    attachments[name] = doc.attachments[name]
+                    continue
+                if info.get('follows'):
+                    if not follows:
+                        raise CouchError(400, 'bad_request', 'attachment %s was not included' % name)
+                    data = follows.pop(0)
+                else:
+                    try:
+                        data = b64decode(info.get('data') or '')
+                    except TypeError:
+                        raise CouchError(400, 'bad_request', 'Invalid attachment data for %s' % name)
+                attachments[name] = dict(content_type=info.get('content_type') or 'application/octet-stream',
+                                         data=data, revpos=pos,
+                                         digest='md5-%s' % b64encode(md5(data).digest()))
+
+            if doc is None:
+                doc = db.docs[doc_id] = _Doc(doc_id)
+            if conflicted:
+                parent = doc.revision(rev) if rev else None
+                digest = md5(json.dumps([rev, fields, body.get('_deleted', False)], sort_keys=True)).hexdigest()
+                new_rev = '%i-%s' % (pos, digest)
+                revs = [new_rev] + (parent.revs if parent is not None else [])
+                if (pos, new_rev) < (doc.pos, doc.rev):
+                    # the existing revision stays the winner
+                    doc.history[new_rev] = (revs, fields, bool(body.get('_deleted')), attachments)
+                    doc.conflicts.append(new_rev)
+                    self._bump(db, doc)
+                    return doc_id, new_rev
+                doc.conflicts.append(doc.rev)
+                doc.archive()
+                doc.revs, rev = revs, new_rev
+            elif new_edits:
+                digest = md5(json.dumps([doc.rev, fields, body.get('_deleted', False)], sort_keys=True)).hexdigest()
+                rev = '%i-%s' % (pos, digest)
+                doc.archive()
+                doc.revs = [rev] + doc.revs[:db.revs_limit-1]
+            elif rev not in doc.revs:
+                doc.archive()
+                history = body.get('_revisions')
+                if history:
+                    doc.revs = ['%i-%s' % (history['start']-i, h) for i, h in enumerate(history['ids'])]
+                else:
+                    doc.revs = [rev]
+            else:
+                return doc_id, rev
+            doc.body = fields
+            doc.deleted = bool(body.get('_deleted'))
+            doc.attachments = attachments
+            self._bump(db, doc)
+            return doc_id, rev
+
+    def put_attachment(self, db_name, doc_id, name, data, content_type, rev=None):
+        with self._lock:
+            db = self._db(db_name)
+            doc = db.docs.get(doc_id)
+            if doc is not None and not doc.deleted:
+                body = self.render_doc(doc)
+            else:
+                body = {'_id':doc_id}
+                if doc is not None:
+                    body['_rev'] = doc.rev
+            if rev is not None:
+                body['_rev'] = rev
+            if doc is not None and doc.deleted and rev is None:
+                body.pop('_rev', None)
+            body.setdefault('_attachments', {})[name] = dict(content_type=content_type, follows=True)
+            return self.update_doc(db_name, body, follows=[data])
+
+    def delete_attachment(self, db_name, doc_id, name, rev=None):
+        with self._lock:
+            doc = self.get_doc(db_name, doc_id)
+            if name not in doc.attachments:
+                raise CouchError(404, 'not_found', 'Document is missing attachment')
+            body = self.render_doc(doc)
+            body['_rev'] = rev
+            del body['_attachments'][name]
+            return self.update_doc(db_name, body)
+
+    def bulk_docs(self, db_name, docs, all_or_nothing=False, new_edits=True):
+        with self._lock:
+            self._db(db_name)
+            if all_or_nothing:
+                # no conflict checking at all: out-of-date revs just create conflicts
+                results = []
+                for body in docs:
+                    doc_id, rev = self.update_doc(db_name, body, new_edits=new_edits, branch=new_edits)
+                    results.append(dict(id=doc_id, rev=rev))
+                return results
+            results = []
+            for body in docs:
+                try:
+                    doc_id, rev = self.update_doc(db_name, body, new_edits=new_edits)
+                    if new_edits:
+                        results.append(dict(id=doc_id, rev=rev))
+                except CouchError, e:
+                    results.append(dict(id=body.get('_id'), error=e.error, reason=e.reason))
+            return results
+
+    def compact(self, db_name):
+        """Discard the bodies of all but the leaf revisions"""
+        with self._lock:
+            for doc in self._db(db_name).docs.itervalues():
+                doc.history = dict((r, doc.history[r]) for r in doc.conflicts if r in doc.history)
+
+    def purge(self, db_name, revs):
+        with self._lock:
+            db = self._db(db_name)
+            purged = {}
+            for doc_id, doc_revs in revs.items():
+                doc = db.docs.get(doc_id)
+                if doc is not None and doc.rev in doc_revs:
+                    del db.docs[doc_id]
+                    db.by_seq.pop(doc.seq, None)
+                    purged[doc_id] = [doc.rev]
+            db.seq += 1
+            return dict(purge_seq=1, purged=purged)
+
+    #
+    # views
+    #
+    def _ddoc(self, db, ddoc_name):
+        ddoc = db.docs.get('_design/%s' % ddoc_name)
+        if ddoc is None or ddoc.deleted:
+            raise CouchError(404, 'not_found', 'missing')
+        return ddoc
+
+    def _functions(self, ddoc, kind, name):
+        funcs = ddoc.body.get(kind) or {}
+        if name not in funcs:
+            raise CouchError(404, 'not_found', 'missing_named_view' if kind=='views' else 'missing %s function %s' % (kind, name))
+        return funcs[name]
+
+    def _map(self, db, mapfn, source=None):
+        """Run a map function over every doc, returning sorted (key, id, value) rows"""
+        rows = []
+        for doc in db.docs.values():
+            if doc.deleted or (source is None and doc.id.startswith('_design/')):
+                continue
+            rendered = self.render_doc(doc)
+            try:
+                emitted = run_map(mapfn, json.loads(json.dumps(rendered)))
+            except Exception:
+                continue # like couch, skip docs that make the map function throw
+            rows.extend((k, doc.id, v) for k, v in emitted)
+        rows.sort(key=lambda r: (collate(r[0]), r[1]))
+        return rows
+
+    def view_rows(self, db_name, ddoc_name, view_name):
+        """Return the view's (sorted) rows, along with its reduce function (if any)"""
+        with self._lock:
+            db = self._db(db_name)
+            ddoc = self._ddoc(db, ddoc_name)
+            view = self._functions(ddoc, 'views', view_name)
+            key = (ddoc.id, view_name)
+            cached = db.indexes.get(key)
+            if cached is None or cached[0] != (db.seq, ddoc.rev):
+                rows = self._map(db, compile_function(view['map']))
+                db.indexes[key] = cached = ((db.seq, ddoc.rev), rows)
+            return cached[1], view.get('reduce'), '"%s"' % md5('%s/%s' % cached[0]).hexdigest()
+
+    def temp_view_rows(self, db_name, spec):
+        with self._lock:
+            db = self._db(db_name)
+            return self._map(db, compile_function(spec['map'])), spec.get('reduce')
+
+    def query(self, db_name, rows, reduce_src=None, params=None, keys=None, all_docs=False):
+        """Apply the standard view query options to a list of (key, id, value) rows"""
+        params = params or {}
+        if keys is None:
+            keys = params.get('keys')
+        reduce = reduce_src is not None and params.get('reduce', True)
+        include_docs = params.get('include_docs', False)
+        if reduce and include_docs:
+            raise CouchError(400, 'query_parse_error', 'include_docs is invalid for reduce')
+        descending = params.get('descending', False)
+        ordered = rows[::-1] if descending else rows
+
+        if keys is not None:
+            selected = []
+            if all_docs:
+                db = self._db(db_name)
+                for k in keys:
+                    doc = db.docs.get(k)
+                    if doc is None:
+                        selected.append(dict(key=k, error='not_found'))
+                    elif doc.deleted:
+                        selected.append(dict(id=k, key=k, value=dict(rev=doc.rev, deleted=True)))
+                    else:
+                        selected.append((k, k, dict(rev=doc.rev)))
+            else:
+                by_key = {}
+                for row in ordered:
+                    by_key.setdefault(json.dumps(row[0], sort_keys=True), []).append(row)
+                for k in keys:
+                    selected.extend(by_key.get(json.dumps(k, sort_keys=True), []))
+            offset = 0
+        else:
+            selected, offset = self._range(ordered, params, descending)
+
+        if reduce:
+            return self._reduce(selected, reduce_src, params)
+
+        skip, limit = params.get('skip', 0), params.get('limit')
+        offset += skip
+        selected = selected[skip:]
+        if limit is not None:
+            selected = selected[:limit]
+
+        db = self._db(db_name)
+        out_rows = []
+        for row in selected:
+            if isinstance(row, dict):
+                if include_docs and 'id' in row:
+                    row['doc'] = None
+                out_rows.append(row)
+                continue
+            key, doc_id, value = row
+            out = odict([('id', doc_id), ('key', key), ('value', value)])
+            if include_docs:
+                target = doc_id
+                if isinstance(value, dict) and '_id' in value and not all_docs:
+                    target = value['_id'] # linked docs
+                doc = db.docs.get(target)
+                out['doc'] = self.render_doc(doc) if doc is not None and not doc.deleted else None
+            out_rows.append(out)
+        result = odict([('total_rows', len(rows)), ('offset', offset), ('rows', out_rows)])
+        if params.get('update_seq'):
+            result['update_seq'] = db.seq
+        return result
+
+    def _range(self, rows, params, descending):
+        startkey = params.get('startkey', params.get('start_key', _MISSING))
+        endkey = params.get('endkey', params.get('end_key', _MISSING))
+        if 'key' in params:
+            startkey = endkey = params['key']
+        start_id, end_id = params.get('startkey_docid'), params.get('endkey_docid')
+        inclusive = params.get('inclusive_end', True)
+        before = (lambda a, b: a > b) if descending else (lambda a, b: a < b)
+
+        selected, offset = [], 0
+        start = collate(startkey) if startkey is not _MISSING else None
+        end = collate(endkey) if endkey is not _MISSING else None
+        for row in rows:
+            ck = collate(row[0])
+            if start is not None and (before(ck, start) or (ck == start and start_id and before(row[1], start_id))):
+                offset += 1
+                continue
+            if end is not None:
+                if before(end, ck) or (ck == end and end_id and before(end_id, row[1])):
+                    break
+                if not inclusive and ck == end and (not end_id or row[1] == end_id):
+                    break
+            selected.append(row)
+        return selected, offset
+
+    def _reduce(self, rows, reduce_src, params):
+        if reduce_src.startswith('_'):
+            reducer = lambda keys, values, rereduce: builtin_reduce(reduce_src, keys, values, rereduce)
+        else:
+            reducer = compile_function(reduce_src)
+        group_level = params.get('group_level')
+        if params.get('group') and group_level is None:
+            group_level = 'exact'
+        groups = odict()
+        for row in rows:
+            key, doc_id, value = row
+            if group_level is None:
+                gk = None
+            elif group_level == 'exact' or not isinstance(key, list):
+                gk = key
+            else:
+                gk = key[:group_level]
+            groups.setdefault(json.dumps(gk, sort_keys=True), (gk, []))[1].append(row)
+        out = []
+        for gk, members in groups.values():
+            value = reducer([[r[0], r[1]] for r in members], [r[2] for r in members], False)
+            out.append(odict([('key', gk), ('value', value)]))
+        if not rows and group_level is None:
+            out = []
+        limit = params.get('limit')
+        if limit is not None:
+            out = out[params.get('skip', 0):params.get('skip', 0)+limit]
+        return dict(rows=out)
+
+    def all_docs_rows(self, db_name):
+        with self._lock:
+            db = self._db(db_name)
+            rows = [(d.id, d.id, dict(rev=d.rev)) for d in db.docs.values() if not d.deleted]
+            rows.sort(key=lambda r: collate(r[0]))
+            return rows, '"%s"' % md5('all_docs/%s/%i' % (db_name, db.seq)).hexdigest()
+
+    #
+    # changes
+    #
+    def changes(self, db_name, since=0, limit=None, descending=False, include_docs=False,
+                filter=None, params=None, doc_ids=None):
+        """Return the changes after `since` as a list of result dicts"""
+        with self._lock:
+            db = self._db(db_name)
+            predicate = self._change_filter(db, filter, params or {}, doc_ids)
+            results = []
+            for seq in sorted(db.by_seq, reverse=descending):
+                if not descending and seq <= since:
+                    continue
+                doc = db.docs[db.by_seq[seq]]
+                if predicate and not predicate(doc):
+                    continue
+                change = odict([('seq', seq), ('id', doc.id), ('changes', [dict(rev=doc.rev)])])
+                if doc.deleted:
+                    change['deleted'] = True
+                if include_docs:
+                    change['doc'] = self.render_doc(doc)
+                results.append(change)
+                if limit is not None and len(results) >= limit:
+                    break
+            return results
+
+    def _change_filter(self, db, name, params, doc_ids):
+        if not name:
+            return None
+        if name == '_doc_ids':
+            ids = set(doc_ids or [])
+            return lambda doc: doc.id in ids
+        if name == '_design':
+            return lambda doc: doc.id.startswith('_design/')
+        ddoc_name, _, filter_name = name.partition('/')
+        ddoc = self._ddoc(db, ddoc_name)
+        func = compile_function(self._functions(ddoc, 'filters', filter_name))
+        req = dict(query=params)
+        return lambda doc: func(json.loads(json.dumps(self.render_doc(doc))), req)
+
+    def wait_for_change(self, db_name, since, timeout):
+        """Block until the db's update_seq passes `since` (or the timeout elapses)"""
+        deadline = time.time() + timeout
+        with self._lock:
+            db = self._db(db_name)
+            while db.seq <= since and not self.stopping and self._dbs.get(db_name) is db:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                db.changed.wait(min(remaining, 0.25))
+
+    #
+    # design doc functions
+    #
+    def update_handler(self, db_name, ddoc_name, func_name, doc_id, req):
+        with self._lock:
+            db = self._db(db_name)
+            ddoc = self._ddoc(db, ddoc_name)
+            func = compile_function(self._functions(ddoc, 'updates', func_name))
+            doc = None
+            if doc_id is not None:
+                current = db.docs.get(doc_id)
+                if current is not None and not current.deleted:
+                    doc = json.loads(json.dumps(self.render_doc(current)))
+            new_doc, response = func(doc, req)
+            headers = {}
+            if new_doc is not None:
+                doc_id, rev = self.update_doc(db_name, new_doc)
+                headers['X-Couch-Update-NewRev'] = rev
+                headers['X-Couch-Id'] = doc_id
+            return new_doc is not None, response, headers
+
+
+_MISSING = object()
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self._handlers = set()
+        self._handlers_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        # keep track of the request threads so `finish` can wait for them
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self._handlers_lock:
+            self._handlers.add(thread)
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._handlers_lock:
+                self._handlers.discard(threading.current_thread())
+
+    def finish(self, timeout):
+        """Wait for the requests in progress to be answered"""
+        deadline = time.time() + timeout
+        with self._handlers_lock:
+            handlers = list(self._handlers)
+        for thread in handlers:
+            thread.join(max(deadline - time.time(), 0))
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on continuous feeds (or injected drops) aren't worth a
+        # traceback, nor are connections cut off by the server being stopped
+        if self.fake.stopping or isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+# servers that are still running at exit get shut down before their threads can trip
+# over the interpreter's teardown
+_running = weakref.WeakSet()
+
+@atexit.register
+def _stop_all():
+    for fake in list(_running):
+        fake.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CouchDB/1.2.0 (fake)'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self): self.dispatch()
+    def do_HEAD(self): self.dispatch()
+    def do_PUT(self): self.dispatch()
+    def do_POST(self): self.dispatch()
+    def do_DELETE(self): self.dispatch()
+    def do_COPY(self): self.dispatch()
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def dispatch(self):
+        fake = self.fake
+        with fake._lock:
+            fake.stats.requests += 1
+        raw_path, _, query = self.path.partition('?')
+        self.segments = [unquote(s) for s in raw_path.split('/') if s]
+        self.params = self._params(query)
+        self.body = self._read_body()
+        fake.log.append((self.command, raw_path))
+
+        fault = fake._fault()
+        if fault == 'drop':
+            fake.stats.drops += 1
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        fake._delay()
+        try:
+            if fault is not None:
+                fake.stats.failures += 1
+                raise CouchError(fault, 'unknown_error', 'injected failure')
+            result = self.route()
+            if result is not None:
+                self.send_json(*result)
+        except CouchError, e:
+            self.send_json(e.code, dict(error=e.error, reason=e.reason))
+        except socket.error:
+            self.close_connection = 1
+        except Exception, e:
+            self.send_json(500, dict(error='unknown_error', reason='%s: %s' % (type(e).__name__, e)))
+
+    def _params(self, query):
+        params = {}
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name in JSON_PARAMS:
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    raise CouchError(400, 'query_parse_error', 'Invalid value for %s: %s' % (name, value))
+            params[name] = value
+        return params
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip() or '0', 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(length) if length else ''
+        self.throttle(len(body))
+        with self.fake._lock:
+            self.fake.stats.bytes_in += len(body)
+        if body and self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                pass # leave it to fail as invalid json
+        return body
+
+    def json_body(self):
+        try:
+            return json.loads(self.body or 'null')
+        except ValueError:
+            raise CouchError(400, 'bad_request', 'invalid UTF-8 JSON')
+
+    #
+    # responses
+    #
+    def send_json(self, code, obj, headers=None):
+        if isinstance(obj, dict) and isinstance(obj.get('rows'), list):
+            # like couchdb, put each row of a view on a line of its own
+            head = json.dumps(odict((k, v) for k, v in obj.items() if k != 'rows'))
+            head = head[:-1] + (', ' if len(head) > 2 else '') + '"rows": ['
+            body = head + '\r\n' + ',\r\n'.join(json.dumps(row) for row in obj['rows']) + '\r\n]}\n'
+        else:
+            body = json.dumps(obj)
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json' if 'json' in self.headers.get('Accept', 'json') \
+                                  else 'text/plain;charset=utf-8'
+        self.send_body(code, body, headers)
+
+    def send_body(self, code, body, headers):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Cache-Control', 'must-revalidate')
+        if code == 304:
+            self.end_headers()
+            return
+        if self.fake.gzip and 'gzip' in self.headers.get('Accept-Encoding', '') and \
+           headers.get('Content-Type', '').startswith(('application/json', 'text/plain')):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write_throttled(body)
+
+    def throttle(self, nbytes):
+        # wait out the time it'd have taken for a request body to arrive over the link
+        if self.fake.bandwidth and nbytes:
+            time.sleep(nbytes / float(self.fake.bandwidth))
+
+    def write_throttled(self, data):
+        with self.fake._lock:
+            self.fake.stats.bytes_out += len(data)
+        bandwidth = self.fake.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        step = max(int(bandwidth / 20), 1024)
+        for i in xrange(0, len(data), step):
+            chunk = data[i:i+step]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / float(bandwidth))
+
+    def send_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    #
+    # routing
+    #
+    def route(self):
+        seg, method = self.segments, self.command
+        fake = self.fake
+        if not seg:
+            return 200, dict(couchdb='Welcome', version='1.2.0', vendor=dict(name='corduroy', version=VERSION))
+        top = seg[0]
+        if top == '_all_dbs':
+            return 200, sorted(fake._dbs.keys())
+        if top == '_uuids':
+            return 200, dict(uuids=[uuid.uuid4().hex for i in range(int(self.params.get('count', 1)))])
+        if top == '_active_tasks':
+            return 200, []
+        if top == '_stats':
+            return 200, dict(httpd=dict(requests=dict(current=fake.stats.requests)))
+        if top == '_session':
+            return 200, dict(ok=True, userCtx=dict(name=None, roles=['_admin']))
+        if top == '_config':
+            return self.config(seg[1:])
+        if top == '_replicate':
+            spec = self.json_body()
+            if spec.get('continuous') or spec.get('cancel'):
+                raise CouchError(501, 'not_implemented', 'only one-shot replication is supported')
+            return 200, fake.replicate(**dict((str(k), v) for k, v in spec.items()))
+        if top.startswith('_') and top not in fake._dbs:
+            raise CouchError(400, 'illegal_database_name', 'Only lowercase characters (a-z), digits (0-9), '
+                             'and any of the characters _, $, (, ), +, -, and / are allowed.')
+        if len(seg) == 1:
+            return self.database(top)
+
+        db, sub = top, seg[1]
+        if sub == '_design':
+            if len(seg) < 3:
+                raise CouchError(404, 'not_found', 'missing')
+            if len(seg) == 3:
+                return self.document(db, '_design/%s' % seg[2])
+            if seg[3] == '_info':
+                fake._ddoc(fake._db(db), seg[2])
+                return 200, dict(name=seg[2], view_index=dict(compact_running=False, updater_running=False,
+                                 language='python', purge_seq=0, waiting_commit=False, waiting_clients=0,
+                                 signature=md5(seg[2]).hexdigest(), update_seq=fake._db(db).seq, disk_size=0))
+            if seg[3] == '_view' and len(seg) == 5:
+                return self.view(db, seg[2], seg[4])
+            if seg[3] == '_update' and len(seg) >= 5:
+                return self.update(db, seg[2], seg[4], '/'.join(seg[5:]) or None)
+            if seg[3] in ('_show', '_list', '_rewrite'):
+                raise CouchError(501, 'not_implemented', 'the fake server doesn\'t run %s functions' % seg[3])
+            return self.attachment(db, '_design/%s' % seg[2], '/'.join(seg[3:]))
+        if sub == '_local':
+            return self.document(db, '_local/%s' % '/'.join(seg[2:]))
+        if sub == '_all_docs':
+            return self.all_docs(db)
+        if sub == '_bulk_docs':
+            body = self.json_body() or {}
+            results = fake.bulk_docs(db, body.get('docs', []), all_or_nothing=body.get('all_or_nothing', False),
+                                     new_edits=body.get('new_edits', True))
+            return 201, results
+        if sub == '_changes':
+            return self.changes(db)
+        if sub == '_temp_view':
+            spec = self.json_body() or {}
+            rows, reduce_src = fake.temp_view_rows(db, spec)
+            return 200, fake.query(db, rows, reduce_src, self.params, keys=spec.get('keys'))
+        if sub in ('_compact', '_view_cleanup'):
+            fake.compact(db)
+            return 202, dict(ok=True)
+        if sub == '_ensure_full_commit':
+            fake._db(db)
+            return 201, dict(ok=True, instance_start_time='%i' % (fake._db(db).created*1e6))
+        if sub == '_security':
+            target = fake._db(db)
+            if method == 'PUT':
+                target.security = self.json_body()
+                return 200, dict(ok=True)
+            return 200, target.security
+        if sub == '_revs_limit':
+            target = fake._db(db)
+            if method == 'PUT':
+                target.revs_limit = int(self.json_body())
+                return 200, dict(ok=True)
+            return 200, target.revs_limit
+        if sub == '_purge':
+            return 200, fake.purge(db, self.json_body() or {})
+        if sub.startswith('_'):
+            raise CouchError(400, 'bad_request', 'Only reserved document ids may start with underscore.')
+        if len(seg) == 2:
+            return self.document(db, sub)
+        return self.attachment(db, sub, '/'.join(seg[2:]))
+
+    def config(self, path):
+        conf = self.fake.config
+        if not path:
+            return 200, conf
+        section = conf.setdefault(path[0], {}) if self.command == 'PUT' else conf.get(path[0])
+        if section is None:
+            raise CouchError(404, 'not_found', 'unknown_config_value')
+        if len(path) == 1:
+            return 200, section
+        old = section.get(path[1])
+        if self.command == 'PUT':
+            section[path[1]] = self.json_body()
+            return 200, old or ''
+        if old is None:
+            raise CouchError(404, 'not_found', 'unknown_config_value')
+        if self.command == 'DELETE':
+            del section[path[1]]
+        return 200, old
+
+    def database(self, name):
+        fake, method = self.fake, self.command
+        if method == 'PUT':
+            fake.create_db(name)
+            return 201, dict(ok=True), {'Location':'/%s' % name}
+        if method == 'DELETE':
+            fake.delete_db(name)
+            return 200, dict(ok=True)
+        if method == 'POST':
+            body = self.json_body()
+            doc_id, rev = fake.update_doc(name, body)
+            if self.params.get('batch') == 'ok':
+                return 202, dict(ok=True, id=doc_id)
+            return 201, dict(ok=True, id=doc_id, rev=rev)
+        return 200, fake.db_info(name)
+
+    def document(self, db, doc_id):
+        fake, method, params = self.fake, self.command, self.params
+        if method in ('GET', 'HEAD'):
+            if 'open_revs' in params:
+                return self.open_revs(db, doc_id, params['open_revs'])
+            doc = fake.get_doc(db, doc_id, params.get('rev'))
+            if isinstance(doc, dict): # a _local doc
+                return 200, doc
+            etag = '"%s"' % doc.rev
+            if self.headers.get('If-None-Match') == etag:
+                return 304, {}, {'ETag':etag}
+            multipart = 'multipart/related' in self.headers.get('Accept', '') and params.get('attachments') \
+                        and doc.attachments
+            body = fake.render_doc(doc, attachments=params.get('attachments', False), revs=params.get('revs', False),
+                                   revs_info=params.get('revs_info', False), local_seq=params.get('local_seq', False),
+                                   follows=bool(multipart), conflicts=params.get('conflicts', False))
+            if multipart:
+                return self.send_multipart(body, doc, etag)
+            return 200, body, {'ETag':etag}
+        if method == 'PUT':
+            content_type = self.headers.get('Content-Type', '')
+            follows = None
+            if content_type.startswith('multipart/related'):
+                body, follows = self.parse_multipart(content_type)
+            else:
+                body = self.json_body()
+            if not isinstance(body, dict):
+                raise CouchError(400, 'bad_request', 'Document must be a JSON object')
+            body['_id'] = doc_id
+            if 'rev' in params:
+                body['_rev'] = params['rev']
+            new_edits = params.get('new_edits', 'true') != 'false'
+            doc_id, rev = fake.update_doc(db, body, new_edits=new_edits, follows=follows)
+            if params.get('batch') == 'ok':
+                return 202, dict(ok=True, id=doc_id)
+            return 201, dict(ok=True, id=doc_id, rev=rev), {'ETag':'"%s"' % rev}
+        if method == 'DELETE':
+            rev = params.get('rev') or self.headers.get('If-Match', '').strip('"') or None
+            if doc_id.startswith('_local/'):
+                doc_id, rev = fake.update_doc(db, dict(_id=doc_id, _rev=rev, _deleted=True))
+                return 200, dict(ok=True, id=doc_id, rev=rev)
+            current = fake.get_doc(db, doc_id)
+            doc_id, rev = fake.update_doc(db, dict(_id=doc_id, _rev=rev, _deleted=True))
+            return 200, dict(ok=True, id=doc_id, rev=rev)
+        if method == 'COPY':
+            source = fake.get_doc(db, doc_id, params.get('rev'))
+            dest = self.headers.get('Destination', '')
+            dest_id, _, dest_query = dest.partition('?')
+            dest_rev = dict(parse_qsl(dest_query)).get('rev')
+            body = fake.render_doc(source, attachments=True)
+            body['_id'] = unquote(dest_id)
+            if dest_rev:
+                body['_rev'] = dest_rev
+            else:
+                body.pop('_rev', None)
+            new_id, rev = fake.update_doc(db, body)
+            return 201, dict(id=new_id, rev=rev)
+        raise CouchError(405, 'method_not_allowed', 'Only GET,HEAD,PUT,DELETE,COPY allowed')
+
+    def open_revs(self, db, doc_id, revs):
+        doc = self.fake._db(db).docs.get(doc_id)
+        if doc is None:
+            raise CouchError(404, 'not_found', 'missing')
+        if revs == 'all':
+            revs = [doc.rev] + doc.conflicts
+        else:
+            try:
+                revs = json.loads(revs)
+            except ValueError:
+                raise CouchError(400, 'bad_request', 'invalid open_revs')
+        found = []
+        for rev in revs:
+            leaf = doc.revision(rev)
+            if leaf is None:
+                found.append(dict(missing=rev))
+            else:
+                found.append(dict(ok=self.fake.render_doc(leaf, attachments=self.params.get('attachments', False))))
+        return 200, found
+
+    def attachment(self, db, doc_id, name):
+        fake, method, params = self.fake, self.command, self.params
+        if method in ('GET', 'HEAD'):
+            doc = fake.get_doc(db, doc_id, params.get('rev'))
+            att = doc.attachments.get(name)
+            if att is None:
+                raise CouchError(404, 'not_found', 'Document is missing attachment')
+            etag = '"%s"' % att['digest'][4:]
+            if self.headers.get('If-None-Match') == etag:
+                return 304, {}, {'ETag':etag}
+            self.send_body(200, att['data'], {'Content-Type':att['content_type'], 'ETag':etag,
+                                              'Content-MD5':att['digest'][4:]})
+            return None
+        if method == 'PUT':
+            content_type = self.headers.get('Content-Type') or 'application/octet-stream'
+            doc_id, rev = fake.put_attachment(db, doc_id, name, self.body, content_type, params.get('rev'))
+            return 201, dict(ok=True, id=doc_id, rev=rev)
+        if method == 'DELETE':
+            doc_id, rev = fake.delete_attachment(db, doc_id, name, params.get('rev'))
+            return 200, dict(ok=True, id=doc_id, rev=rev)
+        raise CouchError(405, 'method_not_allowed', 'Only GET,HEAD,PUT,DELETE allowed')
+
+    def parse_multipart(self, content_type):
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            raise CouchError(400, 'bad_request', 'missing multipart boundary')
+        delim = '--%s' % match.group(1)
+        parts = []
+        for chunk in self.body.split(delim)[1:]:
+            if chunk.startswith('--'):
+                break
+            chunk = chunk[2:] if chunk.startswith('\r\n') else chunk
+            headers, _, data = chunk.partition('\r\n\r\n') if not chunk.startswith('\r\n') else ('', '', chunk[2:])
+            parts.append(data[:-2] if data.endswith('\r\n') else data)
+        if not parts:
+            raise CouchError(400, 'bad_request', 'empty multipart body')
+        try:
+            body = json.loads(parts[0])
+        except ValueError:
+            raise CouchError(400, 'bad_request', 'invalid UTF-8 JSON')
+        return body, parts[1:]
+
+    def send_multipart(self, body, doc, etag):
+        boundary = uuid.uuid4().hex
+        chunks = ['--%s\r\nContent-Type: application/json\r\n\r\n' % boundary, json.dumps(body)]
+        for name, att in doc.attachments.items():
+            chunks.append('\r\n--%s\r\nContent-Disposition: attachment; filename="%s"\r\n'
+                          'Content-Type: %s\r\nContent-Length: %i\r\n\r\n' % (boundary, name.encode('utf-8'),
+                          att['content_type'], len(att['data'])))
+            chunks.append(att['data'])
+        chunks.append('\r\n--%s--' % boundary)
+        self.send_body(200, ''.join(chunks), {'Content-Type':'multipart/related; boundary="%s"' % boundary,
+                                              'ETag':etag})
+        return None
+
+    def keys_param(self):
+        if self.command == 'POST':
+            body = self.json_body() or {}
+            return body.get('keys')
+        return self.params.get('keys')
+
+    def all_docs(self, db):
+        fake = self.fake
+        rows, etag = fake.all_docs_rows(db)
+        keys = self.keys_param()
+        if keys is not None:
+            etag = '"%s"' % md5(etag + json.dumps(keys)).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return 304, {}, {'ETag':etag}
+        return 200, fake.query(db, rows, None, self.params, keys=keys, all_docs=True), {'ETag':etag}
+
+    def view(self, db, ddoc, name):
+        fake = self.fake
+        rows, reduce_src, etag = fake.view_rows(db, ddoc, name)
+        keys = self.keys_param()
+        etag = '"%s"' % md5(etag + json.dumps(self.params, sort_keys=True) + json.dumps(keys)).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return 304, {}, {'ETag':etag}
+        return 200, fake.query(db, rows, reduce_src, self.params, keys=keys), {'ETag':etag}
+
+    def update(self, db, ddoc, func, doc_id):
+        fake = self.fake
+        form = {}
+        if 'application/x-www-form-urlencoded' in self.headers.get('Content-Type', ''):
+            form = dict(parse_qsl(self.body))
+        req = dict(method=self.command, query=self.params, form=form, body=self.body, id=doc_id,
+                   headers=dict(self.headers.items()))
+        saved, response, headers = fake.update_handler(db, ddoc, func, doc_id, req)
+        if isinstance(response, dict):
+            if 'json' in response:
+                headers['Content-Type'] = 'application/json'
+                body = json.dumps(response['json'])
+            else:
+                body = response.get('body', '')
+            headers.update(response.get('headers', {}))
+            code = response.get('code', 201 if saved else 200)
+        else:
+            body, code = response or '', 201 if saved else 200
+        headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_body(code, body, headers)
+        return None
+
+    def changes(self, db):
+        fake, params = self.fake, self.params
+        if self.command == 'POST':
+            params = dict(params, **dict((str(k), v) for k, v in (self.json_body() or {}).items()))
+        since = params.get('since', 0)
+        since = fake._db(db).seq if since == 'now' else int(since)
+        feed = params.get('feed', 'normal')
+        options = dict(limit=params.get('limit'), descending=params.get('descending', False),
+                       include_docs=params.get('include_docs', False), filter=params.get('filter'),
+                       params=params, doc_ids=params.get('doc_ids'))
+
+        if feed == 'continuous':
+            return self.continuous_changes(db, since, params, options)
+
+        results = fake.changes(db, since, **options)
+        if feed == 'longpoll' and not results:
+            fake.wait_for_change(db, since, params.get('timeout', 60000) / 1000.0)
+            results = fake.changes(db, since, **options)
+        last_seq = results[-1]['seq'] if results else (since if feed == 'longpoll' else fake._db(db).seq)
+        return 200, dict(results=results, last_seq=last_seq)
+
+    def continuous_changes(self, db, since, params, options):
+        fake = self.fake
+        fake._db(db) # 404 before committing to a streamed response
+        heartbeat = params.get('heartbeat')
+        timeout = params.get('timeout', None if heartbeat else 60000)
+        deadline = time.time() + timeout / 1000.0 if timeout else None
+        interval = heartbeat / 1000.0 if heartbeat else 1.0
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if 'json' in self.headers.get('Accept', 'json')
+                                         else 'text/plain;charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.close_connection = 1
+
+        sent, limit, finished = 0, options.get('limit'), False
+        while not fake.stopping:
+            try:
+                results = fake.changes(db, since, **options)
+            except CouchError:
+                break # the db was deleted (so just hang up)
+            for change in results:
+                self.send_chunk(json.dumps(change) + '\n')
+                since = change['seq']
+                sent += 1
+            if limit is not None and sent >= limit or deadline is not None and time.time() >= deadline:
+                finished = True
+                break
+            waited = time.time()
+            wait = interval if deadline is None else min(interval, deadline - waited)
+            fake.wait_for_change(db, since, max(wait, 0))
+            if heartbeat and time.time() - waited >= interval:
+                self.send_chunk('\n')
+        if finished:
+            self.send_chunk(json.dumps(dict(last_seq=since)) + '\n')
+        self.wfile.write('0\r\n\r\n')
+        return None
+
+
+def main(argv=None):
+    """Run a fake server in the foreground: python -m corduroy.fakecouch [options] [port]"""
+    from optparse import OptionParser
+    parser = OptionParser(usage='python -m corduroy.fakecouch [options] [port]')
+    parser.add_option('-l', '--latency', type='float', default=0, help='seconds to delay each response')
+    parser.add_option('-b', '--bandwidth', type='int', help='max bytes/sec for request and response bodies')
+    parser.add_option('-z', '--gzip', action='store_true', help='compress responses when asked to')
+    parser.add_option('-f', '--failure-rate', type='float', default=0, help='fraction of requests to fail')
+    opts, args = parser.parse_args(argv)
+    port = int(args[0]) if args else 5984
+    couch = FakeCouch(port=port, latency=opts.latency, bandwidth=opts.bandwidth,
+                      failure_rate=opts.failure_rate, gzip=opts.gzip).start()
+    print "fake couch listening at %s (^C to quit)" % couch.url
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        couch.stop()
+
+if __name__ == '__main__':
+    main()
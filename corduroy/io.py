@@ -6,10 +6,21 @@ Synchromesh HTTP Bit-slinging Mayhem.
 """
 
 import sys, os, re
+import time
+import random
+import socket
 import urllib
+import zlib
+import threading
+import Queue
+import atexit
+import weakref
+from collections import deque
 import logging
 import mimetypes
+import uuid
 from datetime import timedelta
+from tempfile import SpooledTemporaryFile
 from base64 import b64encode
 from urlparse import urlsplit, urlunsplit, urlparse, urlunparse
 from base64 import b64encode
@@ -22,13 +33,728 @@ from .config import defaults, json
 from . import __version__ as VERSION
 
 _logger = logging.getLogger('corduroy')
-def log(*msg):
-    _logger.info((u" ".join([unicode(s) for s in msg])).encode('utf-8'))
+def log(msg, *args):
+    # skip the formatting entirely unless someone's listening
+    if not _logger.isEnabledFor(logging.INFO):
+        return
+    if args:
+        msg = msg % args
+    _logger.info(unicode(msg).encode('utf-8'))
+
+class Hooks(object):
+    """A registry of instrumentation callbacks invoked around every request.
+
+    Each event is passed an `adict` describing the request with the fields `method`,
+    `url`, `template` (the url's path with names replaced by placeholders, e.g.
+    ``/{db}/_design/{ddoc}/_view/{view}``), `bytes_sent`, `started`, and `traceparent`
+    (if `defaults.http.trace` is enabled). Once the
+    request completes, `bytes_received` and `timings` are filled in as well (see
+    `client_timings` for the breakdown).
+
+    Events:
+        on_request_start ƒ(request): called before the request is sent
+
+        on_response ƒ(request, status): called when a response arrives (with code < 400)
+
+        on_error ƒ(request, status): called for error responses and failed connections
+
+        on_retry ƒ(request, status): called before a failed request is attempted again
+
+        on_conflict ƒ(resolution): called with the ConflictResolution for any bulk save 
+        that left docs in its `pending` dict (single-doc conflicts arrive via on_error)
+
+        on_circuit ƒ(circuit, event): called when a circuit breaker changes `state` (with
+        an event of 'open', 'half_open', or 'closed') or turns a request away ('rejected')
+    """
+    events = ('on_request_start', 'on_response', 'on_error', 'on_retry', 'on_conflict', 'on_circuit')
+
+    def __init__(self):
+        self._active = False
+        for event in self.events:
+            setattr(self, event, [])
+
+    def __nonzero__(self):
+        return self._active
+
+    def register(self, listener=None, **handlers):
+        """Add callbacks for one or more events.
+
+        Args:
+            listener (obj): an optional object whose methods named after the events
+            will be registered
+
+        Kwargs:
+            event names mapped to callback functions (e.g., ``on_error=my_func``)
+        """
+        if listener is not None:
+            for event in self.events:
+                if hasattr(listener, event):
+                    handlers.setdefault(event, getattr(listener, event))
+        for event, handler in handlers.items():
+            if event not in self.events:
+                raise ValueError('unknown event %r' % event)
+            getattr(self, event).append(handler)
+        self._active = any(getattr(self, event) for event in self.events)
+
+    def unregister(self, listener=None, **handlers):
+        """Remove callbacks previously added with `.register`"""
+        if listener is not None:
+            for event in self.events:
+                if hasattr(listener, event):
+                    handlers.setdefault(event, getattr(listener, event))
+        for event, handler in handlers.items():
+            callbacks = getattr(self, event)
+            if handler in callbacks:
+                callbacks.remove(handler)
+        self._active = any(getattr(self, event) for event in self.events)
+
+    def clear(self):
+        for event in self.events:
+            setattr(self, event, [])
+        self._active = False
+
+    def fire(self, event, *args):
+        for handler in getattr(self, event):
+            try:
+                handler(*args)
+            except Exception:
+                _logger.exception('%s hook failed' % event)
+
+hooks = Hooks()
+
+def url_template(url):
+    """Replace the db, doc, and design doc names in a url's path with placeholders"""
+    path = [p for p in urlsplit(url).path.split('/') if p]
+    if not path:
+        return '/'
+    template = [path[0] if path[0].startswith('_') else '{db}']
+    if len(path) > 1 and not path[0].startswith('_'):
+        if path[1] in ('_design', '_local'):
+            template += [path[1], '{ddoc}' if path[1] == '_design' else '{doc}']
+            rest = path[3:]
+            if rest and rest[0].startswith('_'):
+                template.append(rest[0])
+                if len(rest) > 1:
+                    template.append('{view}' if rest[0] == '_view' else '{func}')
+            elif rest:
+                template.append('{attachment}')
+        elif path[1].startswith('_'):
+            template.append(path[1])
+        else:
+            template.append('{doc}')
+            if len(path) > 2:
+                template.append('{attachment}')
+    elif len(path) > 1:
+        template.append('{name}')
+    return '/' + '/'.join(template)
+
+def traceparent(parent=None):
+    """Generate a W3C `traceparent` header value for a new span.
+
+    Args:
+        parent (str): the traceparent of the enclosing span (if any). Its trace-id and
+        flags are inherited, otherwise a new trace is started.
+    """
+    parts = parent.split('-') if parent else []
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[3]) == 2:
+        trace_id, flags = parts[1], parts[3]
+    else:
+        trace_id, flags = uuid.uuid4().hex, '01'
+    return '00-%s-%s-%s' % (trace_id, os.urandom(8).encode('hex'), flags)
+
+def client_timings(resp=None):
+    """Start a breakdown of where a request's time went (in seconds).
+
+    The `queue`, `connect`, `ttfb`, and `transfer` fields are whatever the http client 
+    recorded for the response (or None if it doesn't say). The rest are filled in as
+    the response is processed:
+
+        validate: checking the status code and decoding the body's charset
+
+        decode: parsing the json
+
+        construct: wrapping the result in Document/View/etc. objects
+
+        total: wall-clock time from the start of the request until it was handed off
+    """
+    info = getattr(resp, 'time_info', None) or {}
+    return adict(queue=info.get('queue'), connect=info.get('connect'), 
+                 ttfb=info.get('starttransfer'), transfer=getattr(resp, 'request_time', None),
+                 validate=None, decode=None, construct=None, total=None)
+
+class RetryBudget(object):
+    """Caps retries at a fraction of recent traffic so a struggling server isn't buried
+    under a storm of them.
+
+    Every request deposits `ratio` tokens and every retry withdraws one. A `reserve` of
+    tokens per second is granted regardless of traffic (so a quiet client can still
+    retry the occasional failure), and the balance never grows beyond `cap`.
+    """
+    def __init__(self, ratio=0.1, reserve=1.0, cap=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.cap = cap
+        self._balance = float(cap)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.cap, self._balance + self.ratio)
+
+    def withdraw(self):
+        """Spend a token on a retry (returning False if there are none left)"""
+        with self._lock:
+            now = time.time()
+            self._balance = min(self.cap, self._balance + (now - self._updated) * self.reserve)
+            self._updated = now
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+class RetryPolicy(object):
+    """Decides which failed requests are worth repeating and how long to wait first.
+
+    A request is only retried if repeating it can't change the outcome:
+
+        GET and HEAD (along with POSTs that only read, like view queries with `keys`
+        or _changes) are always safe.
+
+        PUT and DELETE are safe when they name the revision they replace (through a
+        `_rev` in the body, a `rev` param, or an If-Match header), since a duplicate
+        will simply conflict.
+
+        POSTs to _bulk_docs are resent only when the server can't have acted on them
+        (the connection was refused or the response was a 408, 429, or 503). Once a
+        _bulk_docs response arrives, any individual docs that failed with a transient
+        error are resent on their own.
+
+    The wait before each retry is drawn at random from between zero and an exponentially
+    growing ceiling (`backoff` × 2^n, up to `max_backoff`) unless the server sent a
+    Retry-After header. Retries are also subject to a shared `RetryBudget`.
+
+    Attributes:
+        stats (dict): the number of `retries` made, along with the failures that weren't
+        retried because they'd already used up their `attempts` (`exhausted`) or because
+        the budget had run dry (`denied`)
+    """
+    statuses = (408, 429, 500, 502, 503, 504, 599)
+    unprocessed = (408, 429, 503)
+    doc_errors = ('unknown_error', 'timeout', 'internal_server_error', 'service_unavailable',
+                  'too_many_requests')
+    read_only = ('_all_docs', '_view', '_temp_view', '_changes', '_revs_diff', '_missing_revs',
+                 '_ensure_full_commit', '_compact', '_view_cleanup')
+    refused = re.compile(r'refused|errno (111|61)\b|not known|nodename nor servname', re.I)
+
+    def __init__(self, attempts=3, backoff=0.05, max_backoff=5.0, budget=None):
+        """Kwargs:
+            attempts (int): the most times a request will be sent (including the first)
+
+            backoff (float): the ceiling (in seconds) of the random delay before the
+            first retry (it doubles with each subsequent one)
+
+            max_backoff (float): the longest delay between attempts
+
+            budget (RetryBudget): the budget to draw from (a new one by default)
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget if budget is not None else RetryBudget()
+        self.stats = adict(retries=0, exhausted=0, denied=0)
+
+    def idempotent(self, method, url, body=None, headers=None):
+        """Return True if the request can be safely repeated after any transient failure,
+        'unprocessed' if only after failures the server can't have acted on, and False
+        if it shouldn't be retried at all"""
+        path = urlsplit(url).path.rstrip('/').split('/')
+        if method in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        if method == 'POST':
+            if path[-1] == '_bulk_docs':
+                return 'unprocessed'
+            return any(seg in self.read_only for seg in path[-3:])
+        if method in ('PUT', 'DELETE'):
+            if path[-1] in ('_security', '_revs_limit') or '_config' in path:
+                return method == 'PUT'
+            if re.search(r'[?&]rev=', url) or (headers or {}).get('If-Match'):
+                return True
+            return bool(hasattr(body, 'get') and body.get('_rev'))
+        return False
+
+    def retryable(self, safety, status):
+        """Whether a failed response is transient (for a request of the given safety)"""
+        if not safety or status.code not in self.statuses or isinstance(status.exception, CircuitOpen):
+            return False
+        if safety == 'unprocessed':
+            return status.code in self.unprocessed or \
+                   (status.code == 599 and bool(self.refused.search(str(status.exception))))
+        return True
+
+    def permit(self, attempt):
+        """Whether another attempt is allowed after `attempt` tries"""
+        if attempt >= self.attempts:
+            self.stats.exhausted += 1
+            return False
+        if not self.budget.withdraw():
+            self.stats.denied += 1
+            return False
+        self.stats.retries += 1
+        return True
+
+    def delay(self, attempt, status=None):
+        """Seconds to wait before the next attempt (after `attempt` tries)"""
+        retry_after = status.headers.get('Retry-After') if status is not None and status.headers else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass # an http-date rather than a number of seconds
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**(attempt-1)))
+
+    def transient_docs(self, results):
+        """The indices of the _bulk_docs results that failed with a transient error"""
+        return [i for i, r in enumerate(results) if hasattr(r, 'get') and r.get('error') in self.doc_errors]
+
+class HedgePolicy(object):
+    """Sends a second copy of slow reads and uses whichever response arrives first.
+
+    A GET (or HEAD) that hasn't completed within the `percentile`th percentile of recent
+    read latencies is duplicated (to another node if the request is being routed through
+    a Cluster). The first response wins and the other is abandoned: its callback is
+    dropped without decoding the body, though the request itself runs to completion
+    since the http clients have no way to abort one in flight. Hedges are drawn from a
+    RetryBudget so they add at most a `budget` fraction of extra reads.
+
+    Blocking reads are sent from the policy's WorkerPool (so the caller is free to stop
+    waiting on a slow primary once the hedge comes back) rather than a fresh thread per
+    attempt.
+
+    Attributes:
+        stats (dict): the number of `hedges` sent, the number of them that `won`, and
+        the number that weren't sent because the budget had run dry (`denied`)
+
+        workers (WorkerPool): the threads that send blocking reads and their hedges
+    """
+    def __init__(self, percentile=95, budget=0.05, min_delay=0.002, max_delay=1.0, window=1000):
+        """Kwargs:
+            percentile (float): the point in the latency distribution at which reads are
+            hedged
+
+            budget (float, RetryBudget): the fraction of reads that may be hedged (or a
+            RetryBudget to share with other policies)
+
+            min_delay (float): the shortest wait (in seconds) before hedging
+
+            max_delay (float): the longest wait before hedging (also used until enough
+            latencies have been seen to compute a percentile)
+
+            window (int): the number of recent latencies to draw the percentile from
+        """
+        self.percentile = percentile
+        self.budget = budget if isinstance(budget, RetryBudget) else RetryBudget(ratio=budget, reserve=0, cap=5)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stats = adict(hedges=0, won=0, denied=0)
+        self.workers = WorkerPool()
+        self._latencies = deque(maxlen=window)
+        self._delay = None
+        self._lock = threading.Lock()
+
+    def eligible(self, method, url):
+        """Whether a request is a read that's safe to duplicate"""
+        return method in ('GET', 'HEAD') and '/_changes' not in url
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            if len(self._latencies) % 50 == 0:
+                self._delay = None # recompute the percentile every so often
+
+    def delay(self):
+        """Seconds to wait for a response before hedging"""
+        with self._lock:
+            if self._delay is None:
+                if len(self._latencies) < 20:
+                    return self.max_delay
+                ordered = sorted(self._latencies)
+                idx = min(len(ordered)-1, int(len(ordered) * self.percentile / 100.0))
+                self._delay = max(self.min_delay, min(self.max_delay, ordered[idx]))
+            return self._delay
+
+    def permit(self):
+        if not self.budget.withdraw():
+            self.stats.denied += 1
+            return False
+        self.stats.hedges += 1
+        return True
+
+class WorkerPool(object):
+    """A set of long-lived threads for running blocking calls in the background. Since
+    each thread keeps its own http client (and connections) between calls, handing a
+    request to an idle worker costs little more than sending it from the caller's thread.
+    A thread is added whenever none are idle and retires after `linger` idle seconds
+    (or when the pool is closed, which happens automatically at exit)."""
+    def __init__(self, linger=60):
+        self.linger = linger
+        self._idle = [] # the (thread, inbox) pairs of the workers waiting for a call
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def close(self, timeout=1):
+        """Retire the idle workers (waiting up to `timeout` seconds for them to exit)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for thread, inbox in idle:
+            inbox.put(None)
+        deadline = time.time() + timeout
+        for thread, inbox in idle:
+            thread.join(max(deadline - time.time(), 0))
+
+    def submit(self, call, callback=None):
+        """Run a function (taking no args) on one of the pool's threads.
+
+        Kwargs:
+            callback (function): passed the call's return value and the exception it
+            raised (or None) once the worker is back in the pool, so a caller waiting on
+            the result can submit its next call without a new thread being started
+        """
+        task = (call, callback)
+        with self._lock:
+            thread, inbox = self._idle.pop() if self._idle else (None, None)
+        if inbox is not None:
+            return inbox.put(task)
+        worker = threading.Thread(target=self._work, args=(task,))
+        worker.daemon = True
+        worker.start()
+
+    def _work(self, task):
+        idle = (threading.current_thread(), Queue.Queue())
+        while task is not None:
+            call, callback = task
+            try:
+                result, exc = call(), None
+            except Exception, e:
+                result, exc = None, e
+            with self._lock:
+                self._idle.append(idle)
+            try:
+                if callback:
+                    callback(result, exc)
+                elif exc is not None:
+                    raise exc
+            except Exception:
+                _logger.exception('unhandled error in a worker thread')
+            try:
+                task = idle[1].get(timeout=self.linger)
+            except Queue.Empty:
+                with self._lock:
+                    if idle in self._idle:
+                        self._idle.remove(idle)
+                        return
+                # it was handed a call just as it was about to give up
+                task = idle[1].get()
+
+# idle workers are retired at exit rather than left to wake up in the middle of the
+# interpreter's teardown
+_pools = weakref.WeakSet()
+
+@atexit.register
+def _close_pools():
+    for pool in list(_pools):
+        pool.close()
+
+class Circuit(object):
+    """The breaker state for one host or database (see CircuitBreaker)"""
+    def __init__(self, key):
+        self.key = key
+        self.state = 'closed'
+        self.opened = None
+        self.outcomes = deque()
+        self.trials = 0
+        self.successes = 0
+        self.stats = adict(rejected=0, opened=0)
+
+    def __repr__(self):
+        return '<Circuit %s %s>' % (self.key, self.state)
+
+class CircuitBreaker(object):
+    """Fails requests immediately while a host or database is in trouble, rather than
+    letting every caller wait out its timeout.
+
+    Each database (or host, for server-level requests) gets a `Circuit` of its own.
+    Once at least `volume` requests have completed within the last `window` seconds,
+    the circuit opens if the fraction of them that failed (with a 5xx or 429 response
+    or a connection error) reaches `errors`, or if the fraction that took longer than
+    `slow_call` seconds reaches `slow`. While open, requests raise CircuitOpen (or pass
+    it to their callbacks in a 503 Status) without touching the network. After
+    `cooldown` seconds the circuit is half-open: up to `trials` requests are let
+    through at a time, and that many successes in a row close it again while any
+    failure reopens it.
+
+    State changes and rejections are reported through the `on_circuit` hook (which
+    corduroy.metrics.Metrics tracks).
+    """
+    def __init__(self, errors=0.5, slow=0.5, slow_call=10.0, volume=20, window=10.0, cooldown=5.0, trials=3):
+        self.errors = errors
+        self.slow = slow
+        self.slow_call = slow_call
+        self.volume = volume
+        self.window = window
+        self.cooldown = cooldown
+        self.trials = trials
+        self.circuits = {}
+        self._lock = threading.Lock()
+
+    def circuit(self, url):
+        """Return the Circuit covering the given url"""
+        parts = urlsplit(url)
+        name = parts.path.strip('/').split('/')[0]
+        key = '%s://%s/%s' % (parts.scheme, parts.netloc, '' if name.startswith('_') else name)
+        circuit = self.circuits.get(key)
+        if circuit is None:
+            with self._lock:
+                circuit = self.circuits.setdefault(key, Circuit(key))
+        return circuit
+
+    def admit(self, circuit):
+        """Whether a request may be sent (counting it as a trial if the circuit is half-open)"""
+        with self._lock:
+            if circuit.state == 'open' and self.remaining(circuit) <= 0:
+                self._transition(circuit, 'half_open')
+            if circuit.state == 'closed' or (circuit.state == 'half_open' and circuit.trials < self.trials):
+                if circuit.state == 'half_open':
+                    circuit.trials += 1
+                return True
+            circuit.stats.rejected += 1
+        hooks.fire('on_circuit', circuit, 'rejected')
+        return False
+
+    def remaining(self, circuit):
+        """Seconds until an open circuit lets a trial request through"""
+        return max(0, circuit.opened + self.cooldown - time.time()) if circuit.opened else 0
+
+    def record(self, circuit, elapsed, status=None):
+        """Note the outcome of an admitted request"""
+        failed = status is not None and (status.code >= 500 or status.code == 429)
+        slow = elapsed >= self.slow_call
+        with self._lock:
+            if circuit.state == 'half_open':
+                circuit.trials = max(0, circuit.trials - 1)
+                if failed or slow:
+                    self._transition(circuit, 'open')
+                else:
+                    circuit.successes += 1
+                    if circuit.successes >= self.trials:
+                        self._transition(circuit, 'closed')
+            elif circuit.state == 'closed':
+                now = time.time()
+                circuit.outcomes.append((now, failed, slow))
+                while circuit.outcomes and circuit.outcomes[0][0] < now - self.window:
+                    circuit.outcomes.popleft()
+                total = len(circuit.outcomes)
+                if total >= self.volume:
+                    failures = sum(1 for _, f, _ in circuit.outcomes if f)
+                    slow_calls = sum(1 for _, _, s in circuit.outcomes if s)
+                    if failures >= total * self.errors or slow_calls >= total * self.slow:
+                        self._transition(circuit, 'open')
+
+    def reset(self):
+        with self._lock:
+            self.circuits.clear()
+
+    def status(self):
+        """The state of every circuit (keyed by host or database url)"""
+        return dict((key, adict(state=c.state, retry_in=self.remaining(c) if c.state == 'open' else None, **c.stats))
+                    for key, c in self.circuits.items())
+
+    def _transition(self, circuit, state):
+        circuit.state = state
+        circuit.trials = circuit.successes = 0
+        circuit.outcomes.clear()
+        circuit.opened = time.time() if state == 'open' else None
+        if state == 'open':
+            circuit.stats.opened += 1
+        hooks.fire('on_circuit', circuit, state)
+
+class Limit(object):
+    """The adaptive concurrency limit for one host (see ConcurrencyLimiter)"""
+    def __init__(self, host, initial):
+        self.host = host
+        self.limit = float(initial)
+        self.inflight = 0
+        self.blocking = 0
+        self.queue = deque()
+        self.baseline = None
+        self.rtt = None
+        self.decreased = 0
+        self.cond = threading.Condition()
+        self.stats = adict(requests=0, waited=0, decreases=0)
+
+    def __repr__(self):
+        return '<Limit %s %i/%i>' % (self.host, self.inflight, self.limit)
+
+    @property
+    def slots(self):
+        return max(1, int(self.limit))
+
+class ConcurrencyLimiter(object):
+    """Adjusts the number of requests allowed in flight to each host based on how
+    quickly (and how reliably) it's been responding.
+
+    The limit grows additively (by about one request per round of `limit` successful
+    responses) while round-trip times stay within `tolerance` times the fastest
+    recently observed, and shrinks multiplicatively (by `backoff`, at most once per
+    round trip) when they rise beyond that or when the server responds with a 5xx or
+    429 or fails to respond at all.
+
+    Asynchronous requests beyond the limit wait in a per-host queue. Blocking requests
+    wait (on their own thread) for a slot when other blocking requests hold them all;
+    they never wait on async requests, since those may need the blocked thread's event
+    loop to finish. Bulk saves and fetches are also split into chunks whose size tracks
+    the limit (see `chunk_size`).
+
+    Enable it for all requests with ``defaults.http.limiter = ConcurrencyLimiter()``. The
+    current limits can be found in `status()`.
+    """
+    def __init__(self, initial=10, min_limit=1, max_limit=200, tolerance=2.0, backoff=0.9, 
+                       chunk=500, min_chunk=10, max_chunk=5000):
+        """Kwargs:
+            initial (int): the starting limit for each host
+
+            min_limit, max_limit (int): bounds on the limit
+
+            tolerance (float): how many times slower than the baseline a response can be
+            before it's taken as a sign of congestion
+
+            backoff (float): the factor by which the limit is cut when congested
+
+            chunk (int): the number of docs per bulk request when the limit is at its
+            initial value (scaled in proportion to the limit and kept within
+            `min_chunk` and `max_chunk`)
+        """
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.chunk = chunk
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.limits = {}
+        self._lock = threading.Lock()
+
+    def host(self, url):
+        """Return the Limit for the host the url points to"""
+        parts = urlsplit(url)
+        key = '%s://%s' % (parts.scheme, parts.netloc)
+        limit = self.limits.get(key)
+        if limit is None:
+            with self._lock:
+                limit = self.limits.setdefault(key, Limit(key, self.initial))
+        return limit
+
+    def limit(self, url):
+        """The number of requests currently allowed in flight to the url's host"""
+        return self.host(url).slots
+
+    def chunk_size(self, url):
+        """The number of docs to send in each bulk request to the url's host"""
+        size = int(self.chunk * self.host(url).limit / self.initial)
+        return max(self.min_chunk, min(self.max_chunk, size))
+
+    def acquire(self, limit):
+        """Wait for a slot for a blocking request"""
+        with limit.cond:
+            while limit.blocking >= limit.slots:
+                limit.cond.wait()
+            limit.blocking += 1
+            limit.inflight += 1
+            limit.stats.requests += 1
+
+    def submit(self, limit, start):
+        """Call `start` once there's a slot for an async request"""
+        with limit.cond:
+            limit.stats.requests += 1
+            if limit.inflight >= limit.slots:
+                limit.stats.waited += 1
+                limit.queue.append(start)
+                return
+            limit.inflight += 1
+        start()
+
+    def release(self, limit, rtt, status=None, blocking=False):
+        """Free a request's slot and adjust the limit based on how it went"""
+        failed = status is not None and (status.code >= 500 or status.code == 429)
+        with limit.cond:
+            limit.inflight -= 1
+            if blocking:
+                limit.blocking -= 1
+            self._adjust(limit, rtt, failed)
+            ready = []
+            while limit.queue and limit.inflight < limit.slots:
+                limit.inflight += 1
+                ready.append(limit.queue.popleft())
+            limit.cond.notify_all()
+        for start in ready:
+            start()
+
+    def status(self):
+        """The current limit and load for each host"""
+        return dict((key, adict(limit=l.slots, inflight=l.inflight, queued=len(l.queue),
+                                baseline=l.baseline, rtt=l.rtt, **l.stats))
+                    for key, l in self.limits.items())
+
+    def _adjust(self, limit, rtt, failed):
+        limit.rtt = rtt if limit.rtt is None else limit.rtt + 0.2 * (rtt - limit.rtt)
+        if not failed:
+            # let the baseline creep upward so a permanently slower server isn't
+            # mistaken for a congested one forever
+            limit.baseline = rtt if limit.baseline is None or rtt < limit.baseline \
+                             else limit.baseline * 1.001
+        now = time.time()
+        if failed or (limit.baseline is not None and rtt > limit.baseline * self.tolerance):
+            if now - limit.decreased > rtt:
+                limit.limit = max(self.min_limit, limit.limit * self.backoff)
+                limit.decreased = now
+                limit.stats.decreases += 1
+        elif limit.inflight + 1 >= limit.slots or limit.queue:
+            # only grow while the current limit is actually being used
+            limit.limit = min(self.max_limit, limit.limit + 1.0 / limit.limit)
+
+def relaxed_task(start):
+    """Wrap a callback-style request in a tornado.gen.Task for the @relax decorator
+    (raising the request's exception if it fails)"""
+    from tornado import gen
+    def run(callback):
+        def just_the_facts(data, status):
+            if not status.ok:
+                raise status.exception
+            callback(data)
+        start(just_the_facts)
+    return gen.Task(run)
+
+def transport_error(exc):
+    """Whether an exception raised by a blocking client means the request never got a
+    response (a refused or dropped connection, a timeout, etc.)"""
+    return isinstance(exc, (socket.error, IOError)) or type(exc).__module__.startswith('requests')
+
+def gzip_body(data, level=6):
+    """Compress a request body with gzip framing"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 def guess_mime(filename):
     return ';'.join(filter(None, mimetypes.guess_type(filename)) or 'application/octet-stream')
 
 def serialize_doc(doc, _encode=True):
+    raw = raw_json(doc)
+    if raw is not None:
+        # unmodified lazy docs are sent just as they were received
+        if _encode:
+            return raw.encode('utf-8') if isinstance(raw, unicode) else raw
+        return doc
     body = content_type = None
     _att = odict()
     for fn, info in doc.get('_attachments',{}).iteritems():
@@ -48,9 +774,148 @@ def serialize_doc(doc, _encode=True):
         return json.encode(updated_doc).encode('utf-8')
     return updated_doc
 
+def serialize_multipart(doc):
+    """Build a multipart/related request body for a doc whose _attachments contain file objects.
+    
+    Only the json part is encoded in memory. The attachment parts are read from their
+    files while the request is being sent (see CouchDB's docs on `PUT /db/doc`).
+    
+    Returns:
+        a (body, content_type) tuple or None if the doc has no file-like attachments
+    """
+    if raw_json(doc) is not None:
+        return None
+    _att = odict()
+    files = []
+    for fn, info in doc.get('_attachments',{}).iteritems():
+        if hasattr(info, 'read') and info.read:
+            fileobj, content_type = info, guess_mime(fn)
+        elif hasattr(info.get('data'), 'read') and info.get('data').read:
+            fileobj, content_type = info['data'], info.get('content_type',None) or guess_mime(fn)
+        else:
+            _att[fn] = info
+            continue
+        length = body_length(fileobj)
+        if length is None:
+            fileobj = fileobj.read()
+            length = len(fileobj)
+        _att[fn] = dict(content_type=content_type, length=length, follows=True)
+        files.append(fileobj)
+    if not files:
+        return None
+
+    updated_doc = doc.copy()
+    updated_doc['_attachments'] = _att
+    boundary = uuid.uuid4().hex
+    parts = ['--%s\r\nContent-Type: application/json\r\n\r\n'%boundary, 
+             json.encode(updated_doc).encode('utf-8')]
+    for fileobj in files:
+        parts.extend(['\r\n--%s\r\n\r\n'%boundary, fileobj])
+    parts.append('\r\n--%s--'%boundary)
+    return MultipartBody(parts), 'multipart/related; boundary="%s"'%boundary
+
+class MultipartBody(object):
+    """A read-only file-like concatenation of bytestrings and (already sized) file objects"""
+    def __init__(self, parts):
+        self._parts = list(parts)
+        self._remaining = sum(len(p) if isinstance(p, basestring) else body_length(p) 
+                              for p in self._parts)
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            part = self._parts[0]
+            if isinstance(part, basestring):
+                chunk = part[:size] if size > 0 else part
+                self._parts[0] = part[len(chunk):]
+            else:
+                chunk = part.read(size) if size > 0 else part.read()
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            self._remaining -= len(chunk)
+            if size > 0: 
+                size -= len(chunk)
+        return ''.join(chunks)
+
+def body_length(body):
+    """Return the number of unread bytes in a file-like body (or None if it can't be known
+    without reading the whole thing)"""
+    if isinstance(body, MultipartBody):
+        return len(body)
+    try:
+        return os.fstat(body.fileno()).st_size - body.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    if hasattr(body, 'getvalue'):
+        return len(body.getvalue()) - body.tell()
+    return None
+
 def serialize_bulk(body):
     body['docs'] = [serialize_doc(d, _encode=False) for d in body['docs']]
-    return json.encode(body).encode('utf-8')    
+    raws = [raw_json(d) for d in body['docs']]
+    if not any(raw is not None for raw in raws):
+        return json.encode(body).encode('utf-8')
+
+    # splice the json of any unmodified lazy docs into the request body as-is
+    docs = []
+    for doc, raw in zip(body['docs'], raws):
+        if raw is None:
+            raw = json.encode(doc)
+        docs.append(raw if isinstance(raw, unicode) else raw.decode('utf-8'))
+    rest = json.encode(dict((k,v) for k,v in body.items() if k!='docs'))
+    rest = u',' + rest[1:-1] if len(rest) > 2 else u''
+    return (u'{"docs":[%s]%s}' % (u','.join(docs), rest)).encode('utf-8')
+
+def decode_doc(data):
+    """Decode a doc from a response body (leaving it as JSON if the doc type is lazy)"""
+    from_json = getattr(defaults.types.doc, 'from_json', None)
+    if from_json is not None and data.lstrip().startswith('{'):
+        return from_json(data)
+    return json.decode(data)
+
+_ROW_KEY = re.compile(r'\s*("(?:[^"\\]|\\.)*")\s*:\s*')
+_ROW_SEP = re.compile(r'\s*,?\s*')
+
+def decode_rows(data):
+    """Decode a view response, leaving each row's doc as JSON if the doc type is lazy.
+    
+    CouchDB writes each row of a view on a line of its own (with the doc as the row's 
+    last field), so the docs can be sliced out of the body without decoding them. 
+    Responses laid out any other way are decoded in full.
+    """
+    from_json = getattr(defaults.types.doc, 'from_json', None)
+    lines = data.split('\n') if from_json is not None else []
+    if len(lines) < 3 or not lines[0].rstrip().endswith('['):
+        return json.decode(data)
+
+    rows, trailer = [], []
+    for line in lines[1:]:
+        line = line.strip()
+        if line.startswith('{'):
+            rows.append(line.rstrip(','))
+        else:
+            trailer.append(line)
+    try:
+        results = json.decode(lines[0].rstrip() + ''.join(trailer))
+        for line in rows:
+            row, pos = defaults.types.dict(), 1
+            while line[pos] != '}':
+                m = _ROW_KEY.match(line, pos)
+                key = json.decode(m.group(1))
+                if key == 'doc' and line[m.end()] == '{':
+                    row[key] = from_json(line[m.end():-1])
+                    break
+                row[key], pos = json.decode_at(line, m.end())
+                pos = _ROW_SEP.match(line, pos).end()
+            results['rows'].append(row)
+    except (ValueError, AttributeError, IndexError, KeyError):
+        return json.decode(data)
+    return results
     
     
 def denormalize_url(url, creds):
@@ -164,6 +1029,191 @@ def urljoin(base, *path, **query):
     return ''.join(retval)
 
     
+class StreamSink(object):
+    """Write-through destination for response bodies too large to hold in memory.
+    
+    Chunks arriving from the http client are written directly to `target` (any
+    object with a `write` method). If no target is given, a SpooledTemporaryFile
+    is used instead and is rewound once the response completes. Nothing is written
+    to the target until the response is known to be a success (so a proxy's error
+    page doesn't wind up in the middle of the caller's file). If the http client
+    doesn't pass along the status line, the body is spooled until it completes and
+    only then copied to the target.
+    """
+    def __init__(self, target=None, chunk_size=None):
+        self.chunk_size = chunk_size or defaults.http.chunk_size
+        self._rewind = not hasattr(target, 'write')
+        self.target = None if self._rewind else target
+        self.length = 0
+        self.code = None
+        self._held = SpooledTemporaryFile(max_size=defaults.http.spool_size)
+
+    def header(self, line):
+        """Note the response's status code from its status line (if the http client
+        passes it to its header callback along with the rest of the headers)"""
+        m = re.match(r'HTTP/[\d.]+\s+(\d{3})', line)
+        if m:
+            self.code = int(m.group(1)) # the last one wins (after a 100 Continue, say)
+
+    def write(self, chunk):
+        if not chunk: return
+        self.length += len(chunk)
+        if self._held is None:
+            self.target.write(chunk)
+        else:
+            self._held.write(chunk)
+            if self.code is not None and 200 <= self.code < 300:
+                self._flush()
+
+    def pump(self, resp):
+        """Copy a requests-style response's body into the target chunk by chunk"""
+        self.code = resp.status_code
+        for chunk in resp.iter_content(self.chunk_size):
+            self.write(chunk)
+
+    def finish(self, ok=True):
+        """Returns the target file (or the held-back bytes if the response was an error)"""
+        if not ok:
+            if self._held is None:
+                return ''
+            self._held.seek(0)
+            return self._held.read()
+        if self._held is not None:
+            self._flush()
+        if self._rewind:
+            self.target.seek(0)
+        return self.target
+
+    def _flush(self):
+        held, self._held = self._held, None
+        if self.target is None:
+            # no file of our own to copy into, so the spool becomes the target
+            self.target = held
+            return
+        held.seek(0)
+        while True:
+            chunk = held.read(self.chunk_size)
+            if not chunk:
+                break
+            self.target.write(chunk)
+        held.close()
+
+class MultipartSink(StreamSink):
+    """Incremental parser for multipart/related doc+attachment responses.
+    
+    The json part is decoded into a dict and every subsequent part is spooled to its
+    own temporary file and attached to the doc as `_attachments[filename].data`. 
+    Bodies that turn out not to be multipart (e.g., errors or docs without any
+    attachments) are held in memory as-is.
+    """
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or defaults.http.chunk_size
+        self.length = 0
+        self._buf = ''
+        self._held = []
+        self._delim = None
+        self._state = 'start'
+        self._parts = []
+
+    def write(self, chunk):
+        if not chunk: return
+        self.length += len(chunk)
+        if self._state == 'plain':
+            self._held.append(chunk)
+            return
+        self._buf += chunk
+
+        if self._state == 'start':
+            # the first line of the body gives us the boundary
+            if not self._buf.startswith('--'[:len(self._buf)]):
+                self._state, self._held, self._buf = 'plain', [self._buf], ''
+                return
+            if '\n' not in self._buf:
+                return
+            line, self._buf = self._buf.split('\n', 1)
+            self._delim = '\r\n%s' % line.strip()
+            self._state = 'headers'
+        self._parse()
+
+    def _parse(self):
+        while True:
+            buf = self._buf
+            if self._state == 'headers':
+                if buf.startswith('\r\n'):
+                    header_lines, buf = '', buf[2:]
+                elif '\r\n\r\n' in buf:
+                    header_lines, buf = buf.split('\r\n\r\n', 1)
+                else:
+                    return
+                headers = dict((k.strip().lower(), v.strip()) for k, _, v in 
+                               [ln.partition(':') for ln in header_lines.splitlines() if ln])
+                self._parts.append((headers, SpooledTemporaryFile(max_size=defaults.http.spool_size)))
+                self._state = 'body'
+
+            elif self._state == 'body':
+                part = self._parts[-1][1]
+                idx = buf.find(self._delim)
+                if idx < 0:
+                    # write out everything that can't be the start of a delimiter
+                    safe = len(buf) - len(self._delim) + 1
+                    if safe > 0:
+                        part.write(buf[:safe])
+                        self._buf = buf[safe:]
+                    return
+                part.write(buf[:idx])
+                buf = buf[idx+len(self._delim):]
+                self._state = 'boundary'
+
+            elif self._state == 'boundary':
+                if buf.startswith('--'):
+                    self._state, self._buf = 'done', ''
+                    return
+                if '\r\n' not in buf:
+                    return
+                buf = buf.split('\r\n', 1)[1]
+                self._state = 'headers'
+
+            else:
+                self._buf = ''
+                return
+            self._buf = buf
+
+    def finish(self, ok=True):
+        if self._state in ('start', 'plain'):
+            return ''.join(self._held) or self._buf
+
+        doc = None
+        files = []
+        for headers, fileobj in self._parts:
+            fileobj.seek(0)
+            if doc is None and 'json' in headers.get('content-type', 'application/json'):
+                doc = json.decode(fileobj.read().decode('utf-8'))
+            else:
+                files.append((headers, fileobj))
+
+        if doc is None:
+            raise ServerError('malformed multipart response: no json part for the doc')
+
+        # match up the parts by filename, falling back to the order of the doc's stubs
+        attachments = doc.get('_attachments', {})
+        following = [fn for fn, info in attachments.items() if info.get('follows')]
+        for headers, fileobj in files:
+            m = re.search(r'filename="?([^";]+)"?', headers.get('content-disposition', ''))
+            if m:
+                filename = m.group(1).decode('utf-8')
+            elif following:
+                filename = following[0]
+            else:
+                raise ServerError('malformed multipart response: unnamed part with no stub left to match it to')
+            if filename in following:
+                following.remove(filename)
+            if filename not in attachments:
+                raise ServerError('malformed multipart response: no stub for attachment %r' % filename)
+            info = attachments[filename]
+            info.pop('follows', None)
+            info['data'] = fileobj
+        return doc
+
 def is_relaxed():
     for _, filename, _, function_name, _, _ in getouterframes(currentframe())[:30]:
         if 'tornado/gen.py' in filename:
@@ -176,13 +1226,25 @@ class Resource(object):
         self.url, credentials = normalize_url(url)
         self.credentials = auth if auth else credentials
         self.headers = headers or {}
+        self.retries = None # a RetryPolicy (or None to use defaults.http.retries)
+        self.cluster = None # a corduroy.cluster.Cluster to route requests through
+        self.hedge = None # a HedgePolicy (or None to use defaults.http.hedge)
+        self.breaker = None # a CircuitBreaker (or None to use defaults.http.breaker)
         self.io = IO()
 
     def __call__(self, *path):
         obj = type(self)(urljoin(self.url, *path), auth=self.credentials)
         obj.headers = self.headers.copy()
+        obj.retries = self.retries
+        obj.cluster = self.cluster
+        obj.hedge = self.hedge
+        obj.breaker = self.breaker
         return obj
 
+    @property
+    def retry_policy(self):
+        return self.retries if self.retries is not None else defaults.http.retries
+
     @property
     def auth_url(self):
         return denormalize_url(self.url, self.credentials)
@@ -219,9 +1281,10 @@ class Resource(object):
 
 
     def _request(self, method, path=None, body=None, headers=None, asjson=False, 
-                       process=None, callback=None, **params):
+                       process=None, callback=None, stream=None, **params):
         
         method = method.upper()
+        original = body
         
         all_headers = self.headers.copy()
         all_headers.update(headers or {})
@@ -232,6 +1295,11 @@ class Resource(object):
             headers = all_headers
         headers.setdefault('Accept', 'application/json')
         headers['User-Agent'] = 'Corduroy/%s' % VERSION
+        trace = defaults.http.trace
+        if trace:
+            # propagate the caller's trace context (or start a new one) so the
+            # server-side logs can be matched up with the client's
+            headers['traceparent'] = traceparent(trace() if hasattr(trace, '__call__') else None)
 
         if path is not None:
             url = urljoin(self.url, path, **params)
@@ -242,19 +1310,37 @@ class Resource(object):
         # and treat those separately. otherwise json encode it and hope for the best
         if body is not None and not isinstance(body, basestring):
             if not hasattr(body, 'read') or not body.read:                
-                if isinstance(body.get('docs'), (list,tuple)):
+                multipart = serialize_multipart(body) if method=='PUT' else None
+                if multipart:
+                    # send file attachments as raw bytes following the json doc
+                    body, headers['Content-Type'] = multipart
+                elif isinstance(body.get('docs'), (list,tuple)):
                     # import pdb; pdb.set_trace()
                     body = serialize_bulk(body)
+                    headers['Content-Type']='application/json'
                 else:
                     body = serialize_doc(body)
-                headers['Content-Type']='application/json'
+                    headers['Content-Type']='application/json'
+
+        # large json bodies can be sent compressed (which couch has understood since 1.0)
+        threshold = defaults.http.gzip_threshold
+        if threshold is not None and isinstance(body, str) and len(body) >= threshold and \
+           headers.get('Content-Type') == 'application/json' and 'Content-Encoding' not in headers:
+            body = gzip_body(body, defaults.http.gzip_level)
+            headers['Content-Encoding'] = 'gzip'
 
         if body is None:
             headers.setdefault('Content-Length', '0')
         elif isinstance(body, basestring):
             headers.setdefault('Content-Length', str(len(body)))
         elif hasattr(body, 'read') and body.read:
-            body = body.read()
+            # let the http client stream files from disk if we know how much is coming
+            length = body_length(body)
+            if length is None:
+                body = body.read()
+                headers.setdefault('Content-Length', str(len(body)))
+            else:
+                headers.setdefault('Content-Length', str(length))
             
         # path_query = urlunsplit(('', '') + urlsplit(url)[2:4] + ('',))
         req = dict(method=method, headers=headers, url=url)
@@ -264,6 +1350,34 @@ class Resource(object):
             req['data'] = ''
         if self.credentials:
             req['auth'] = self.credentials
+        if stream is not None and stream is not False:
+            # stream the response body to a file rather than returning a string
+            req['stream'] = stream if isinstance(stream, StreamSink) else \
+                            StreamSink(stream if stream is not True else None)
+
+        # only requests whose bodies can be sent a second time are eligible for retries
+        policy = self.retry_policy
+        if policy and 'stream' not in req and not hasattr(req.get('data'), 'read'):
+            safety = policy.idempotent(method, url, original, headers)
+            if safety:
+                return self._retrying_request(req, process, callback, policy, safety)
+        return self._dispatch(req, process, callback)
+
+    def _dispatch(self, req, process, callback, stage=0):
+        # pass the request through whichever of the optional layers are enabled (each
+        # of which calls back here with the next stage) before handing it to the client
+        if stage < 1:
+            breaker = self.breaker if self.breaker is not None else defaults.http.breaker
+            if breaker:
+                return self._guarded_request(req, process, callback, breaker)
+        if stage < 2:
+            hedge = self.hedge if self.hedge is not None else defaults.http.hedge
+            if hedge and 'stream' not in req and hedge.eligible(req['method'], req['url']):
+                return self._hedged_request(req, process, callback, hedge)
+        if stage < 3 and self.cluster is not None:
+            return self._routed_request(req, process, callback)
+        if hooks:
+            return self._observed_request(req, process, callback)
 
         # if there's a callback, try to use one of the async clients
         if callback and hasattr(callback,'__call__'):
@@ -276,18 +1390,237 @@ class Resource(object):
         # otherwise use the blocking client
         return self.io.fetch(process=process, **req)
 
+    def _retrying_request(self, req, process, callback, policy, safety):
+        """Perform a request, repeating it after transient failures (as the policy allows)"""
+        policy.budget.deposit()
+        info = adict(method=req['method'], url=req['url'], template=url_template(req['url']),
+                     attempt=1, delay=None)
+
+        def should_retry(status):
+            return policy.retryable(safety, status) and policy.permit(info.attempt)
+
+        def announce(status):
+            info.delay = policy.delay(info.attempt, status)
+            hooks.fire('on_retry', info, status)
+            info.attempt += 1
+            return info.delay
+
+        if not callback and is_relaxed():
+            return relaxed_task(lambda cb: self._retrying_request(req, process, cb, policy, safety))
+
+        if callback and hasattr(callback,'__call__'):
+            def gate(data, status):
+                # hold back failures that will be retried rather than processing them
+                if not status.ok and should_retry(status):
+                    status.retry = True
+                elif hasattr(process,'__call__'):
+                    data, status = process(data, status)
+                return data, status
+
+            def response_ready(data, status):
+                if status.get('retry'):
+                    self.io.timeout(announce(status), lambda: self._dispatch(req, gate, response_ready))
+                else:
+                    callback(data, status)
+            return self._dispatch(req, gate, response_ready)
+
+        while True:
+            try:
+                return self._dispatch(req, process, None)
+            except Exception, e:
+                status = getattr(e, 'status', None)
+                if status is None:
+                    if not transport_error(e):
+                        raise
+                    status = Status(599, exc=e, headers={})
+                if not should_retry(status):
+                    raise
+                time.sleep(announce(status))
+
+    def _guarded_request(self, req, process, callback, breaker):
+        """Perform a request unless its circuit is open, in which case fail immediately"""
+        circuit = breaker.circuit(req['url'])
+        if not breaker.admit(circuit):
+            exc = CircuitOpen('%s is failing, retry in %.1fs' % (circuit.key, breaker.remaining(circuit)))
+            exc.status = Status(503, exc=exc, headers={})
+            if callback and hasattr(callback,'__call__'):
+                return self.io.timeout(0, lambda: callback(None, exc.status))
+            raise exc
+        if not callback and is_relaxed():
+            return relaxed_task(lambda cb: self._guarded_request(req, process, cb, breaker))
+
+        began = time.time()
+        if callback and hasattr(callback,'__call__'):
+            def response_ready(data, status):
+                breaker.record(circuit, time.time() - began, status)
+                callback(data, status)
+            return self._dispatch(req, process, response_ready, stage=1)
+
+        try:
+            data = self._dispatch(req, process, None, stage=1)
+        except Exception, e:
+            status = getattr(e, 'status', None)
+            if status is None and transport_error(e):
+                status = Status(599, exc=e, headers={})
+            breaker.record(circuit, time.time() - began, status)
+            raise
+        breaker.record(circuit, time.time() - began)
+        return data
+
+    def _hedged_request(self, req, process, callback, hedge):
+        """Perform a read, sending a duplicate if the first attempt is slow to respond"""
+        if not callback and is_relaxed():
+            return relaxed_task(lambda cb: self._hedged_request(req, process, cb, hedge))
+        hedge.budget.deposit()
+        race = adict(winner=None, pending=0, settled=[])
+        lock = threading.Lock()
+
+        def gate(attempt):
+            began = time.time()
+            def gated(data, status):
+                # the first response wins unless it's a server error and the other attempt
+                # might still succeed. only the winner's response gets processed
+                with lock:
+                    if attempt in race.settled:
+                        return data, status
+                    race.settled.append(attempt)
+                    race.pending -= 1
+                    if race.winner is None and (status.code < 500 or not race.pending):
+                        race.winner = attempt
+                hedge.record(time.time() - began)
+                if race.winner != attempt:
+                    return data, status
+                if attempt == 'hedge':
+                    hedge.stats.won += 1
+                if hasattr(process,'__call__'):
+                    data, status = process(data, status)
+                return data, status
+            race.pending += 1
+            return gated
+
+        if callback and hasattr(callback,'__call__'):
+            def send(attempt):
+                def response_ready(data, status):
+                    if race.winner == attempt:
+                        callback(data, status)
+                self._dispatch(req, gate(attempt), response_ready, stage=2)
+
+            def maybe_hedge():
+                if race.winner is None and race.pending == 1 and hedge.permit():
+                    send('hedge')
+            send('primary')
+            self.io.timeout(hedge.delay(), maybe_hedge)
+            return
+
+        # the blocking clients can only wait on one request at a time, so the attempts
+        # are sent from the policy's worker threads while the caller waits for a result
+        results = Queue.Queue()
+        def send(attempt):
+            gated = gate(attempt)
+            def finished(data, exc):
+                if exc is not None:
+                    status = getattr(exc, 'status', None)
+                    if status is None:
+                        status = Status(599, exc=exc, headers={})
+                    gated(None, status)
+                results.put((attempt, data, exc))
+            hedge.workers.submit(lambda: self._dispatch(req, gated, None, stage=2), finished)
+
+        send('primary')
+        try:
+            outcome = results.get(timeout=hedge.delay())
+        except Queue.Empty:
+            if hedge.permit():
+                send('hedge')
+            outcome = results.get()
+        while outcome[0] != race.winner:
+            outcome = results.get()
+        attempt, data, exc = outcome
+        if exc is not None:
+            raise exc
+        return data
+
+    def _routed_request(self, req, process, callback):
+        """Send a request to one of the cluster's nodes, keeping track of its load and health"""
+        cluster = self.cluster
+        if not callback and is_relaxed():
+            return relaxed_task(lambda cb: self._routed_request(req, process, cb))
+
+        node = cluster.pick(req['method'], req['url'])
+        req = dict(req, url=cluster.rebase(req['url'], node))
+        began = node.begin()
+        if callback and hasattr(callback,'__call__'):
+            def response_ready(data, status):
+                cluster.observe(node, began, status)
+                callback(data, status)
+            return self._dispatch(req, process, response_ready, stage=3)
+
+        try:
+            data = self._dispatch(req, process, None, stage=3)
+        except Exception, e:
+            status = getattr(e, 'status', None)
+            if status is None and transport_error(e):
+                status = Status(599, exc=e, headers={})
+            cluster.observe(node, began, status)
+            raise
+        cluster.observe(node, began)
+        return data
+
+    def _observed_request(self, req, process, callback):
+        """Perform a request while reporting its progress to the registered hooks"""
+        info = adict(method=req['method'], url=req['url'], template=url_template(req['url']),
+                     bytes_sent=int(req['headers'].get('Content-Length') or 0), 
+                     bytes_received=None, timings=None, started=time.time(),
+                     traceparent=req['headers'].get('traceparent'))
+        hooks.fire('on_request_start', info)
+
+        def observe(data, status):
+            if hasattr(process,'__call__'):
+                data, status = process(data, status)
+            report(status)
+            return data, status
+
+        def report(status):
+            info.bytes_received = status.get('wire_length') or status.get('length')
+            info.timings = status.get('timings') or client_timings()
+            info.timings.total = time.time() - info.started
+            hooks.fire('on_response' if status.ok else 'on_error', info, status)
+
+        if callback and hasattr(callback,'__call__'):
+            def response_ready(data, status):
+                data, status = observe(data, status)
+                callback(data, status)
+            return self.io.fetch(callback=response_ready, **req)
 
-    def _request_json(self, method, path=None, body=None, headers=None, callback=None, process=None, **params):
+        try:
+            return self.io.fetch(process=observe, **req)
+        except Exception, e:
+            # the blocking clients raise before the response reaches `observe`
+            status = getattr(e, 'status', None) or Status(599, exc=e, headers={})
+            report(status)
+            raise
+
+
+    def _request_json(self, method, path=None, body=None, headers=None, callback=None, process=None, 
+                            decode=None, **params):
         def preprocess(data, status):
+            timings = status.get('timings')
+            if timings is not None:
+                began = time.time()
             if data and status['headers'] and 'application/json' in status.headers.get('Content-Type'):
                 try:
-                    data = json.decode(data)
+                    data = (decode or json.decode)(data)
                 except TypeError:
                     pass # we didn't get a response at all
                 except ValueError:
                     pass # it wasn't valid json
+            if timings is not None:
+                decoded = time.time()
+                timings.decode = decoded - began
             if hasattr(process,'__call__'):
                 data, status = process(data, status) 
+            if timings is not None:
+                timings.construct = time.time() - decoded
             return data, status
 
         # for async calls, return value is a Request object
@@ -295,18 +1628,39 @@ class Resource(object):
         return self._request(method, path, body=body, headers=headers, 
                              process=preprocess, callback=callback, **params)
 
-def validate_response(resp, bail_on_error=False):
+def validate_response(resp, bail_on_error=False, stream=None):
+    timed = hooks or defaults.http.timings
+    if timed:
+        began = time.time()
     code = data = None
     try:
         code = resp.code
         data = resp.body
     except:
         code = resp.status_code
-        data = resp.content
+        if stream is None or code >= 400:
+            data = resp.content
     status = Status(code, headers=resp.headers)
 
+    # streamed bodies have already been written to their sink (unless the request
+    # failed, in which case the sink will have held onto the error message)
+    if stream is not None:
+        status.length = stream.length
+        try:
+            data = stream.finish() if code < 400 else stream.finish(ok=False) or data
+        except ServerError, e:
+            # a body that can't be unpacked is reported like any other bad response
+            code = status.code = 502
+            data = str(e)
+    else:
+        status.length = len(data) if data else 0
+    if resp.headers.get('Content-Encoding') == 'gzip':
+        # the clients decompress as the body arrives, but it's the compressed size
+        # that crossed the network
+        status.wire_length = int(resp.headers.get('Content-Length') or 0) or None
+
     m = re.search(r'charset=([^; ]+)', resp.headers.get('content-type',''))
-    if m:
+    if m and isinstance(data, basestring):
         data = data.decode(m.group(1))        
 
     # Handle errors
@@ -336,7 +1690,12 @@ def validate_response(resp, bail_on_error=False):
             status.error = HTTPError
             status.exception = HTTPError(exc_info)
 
+    if timed:
+        status.timings = client_timings(resp)
+        status.timings.validate = time.time() - began
+
     if bail_on_error and not status.ok:
+        status.exception.status = status
         raise status.exception
     return data, status
 
@@ -350,10 +1709,11 @@ class IO(object):
         return cls._instance    
 
             
-    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None, _i_n_t_e_r_c_e_p_t_=False):
+    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None, stream=None, _i_n_t_e_r_c_e_p_t_=False):
         self._client = self._client or TornadoClient() or RequestsClient()
         if not self._client:
             raise RuntimeError('Neither tornado nor requests is available.')
+        send = self._limited_fetch if defaults.http.limiter else self._client.fetch
             
         if is_relaxed() and not callback:
             # asynchronous fetch using the @relax decorator
@@ -364,9 +1724,41 @@ class IO(object):
                     return data, None
                 else:
                     raise status.exception
-            return self._client.async.gen.Task(self._client.fetch, method, url, data, headers, auth, process=just_the_facts)
+            return self._client.async.gen.Task(send, method, url, data, headers, auth, process=just_the_facts, stream=stream)
         else:
-            return self._client.fetch(method=method, url=url, data=data, headers=headers, auth=auth, process=process, callback=callback)
+            return send(method=method, url=url, data=data, headers=headers, auth=auth, process=process, callback=callback, stream=stream)
+
+    def _limited_fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None, stream=None):
+        """Send a request once its host's concurrency limit allows (queueing async requests
+        and blocking the calling thread for synchronous ones)"""
+        limiter = defaults.http.limiter
+        limit = limiter.host(url)
+        if hasattr(callback, '__call__'):
+            def start():
+                began = time.time()
+                def measured(data, status):
+                    limiter.release(limit, time.time() - began, status)
+                    return process(data, status) if process else (data, status)
+                self._client.fetch(method, url, data, headers, auth, process=measured, callback=callback, stream=stream)
+            return limiter.submit(limit, start)
+
+        limiter.acquire(limit)
+        began = time.time()
+        try:
+            data = self._client.fetch(method, url, data, headers, auth, process=process, stream=stream)
+        except Exception, e:
+            status = getattr(e, 'status', None)
+            if status is None and transport_error(e):
+                status = Status(599, exc=e, headers={})
+            limiter.release(limit, time.time() - began, status, blocking=True)
+            raise
+        limiter.release(limit, time.time() - began, blocking=True)
+        return data
+
+    def timeout(self, secs, callback):
+        """Schedule a callback on the async client's event loop"""
+        self._client = self._client or TornadoClient() or RequestsClient()
+        return self._client.timeout(secs, callback)
             
 
 class RequestsClient(object):
@@ -393,14 +1785,20 @@ class RequestsClient(object):
     def __len__(self):
         return 1 if self._ready else 0
 
-    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None):
+    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None, stream=None):
+        if not defaults.http.gzip:
+            headers['Accept-Encoding'] = 'identity' # requests asks for gzip by default
         req = dict(method=method, url=url, headers=headers, data=data,
                    auth=auth)
+        if stream is not None:
+            req['prefetch'] = False
         if hasattr(callback, '__call__'):
-            log(u"⌁ %4s %s"%(method, url))
+            log(u"⌁ %4s %s", method, url)
         
             def process_gevent_resp(resp):
-                data, status = validate_response(resp)
+                if stream is not None and resp.status_code < 400:
+                    stream.pump(resp)
+                data, status = validate_response(resp, stream=stream)
                 if process:
                     data, status = process(data, status)
                 if status:
@@ -412,9 +1810,11 @@ class RequestsClient(object):
             self.async.client.send(async_req)
             return async_req
         else:
-            log(u"✓ %4s %s"%(req['method'],req['url']))
+            log(u"✓ %4s %s", method, url)
             resp = self.blocking.client.request(**req)
-            data, status = validate_response(resp, bail_on_error=True)
+            if stream is not None and resp.status_code < 400:
+                stream.pump(resp)
+            data, status = validate_response(resp, bail_on_error=True, stream=stream)
             if process:
                 data, status = process(data, status)
             return data
@@ -449,7 +1849,10 @@ class TornadoClient(object):
         if any(m for m in sys.modules.keys() if m.startswith('tornado')):
             try:
                 from tornado import httpclient, ioloop, gen
-                self.blocking = adict(client=httpclient.HTTPClient(), request=httpclient.HTTPRequest, error=httpclient.HTTPError)
+                self.blocking = adict(client=httpclient.HTTPClient(), request=httpclient.HTTPRequest, error=httpclient.HTTPError,
+                                      factory=httpclient.HTTPClient)
+                self._local = threading.local()
+                self._local.client = self.blocking.client
                 self.async = adict(client=httpclient.AsyncHTTPClient(force_instance=True), request=httpclient.HTTPRequest, 
                                            loop=ioloop.IOLoop.instance(), gen=gen)
                 self._ready = True
@@ -467,23 +1870,29 @@ class TornadoClient(object):
     def __len__(self):
         return 1 if self._ready else 0
 
-    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None):
+    def fetch(self, method, url, data=None, headers=None, auth=None, process=None, callback=None, stream=None):
         if 'Content-Length' in headers:
             del headers['Content-Length'] # tornado mangles this if you include it. do they all?
     
         req = adict(method=method, url=url, headers=headers, allow_nonstandard_methods=True)
         if auth:
             req.auth_username, req.auth_password = auth
+        if hasattr(data, 'read'):
+            data = data.read() # tornado's HTTPRequest can only deal with bytestrings
         if data is not None:
             req.body = data
         req.request_timeout = defaults.http.timeout
+        req.use_gzip = bool(defaults.http.gzip)
+        if stream is not None:
+            req.streaming_callback = stream.write
+            req.header_callback = stream.header
 
         if hasattr(callback, '__call__'):
-            log(u"⌁ %4s %s"%(method, url))
+            log(u"⌁ %4s %s", method, url)
             async_req = self.async.request(**req)
         
             def process_tornado_resp(resp):
-                data, status = validate_response(resp)
+                data, status = validate_response(resp, stream=stream)
                 if process:
                     data, status = process(data, status)
                 if status:
@@ -493,18 +1902,30 @@ class TornadoClient(object):
             self.async.client.fetch(async_req, process_tornado_resp)
             return async_req
         else: 
-            log(u"✓ %4s %s"%(req['method'],req['url']))
+            log(u"✓ %4s %s", method, url)
             sync_req = self.blocking.request(**req)
             try:
-                resp = self.blocking.client.fetch(sync_req)
+                resp = self._blocking_client().fetch(sync_req)
             except self.blocking.error, e:
                 resp = e.response
-            
-            data, status = validate_response(resp, bail_on_error=True)
+                if resp is None:
+                    # the request never got a response (a refused connection, a timeout, etc.)
+                    status = Status(599, exc=ServerError(str(e)), headers={})
+                    status.exception.status = status
+                    raise status.exception
+
+            data, status = validate_response(resp, bail_on_error=True, stream=stream)
             if process:
                 data, status = process(data, status)
             return data
     
+    def _blocking_client(self):
+        # the blocking HTTPClient runs an IOLoop of its own, so each thread needs its own
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.blocking.factory()
+        return client
+
     def feed(self, endpoint, listener):
         def buffer_response(resp, buf=''):
             buf += resp
@@ -537,10 +1958,20 @@ class ChangesFeed(object):
         changesets will be passed.
 
         latency (float): the minimum time (in seconds) between invocations of the user callback.
+
+        last_heard (float): when the most recent change or heartbeat arrived (or None if
+        nothing has been heard since the connection was opened)
+
+        reconnect (bool): whether to reopen the connection (from the last seq seen) when
+        the server closes it, waiting a little longer after each consecutive failure
     """
-    def __init__(self, database, filter=None, heartbeat=60, since=0, latency=0.666, callback=None, **options):
+    def __init__(self, database, filter=None, heartbeat=60, since=0, latency=0.666, callback=None, 
+                       reconnect=False, **options):
         self.latency = latency # in seconds
         self.callback = callback
+        self.reconnect = reconnect
+        self.retries = 0
+        self._stopped = False
         self._timeout = None
         self._client = None
         self._changes = []
@@ -550,8 +1981,12 @@ class ChangesFeed(object):
         rsrc = database.resource('_changes')
         self.url = '%s/_changes'%rsrc.url
         self.auth = rsrc.credentials
+        if rsrc.cluster is not None:
+            # stay on one node so the sequence numbers stay meaningful
+            self.url = rsrc.cluster.rebase(self.url, rsrc.cluster.pinned())
         self.listening = False
         self.seq = since
+        self.last_heard = None
         params = dict(feed='continuous', heartbeat=heartbeat, filter=filter)
         params.update(options)
         if not filter: del params['filter']
@@ -562,6 +1997,7 @@ class ChangesFeed(object):
     
     def stop(self):
         """Close the connection to the server"""
+        self._stopped = True
         if not self.listening:
             print "already stopped"
             return
@@ -576,6 +2012,8 @@ class ChangesFeed(object):
             print "already listening"
             return
         self.listening=True
+        self._stopped = False
+        self.last_heard = None
         self._client = self._client or TornadoClient() or RequestsClient()
         # print "listen",self._client
         if not self._client:
@@ -590,11 +2028,16 @@ class ChangesFeed(object):
             self._readline(ln)
     
     def _response(self, ln):
+        self.last_heard = time.time() # heartbeats count too
+        self.retries = 0
         ln = ln.strip()
         if not ln: return
 
         changed = json.decode(ln)
-        if changed:
+        if changed and 'last_seq' in changed:
+            # the server is about to close the feed (e.g., because of a `timeout`)
+            self.seq = changed['last_seq']
+        elif changed:
             self.seq = changed.get('seq', self.seq)
             self._changes.append(changed)
             if not self._timeout:
@@ -607,7 +2050,16 @@ class ChangesFeed(object):
         
     def _closed(self, resp):
         self.listening=False
+        if self.reconnect and not self._stopped:
+            delay = min(60, 0.5 * 2**self.retries)
+            self.retries += 1
+            self._client.timeout(delay, self._reconnect)
+            return
         self._client=None
+
+    def _reconnect(self, _gevent_id=None):
+        if not (self._stopped or self.listening):
+            self.listen()
         # self._closed(resp)
         # print "connection closed itself",resp
 
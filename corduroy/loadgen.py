@@ -0,0 +1,357 @@
+# encoding: utf-8
+"""
+corduroy.loadgen
+
+Drives sustained traffic through Couch/Database and reports how much of it one
+process can handle.
+
+Usage:
+    python -m corduroy.loadgen get bulk_save               # against a fake server
+    python -m corduroy.loadgen -u http://127.0.0.1:5984 -b tornado -c 50 view
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import resource
+import threading
+import subprocess
+from optparse import OptionParser
+from .atoms import adict, odict
+from .config import json
+from .metrics import Histogram
+
+BACKENDS = ('blocking', 'tornado', 'gevent')
+
+
+class Workload(object):
+    """Base class for the operations a worker repeats.
+
+    Subclasses implement `request` (which must pass its callback along to the
+    Database method it calls) and `count` (which returns the number of docs a
+    response accounted for).
+    """
+    name = None
+
+    def __init__(self, db, ids, doc_size=1024, batch=100):
+        self.db = db
+        self.ids = ids
+        self.doc_size = doc_size
+        self.batch = batch
+
+    def doc(self):
+        return {'type':'loadgen', 'created':time.time(), 'payload':'x' * self.doc_size}
+
+    def request(self, callback=None):
+        raise NotImplementedError
+
+    def count(self, data):
+        return 1
+
+
+class Get(Workload):
+    """fetch a random doc"""
+    name = 'get'
+    def request(self, callback=None):
+        return self.db.get(random.choice(self.ids), callback=callback)
+
+class BulkGet(Workload):
+    """fetch `batch` random docs at once"""
+    name = 'bulk_get'
+    def request(self, callback=None):
+        return self.db.get(random.sample(self.ids, min(self.batch, len(self.ids))), callback=callback)
+
+    def count(self, data):
+        return len(data)
+
+class Save(Workload):
+    """create a doc"""
+    name = 'save'
+    def request(self, callback=None):
+        return self.db.save(self.doc(), callback=callback)
+
+class BulkSave(Workload):
+    """create `batch` docs at once"""
+    name = 'bulk_save'
+    def request(self, callback=None):
+        return self.db.save([self.doc() for i in xrange(self.batch)], callback=callback)
+
+    def count(self, data):
+        return len(data.resolved)
+
+class ViewScan(Workload):
+    """read `batch` rows (with docs) from a random point in a view"""
+    name = 'view'
+    def request(self, callback=None):
+        return self.db.view('loadgen/by_id', startkey=random.choice(self.ids), limit=self.batch,
+                            include_docs=True, callback=callback)
+
+    def count(self, data):
+        return len(data)
+
+class Changes(Workload):
+    """page through the changes feed `batch` entries at a time (starting over at the end)"""
+    name = 'changes'
+    def __init__(self, *args, **kwargs):
+        super(Changes, self).__init__(*args, **kwargs)
+        self.since = 0
+
+    def request(self, callback=None):
+        return self.db.changes(since=self.since, limit=self.batch, callback=callback)
+
+    def count(self, data):
+        results = data['results']
+        self.since = data['last_seq'] if results else 0
+        return len(results)
+
+WORKLOADS = odict((w.name, w) for w in (Get, BulkGet, Save, BulkSave, ViewScan, Changes))
+
+
+def prepare(db, count, doc_size=1024, python_views=False):
+    """Fill a database with `count` docs and a view over them, returning the doc ids"""
+    ids = []
+    payload = 'x' * doc_size
+    for start in xrange(0, count, 1000):
+        docs = [{'_id':'load-%08i' % i, 'type':'loadgen', 'payload':payload}
+                for i in xrange(start, min(start+1000, count))]
+        db.save(docs)
+        ids.extend(d['_id'] for d in docs)
+    if python_views:
+        by_id = "def fun(doc):\n    yield doc['_id'], None"
+    else:
+        by_id = "function(doc){ emit(doc._id, null) }"
+    db.save({'_id':'_design/loadgen', 'views':{'by_id':{'map':by_id}}})
+    db.view('loadgen/by_id', limit=1) # build the index before the clock starts
+    return ids
+
+
+class Tally(object):
+    """Latencies and counts shared by all the workers"""
+    def __init__(self):
+        self.latency = Histogram()
+        self.ops = 0
+        self.docs = 0
+        self.errors = odict()
+        self._lock = threading.Lock()
+
+    def success(self, began, docs):
+        with self._lock:
+            self.latency.record(time.time() - began)
+            self.ops += 1
+            self.docs += docs
+
+    def failure(self, began, exc):
+        with self._lock:
+            self.latency.record(time.time() - began)
+            name = type(exc).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def drive_blocking(workload, tally, concurrency, deadline, spawn, join):
+    def worker():
+        while time.time() < deadline:
+            began = time.time()
+            try:
+                data = workload.request()
+            except Exception, e:
+                tally.failure(began, e)
+            else:
+                tally.success(began, workload.count(data))
+    workers = [spawn(worker) for i in xrange(concurrency)]
+    for w in workers:
+        join(w)
+
+def drive_threads(workload, tally, concurrency, deadline):
+    def spawn(func):
+        t = threading.Thread(target=func)
+        t.daemon = True
+        t.start()
+        return t
+    drive_blocking(workload, tally, concurrency, deadline, spawn, lambda t: t.join())
+
+def drive_gevent(workload, tally, concurrency, deadline):
+    import gevent
+    drive_blocking(workload, tally, concurrency, deadline, gevent.spawn, lambda g: g.join())
+
+def drive_tornado(workload, tally, concurrency, deadline):
+    from tornado import ioloop
+    loop = ioloop.IOLoop.instance()
+    running = [concurrency]
+
+    def issue():
+        if time.time() >= deadline:
+            running[0] -= 1
+            if not running[0]:
+                loop.stop()
+            return
+        began = time.time()
+        def done(data, status=None):
+            if status is not None and not status.ok:
+                tally.failure(began, status.exception)
+            else:
+                tally.success(began, workload.count(data))
+            loop.add_callback(issue)
+        try:
+            workload.request(callback=done)
+        except Exception, e:
+            tally.failure(began, e)
+            loop.add_callback(issue)
+
+    for i in xrange(concurrency):
+        loop.add_callback(issue)
+    loop.start()
+
+DRIVERS = dict(blocking=drive_threads, tornado=drive_tornado, gevent=drive_gevent)
+
+
+def run(db, name, ids, backend='blocking', concurrency=10, duration=10, doc_size=1024, batch=100):
+    """Run a single workload for `duration` seconds and summarize the results.
+
+    Args:
+        db (Database): the (prepared) database to send requests to
+
+        name (str): one of 'get', 'bulk_get', 'save', 'bulk_save', 'view', or 'changes'
+
+        ids (list): the ids of the docs that read workloads choose from
+
+    Kwargs:
+        backend (str): 'blocking' (a thread per worker), 'tornado' (callbacks on the
+        IOLoop), or 'gevent' (a greenlet per worker)
+
+        concurrency (int): the number of requests to keep in flight
+
+        duration (float): seconds to run for
+
+        doc_size (int): the size (in bytes) of each new doc's payload
+
+        batch (int): docs per bulk request, rows per view scan, or changes per page
+
+    Returns:
+        dict. Throughput, latency percentiles, CPU time per request, and peak RSS.
+    """
+    workload = WORKLOADS[name](db, ids, doc_size=doc_size, batch=batch)
+    tally = Tally()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    began = time.time()
+    DRIVERS[backend](workload, tally, concurrency, began + duration)
+    elapsed = time.time() - began
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    requests = tally.latency.count
+    rss_scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in kb on linux
+    latency = tally.latency.snapshot()
+    return dict(workload=name, backend=backend, concurrency=concurrency, duration=elapsed,
+                requests=requests, ops=tally.ops, docs=tally.docs, errors=dict(tally.errors),
+                ops_per_sec=tally.ops/elapsed, docs_per_sec=tally.docs/elapsed,
+                latency=latency, cpu=cpu, cpu_per_request=cpu/requests if requests else None,
+                cpu_utilization=cpu/elapsed, peak_rss=after.ru_maxrss * rss_scale)
+
+
+def spawn_fake(latency=0):
+    """Start a fake server in a subprocess (so its cpu time isn't billed to the client)"""
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    proc = subprocess.Popen([sys.executable, '-m', 'corduroy.fakecouch', '-l', str(latency), str(port)],
+                            env=env, stdout=subprocess.PIPE)
+    for i in xrange(200):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            break
+        except socket.error:
+            if proc.poll() is not None:
+                raise RuntimeError('the fake server failed to start')
+            time.sleep(0.05)
+    return proc, 'http://127.0.0.1:%i' % port
+
+
+def _ms(secs):
+    return '%.2f' % (secs*1e3) if secs is not None else '-'
+
+def format_report(report):
+    lat = report['latency']
+    lines = ['%s × %i (%s): %i requests in %.1fs' % (report['workload'], report['concurrency'],
+             report['backend'], report['requests'], report['duration']),
+             '  throughput  %9.1f req/s  %10.1f docs/s' % (report['ops_per_sec'], report['docs_per_sec']),
+             '  latency ms  p50 %s  p90 %s  p99 %s  p99.9 %s  max %s' % (_ms(lat['p50']), _ms(lat['p90']),
+             _ms(lat['p99']), _ms(lat['p999']), _ms(lat['max'])),
+             '  cpu         %s ms/req  (%.0f%% of one core)' % (_ms(report['cpu_per_request']),
+             report['cpu_utilization']*100),
+             '  peak rss    %.1f MB' % (report['peak_rss'] / 1048576.0)]
+    if report['errors']:
+        lines.append('  errors      %s' % ', '.join('%s: %i' % e for e in report['errors'].items()))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m corduroy.loadgen [options] workload...\n\nworkloads:\n' +
+                          '\n'.join('  %-10s %s' % (n, w.__doc__) for n, w in WORKLOADS.items()))
+    parser.add_option('-u', '--url', help='the server to load (a fake one is started by default)')
+    parser.add_option('-d', '--db', default='corduroy_loadgen', help='database name [%default]')
+    parser.add_option('-b', '--backend', choices=BACKENDS, default='blocking',
+                      help='blocking, tornado, or gevent [%default]')
+    parser.add_option('-c', '--concurrency', type='int', default=10, help='requests in flight [%default]')
+    parser.add_option('-t', '--duration', type='float', default=10, help='seconds per workload [%default]')
+    parser.add_option('-s', '--doc-size', type='int', default=1024, help='payload bytes per doc [%default]')
+    parser.add_option('-n', '--batch', type='int', default=100,
+                      help='docs per bulk request, rows per view scan, changes per page [%default]')
+    parser.add_option('--docs', type='int', default=10000, help='docs to preload [%default]')
+    parser.add_option('--latency', type='float', default=0, help='the fake server\'s response delay')
+    parser.add_option('--json', action='store_true', help='print the reports as json')
+    parser.add_option('--keep', action='store_true', help='leave the database behind afterwards')
+    opts, names = parser.parse_args(argv)
+    unknown = [n for n in names if n not in WORKLOADS]
+    if not names or unknown:
+        parser.error('choose from the workloads: %s' % ', '.join(WORKLOADS))
+
+    # the backend has to be in place before the first request picks an http client
+    try:
+        if opts.backend == 'gevent':
+            from gevent import monkey
+            monkey.patch_all()
+        elif opts.backend == 'tornado':
+            import tornado.httpclient
+    except ImportError:
+        parser.error('the %s backend requires the %s module' % (opts.backend, opts.backend))
+
+    fake, url = None, opts.url
+    if url is None:
+        fake, url = spawn_fake(opts.latency)
+    try:
+        from .couchdb import Couch
+        couch = Couch(url)
+        if opts.db in couch:
+            couch.delete(opts.db)
+        db = couch.create(opts.db)
+        ids = prepare(db, opts.docs, opts.doc_size, python_views=fake is not None)
+        reports = []
+        for name in names:
+            report = run(db, name, ids, backend=opts.backend, concurrency=opts.concurrency,
+                         duration=opts.duration, doc_size=opts.doc_size, batch=opts.batch)
+            reports.append(report)
+            if not opts.json:
+                print format_report(report)
+                sys.stdout.flush()
+        if opts.json:
+            print json.encode(reports, indent=2)
+        if not opts.keep:
+            couch.delete(opts.db)
+    finally:
+        if fake is not None:
+            # interrupting the fake lets it close its connections and stop cleanly
+            fake.send_signal(signal.SIGINT)
+            fake.wait()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
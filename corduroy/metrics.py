@@ -0,0 +1,320 @@
+# encoding: utf-8
+"""
+corduroy.metrics
+
+Keeping score: latency histograms and counters fed by the request hooks.
+"""
+
+from __future__ import with_statement
+import time
+import random
+import logging
+from array import array
+from collections import deque
+from urllib import unquote
+from urlparse import urlsplit
+from .atoms import adict, odict
+from .config import json
+from .io import hooks
+
+class Histogram(object):
+    """A fixed-size histogram of durations with HDR-style log-linear buckets.
+
+    Values are recorded in microseconds into buckets whose width grows with their
+    magnitude, so every recorded value is known to within ~3% no matter how many
+    samples are taken. Memory use is constant (~4k bytes).
+    """
+    SUB_BUCKETS = 32 # per power of two (5 significant bits)
+    MAX_SHIFT = 32   # values beyond 2**37 µs (~38 hours) are clamped
+
+    def __init__(self):
+        half = self.SUB_BUCKETS // 2
+        self._counts = array('l', [0]*(self.SUB_BUCKETS + self.MAX_SHIFT*half))
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, usec):
+        if usec < self.SUB_BUCKETS:
+            return usec
+        shift = min(usec.bit_length() - self.SUB_BUCKETS.bit_length() + 1, self.MAX_SHIFT)
+        half = self.SUB_BUCKETS // 2
+        sub = min(usec >> shift, self.SUB_BUCKETS-1)
+        return self.SUB_BUCKETS + (shift-1)*half + (sub-half)
+
+    def _value(self, index):
+        """The midpoint of a bucket (in µs)"""
+        if index < self.SUB_BUCKETS:
+            return index
+        half = self.SUB_BUCKETS // 2
+        shift, sub = divmod(index - self.SUB_BUCKETS, half)
+        shift += 1
+        return ((sub + half) << shift) + (1 << shift) // 2
+
+    def record(self, seconds):
+        """Add a duration (in seconds) to the histogram"""
+        usec = max(int(seconds * 1e6), 0)
+        self._counts[self._index(usec)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, pct):
+        """Return the duration (in seconds) below which `pct` percent of samples fall"""
+        if not self.count:
+            return None
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if n and seen >= threshold:
+                return min(max(self._value(index) / 1e6, self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        """Fold the samples from another histogram into this one"""
+        for index, n in enumerate(other._counts):
+            self._counts[index] += n
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            theirs, ours = getattr(other, attr), getattr(self, attr)
+            if theirs is not None:
+                setattr(self, attr, theirs if ours is None else pick(ours, theirs))
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """Return a summary of the histogram as a plain dict"""
+        snap = dict(count=self.count, sum=self.total, min=self.min, max=self.max,
+                    mean=self.total/self.count if self.count else None)
+        for pct in percentiles:
+            snap['p%s' % ('%g' % pct).replace('.', '')] = self.percentile(pct)
+        return snap
+
+
+def operation(method, template):
+    """Classify a request by what it does to the database (e.g. 'doc.get' or 'view')"""
+    parts = template.split('/')
+    if '_view' in parts or template.endswith('/_all_docs'):
+        return 'view'
+    if template.endswith('/_changes'):
+        return 'changes'
+    if template.endswith('/_bulk_docs'):
+        return 'bulk_docs'
+    if template in ('/{db}/{doc}', '/{db}/_design/{ddoc}', '/{db}/_local/{doc}'):
+        return 'doc.%s' % method.lower()
+    if template.endswith('/{attachment}'):
+        return 'attachment.%s' % method.lower()
+    return '%s %s' % (method, template)
+
+
+class Metrics(object):
+    """Aggregates request timings and outcomes reported through corduroy.hooks.
+
+    Durations are grouped by operation (`doc.get`, `bulk_docs`, `view`, `changes`,
+    etc.) and database name. The time spent in each phase of a request (`transfer`,
+    `validate`, `decode`, and `construct`) is also tracked per operation, which shows
+    whether a slow view is waiting on the server or on json parsing and object
+    construction. Counters track the bytes sent and received, retries, conflicted 
+    docs, and errors (by exception class), and the state of any circuit breakers is
+    kept in `circuits`.
+
+    Usage:
+        metrics = Metrics().install()
+        ...
+        print metrics.prometheus()
+    """
+    phases = ('transfer', 'validate', 'decode', 'construct')
+
+    def __init__(self):
+        self.latency = odict()
+        self.breakdown = odict()
+        self.counters = adict(requests=0, bytes_sent=0, bytes_received=0, retries=0, conflicts=0,
+                              circuit_rejections=0, circuit_trips=0)
+        self.errors = odict()
+        self.circuits = odict()
+
+    def install(self):
+        """Start collecting metrics from every request"""
+        hooks.register(self)
+        return self
+
+    def uninstall(self):
+        hooks.unregister(self)
+        return self
+
+    def reset(self):
+        self.__init__()
+
+    def histogram(self, op, db=None):
+        key = (op, db)
+        if key not in self.latency:
+            self.latency[key] = Histogram()
+        return self.latency[key]
+
+    def on_response(self, request, status):
+        self._tally(request)
+
+    def on_error(self, request, status):
+        self._tally(request)
+        name = status.error.__name__ if status.error else 'HTTPError'
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if name == 'Conflict':
+            self.counters.conflicts += 1
+
+    def on_retry(self, request, status):
+        self.counters.retries += 1
+
+    def on_conflict(self, resolution):
+        self.counters.conflicts += len(resolution.pending)
+
+    def on_circuit(self, circuit, event):
+        if event == 'rejected':
+            self.counters.circuit_rejections += 1
+        elif event == 'open':
+            self.counters.circuit_trips += 1
+        self.circuits[circuit.key] = circuit.state
+
+    def _tally(self, request):
+        self.counters.requests += 1
+        self.counters.bytes_sent += request.bytes_sent or 0
+        self.counters.bytes_received += request.bytes_received or 0
+        db = None
+        if request.template.startswith('/{db}'):
+            db = unquote(urlsplit(request.url).path.split('/')[1])
+        op = operation(request.method, request.template)
+        timings = request.timings
+        self.histogram(op, db).record(timings.total)
+        for phase in self.phases:
+            if timings.get(phase) is not None:
+                if (op, phase) not in self.breakdown:
+                    self.breakdown[(op, phase)] = Histogram()
+                self.breakdown[(op, phase)].record(timings[phase])
+
+    def snapshot(self):
+        """Return the current metrics as plain dicts and lists"""
+        latency = [dict(operation=op, db=db, **hist.snapshot()) for (op, db), hist in self.latency.items()]
+        phases = [dict(operation=op, phase=phase, **hist.snapshot()) for (op, phase), hist in self.breakdown.items()]
+        return dict(latency=latency, phases=phases, counters=dict(self.counters), errors=dict(self.errors),
+                    circuits=dict(self.circuits))
+
+    def prometheus(self, prefix='corduroy'):
+        """Render the current metrics in the Prometheus text exposition format"""
+        def labels(**pairs):
+            pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                     for k, v in sorted(pairs.items()) if v is not None]
+            return '{%s}' % ','.join(pairs) if pairs else ''
+
+        lines = ['# TYPE %s_request_seconds summary' % prefix]
+        for (op, db), hist in self.latency.items():
+            for q in (0.5, 0.9, 0.99, 0.999):
+                lines.append('%s_request_seconds%s %r' % (prefix, labels(operation=op, db=db, quantile=q),
+                                                          hist.percentile(q*100)))
+            lines.append('%s_request_seconds_sum%s %r' % (prefix, labels(operation=op, db=db), hist.total))
+            lines.append('%s_request_seconds_count%s %i' % (prefix, labels(operation=op, db=db), hist.count))
+        lines.append('# TYPE %s_phase_seconds summary' % prefix)
+        for (op, phase), hist in self.breakdown.items():
+            for q in (0.5, 0.9, 0.99):
+                lines.append('%s_phase_seconds%s %r' % (prefix, labels(operation=op, phase=phase, quantile=q),
+                                                        hist.percentile(q*100)))
+            lines.append('%s_phase_seconds_sum%s %r' % (prefix, labels(operation=op, phase=phase), hist.total))
+            lines.append('%s_phase_seconds_count%s %i' % (prefix, labels(operation=op, phase=phase), hist.count))
+        for name, value in self.counters.items():
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %i' % (prefix, name, value))
+        lines.append('# TYPE %s_errors_total counter' % prefix)
+        for name, value in self.errors.items():
+            lines.append('%s_errors_total%s %i' % (prefix, labels(error=name), value))
+        lines.append('# TYPE %s_circuit_state gauge' % prefix)
+        for key, state in self.circuits.items():
+            lines.append('%s_circuit_state%s %i' % (prefix, labels(circuit=key), 
+                                                     ('closed', 'half_open', 'open').index(state)))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestLog(object):
+    """Base class for listeners that keep a ring buffer of request records"""
+    def __init__(self, size=1000):
+        self.records = deque(maxlen=size)
+
+    def install(self):
+        hooks.register(self)
+        return self
+
+    def uninstall(self):
+        hooks.unregister(self)
+        return self
+
+    def on_response(self, request, status):
+        if self.wanted(request, status):
+            self.record(request, status)
+
+    on_error = on_response
+
+    def wanted(self, request, status):
+        raise NotImplementedError
+
+    def record(self, request, status):
+        entry = dict(method=request.method, url=request.url, template=request.template,
+                     code=status.code, bytes_sent=request.bytes_sent, 
+                     bytes_received=request.bytes_received, started=request.started,
+                     timings=dict(request.timings), traceparent=request.traceparent)
+        self.records.append(entry)
+        return entry
+
+    def dump(self, path=None):
+        """Return the buffered records (oldest first), optionally writing them to a file as 
+        json (one record per line)"""
+        records = list(self.records)
+        if path:
+            with file(path, 'w') as f:
+                for entry in records:
+                    f.write(json.encode(entry).encode('utf-8') + '\n')
+        return records
+
+    def clear(self):
+        self.records.clear()
+
+
+class SlowLog(RequestLog):
+    """Keeps (and logs) the details of every request that takes longer than `threshold`.
+
+    Records include the url, request and response sizes, status code, traceparent,
+    and timing breakdown. Each one is also logged as a warning to the `corduroy.slow`
+    logger.
+    """
+    def __init__(self, threshold=1.0, size=100):
+        """Kwargs:
+            threshold (float): the duration (in seconds) above which requests are recorded
+
+            size (int): the number of slow requests to hold onto
+        """
+        super(SlowLog, self).__init__(size)
+        self.threshold = threshold
+        self._logger = logging.getLogger('corduroy.slow')
+
+    def wanted(self, request, status):
+        return request.timings.total >= self.threshold
+
+    def record(self, request, status):
+        entry = super(SlowLog, self).record(request, status)
+        self._logger.warning('%.3fs %s %s [%s] sent=%s received=%s', request.timings.total, 
+                             request.method, request.url, status.code, request.bytes_sent,
+                             request.bytes_received)
+        return entry
+
+
+class Sampler(RequestLog):
+    """Captures a random fraction of all requests into a ring buffer for later inspection"""
+    def __init__(self, rate=0.01, size=1000):
+        """Kwargs:
+            rate (float): the fraction of requests to record (between 0 and 1)
+
+            size (int): the number of samples to hold onto
+        """
+        super(Sampler, self).__init__(size)
+        self.rate = rate
+
+    def wanted(self, request, status):
+        return random.random() < self.rate
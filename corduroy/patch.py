@@ -0,0 +1,238 @@
+# encoding: utf-8
+"""
+corduroy.patch
+
+Partial-document updates sent through a generic server-side update handler (so only
+the changed fields cross the network), with patches to the same doc coalesced into a
+single request.
+"""
+
+from __future__ import with_statement
+import time
+import threading
+from .atoms import Status, adict, odict
+from .exceptions import NotFound, Conflict, ServerError
+from .config import json
+
+DESIGN_DOC = '_design/corduroy'
+HANDLER = 'corduroy/patch'
+
+# the handler applies a json object of fields to the doc named in the url (creating it
+# if need be) and only writes a new revision if one of the values actually changed
+HANDLERS = {
+    'javascript':"""function(doc, req){
+  var fields = JSON.parse(req.body), changed = false;
+  if (!doc){
+    doc = {_id:req.id};
+    changed = true;
+  }
+  for (var key in fields){
+    if (JSON.stringify(doc[key]) !== JSON.stringify(fields[key])){
+      doc[key] = fields[key];
+      changed = true;
+    }
+  }
+  return [changed ? doc : null, {json:{ok:true, id:doc._id, rev:doc._rev || null}}];
+}""",
+
+    'python':"""def fun(doc, req):
+    import json
+    fields = json.loads(req['body'])
+    changed = doc is None
+    if changed:
+        doc = {'_id':req['id']}
+    for key, val in fields.items():
+        if key not in doc or doc[key] != val:
+            doc[key] = val
+            changed = True
+    return (doc if changed else None), {'json':{'ok':True, 'id':doc['_id'], 'rev':doc.get('_rev')}}
+""",
+}
+
+class PatchQueue(object):
+    """Collects the partial updates made with `Database.patch` and sends them through a
+    generic update handler (`_design/corduroy/_update/patch`). The design doc is created
+    the first time the server reports the handler missing.
+
+    Patches to the same doc that arrive within `window` seconds of the first are merged
+    (with later values for a field winning) and sent as a single request whose result is
+    shared by all of their callers. Blocking callers wait out the window in their own
+    thread while async callers are flushed by a timer on the event loop (the two kinds of
+    caller are batched separately, since a blocking caller could otherwise end up waiting
+    on a timer that the event loop it's blocking will never run). Update handlers
+    read the doc's current revision on the server, so a patch is only retried (up to
+    `retries` times) if another write sneaks in between that read and its own write.
+
+    Attributes:
+        stats (dict): counts of the `patches` received, the `requests` sent, the patches
+        that were `coalesced` into another's request, the `conflicts` retried, and the
+        number of times the handler was `installed`
+
+    Usage:
+        db = Database('hot', patches=PatchQueue(window=0.02))
+        db.patch('counter', {'total':41, 'updated':'2012-10-19'})
+    """
+    def __init__(self, window=0.01, language='javascript', retries=3, timeout=60):
+        """Kwargs:
+            window (float): seconds to hold a patch while waiting for others to the same
+            doc (or 0 to send each one immediately)
+
+            language (str): the language to write the update handler in, either
+            'javascript' or 'python' (for corduroy.fakecouch or a python query server)
+
+            retries (int): the number of times to resend a patch that hit a conflict
+
+            timeout (float): the longest a blocking caller will wait for a patch that
+            another thread is sending before raising a ServerError
+        """
+        if language not in HANDLERS:
+            raise ValueError('unknown update handler language: %r' % language)
+        self.window = window
+        self.language = language
+        self.retries = retries
+        self.timeout = timeout
+        self.stats = adict(patches=0, requests=0, coalesced=0, conflicts=0, installed=0)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<PatchQueue %s (%i pending)>' % (self.language, len(self._pending))
+
+    def patch(self, db, doc_id, fields, callback=None):
+        """Queue up a set of field values for a doc and return the handler's response (or
+        pass it to the callback) once they've been written"""
+        key = (db.resource.url, doc_id, bool(callback))
+        with self._lock:
+            self.stats.patches += 1
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = adict(fields=odict(), callbacks=[], outcome=None,
+                                                   done=threading.Event())
+            else:
+                self.stats.coalesced += 1
+            batch.fields.update(fields)
+            if callback:
+                batch.callbacks.append(callback)
+
+        if callback:
+            if leader:
+                flush = lambda: self._flush(db, key, batch, async=True)
+                if self.window:
+                    db.resource.io.timeout(self.window, flush)
+                else:
+                    flush()
+            return
+
+        if leader:
+            if self.window:
+                time.sleep(self.window)
+            self._flush(db, key, batch)
+        elif not batch.done.wait(self.timeout):
+            status = Status(599, exc=ServerError('timed out waiting for a patch to %s' % doc_id), headers={})
+            status.exception.status = status
+            raise status.exception
+        data, status = batch.outcome
+        if not status.ok:
+            raise status.exception
+        return data
+
+    def install(self, db, callback=None):
+        """Add the patch handler to the database's `_design/corduroy` doc (creating it if
+        need be). Raises ValueError if the design doc already exists but is written in a
+        different language than the queue's."""
+        self.stats.installed += 1
+        def updated(ddoc):
+            if ddoc is None:
+                ddoc = {'_id':DESIGN_DOC, 'language':self.language}
+            elif ddoc.get('language', 'javascript') != self.language:
+                # the other functions in the ddoc would stop working if it changed
+                raise ValueError('%s is written in %s, not %s' % (DESIGN_DOC,
+                                 ddoc.get('language', 'javascript'), self.language))
+            ddoc = dict(ddoc)
+            ddoc['updates'] = dict(ddoc.get('updates') or {}, patch=HANDLERS[self.language])
+            return ddoc
+
+        # a conflict just means another client installed the handler first
+        if callback:
+            def saved(data, status):
+                callback(data, Status(200, headers={}) if status.error is Conflict else status)
+            def fetched(data, status):
+                if not status.ok and status.error is not NotFound:
+                    return callback(None, status)
+                try:
+                    ddoc = updated(data if status.ok else None)
+                except ValueError, e:
+                    return callback(None, Status(400, exc=e, headers={}))
+                db.save(ddoc, callback=saved)
+            return db.get(DESIGN_DOC, callback=fetched)
+
+        try:
+            ddoc = db.get(DESIGN_DOC)
+        except NotFound:
+            ddoc = None
+        try:
+            return db.save(updated(ddoc))
+        except Conflict:
+            pass
+
+    def _flush(self, db, key, batch, async=False):
+        with self._lock:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            fields = json.encode(batch.fields)
+
+        def finished(data, status):
+            batch.outcome = data, status
+            batch.done.set()
+            for callback in batch.callbacks:
+                callback(data, status)
+
+        if async:
+            return self._send(db, key[1], fields, finished)
+        try:
+            data, status = self._send(db, key[1], fields), Status(200, headers={})
+        except Exception, e:
+            data, status = None, getattr(e, 'status', None) or Status(599, exc=e, headers={})
+        finished(data, status)
+
+    def _send(self, db, doc_id, fields, callback=None, attempt=0, installed=False):
+        self.stats.requests += 1
+        if callback:
+            def sent(data, status):
+                if status.error is NotFound and not installed:
+                    def resend(data, status):
+                        if not status.ok:
+                            return callback(None, status)
+                        self._send(db, doc_id, fields, callback, attempt, True)
+                    return self.install(db, callback=resend)
+                if status.error is Conflict and attempt < self.retries:
+                    self.stats.conflicts += 1
+                    return self._send(db, doc_id, fields, callback, attempt+1, installed)
+                callback(data, status)
+            return db.update(HANDLER, doc_id, body=fields, process=_patched, callback=sent)
+
+        while True:
+            try:
+                return db.update(HANDLER, doc_id, body=fields, process=_patched)
+            except NotFound:
+                if installed:
+                    raise
+                self.install(db)
+                installed = True
+            except Conflict:
+                if attempt >= self.retries:
+                    raise
+                self.stats.conflicts += 1
+                attempt += 1
+            self.stats.requests += 1
+
+def _patched(data, status):
+    """Unpack the handler's response, taking the new _rev from the headers if it wrote one"""
+    if not status.ok:
+        return data, status
+    result = adict(json.decode(data)) if data else adict(ok=True, id=None, rev=None)
+    headers = status.headers or {}
+    result.id = headers.get('X-Couch-Id') or result.get('id')
+    result.rev = headers.get('X-Couch-Update-NewRev') or result.get('rev')
+    return result, status
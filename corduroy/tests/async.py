@@ -740,6 +740,28 @@ class AsyncDatabaseTestCase(AsyncTestCase):
         new_doc = self.db['foo']
         self.assertEqual(None, new_doc.get('_attachments'))
 
+
+    def test_attachment_stream(self):
+        doc = {}
+        self.db['foo'] = doc
+        content = 'Foo bar baz\n' * 10000
+        self.db.put_attachment(doc, content, 'foo.txt', 'text/plain')
+
+        self.db.get_attachment(doc, 'foo.txt', stream=True, callback=self.stop)
+        attfile, status = self.wait()
+        self.assertEqual(content, attfile.read())
+
+        sink = StringIO()
+        self.db.get_attachment('foo', 'foo.txt', stream=sink, callback=self.stop)
+        attfile, status = self.wait()
+        self.assertTrue(attfile is sink)
+        self.assertEqual(content, sink.getvalue())
+
+        sink = StringIO()
+        self.db.get_attachment(doc, 'missing.txt', stream=sink, callback=self.stop)
+        attfile, status = self.wait()
+        self.assertTrue(status.error is NotFound)
+        self.assertEqual('', sink.getvalue())
     
     def test_empty_attachment(self):
         doc = {}
@@ -962,6 +984,64 @@ class AsyncDatabaseTestCase(AsyncTestCase):
         self.assertEqual(last_change['seq'], half*2)
         listener._feed.stop()
 
+    def test_doc_cache_follows_changes(self):
+        self.db['foo'] = {'a': 1}
+        db = Database(self.db.resource, cache='changes')
+
+        db.get('foo', callback=self.stop)
+        doc, status = self.wait()
+
+        # the cache isn't trusted until the feed has been heard from
+        self.assertFalse(db.cache.trusted())
+        self.db['bar'] = {'b': 1}
+        self.io_loop.add_timeout(timedelta(seconds=0.5), self.stop)
+        self.wait()
+        self.assertTrue(db.cache.trusted())
+        db.get('foo', callback=self.stop)
+        cached, status = self.wait()
+        self.assertEqual(doc, cached)
+        self.assertEqual(1, db.cache.stats.hits)
+        self.assertEqual(0, db.cache.stats.revalidations)
+
+        # writes from elsewhere get evicted once the feed catches up
+        other = self.db['foo']
+        other['a'] = 2
+        self.db.save(other)
+        self.io_loop.add_timeout(timedelta(seconds=1.5), self.stop)
+        self.wait()
+        self.assertEqual(1, db.cache.stats.invalidations)
+        db.get('foo', callback=self.stop)
+        doc, status = self.wait()
+        self.assertEqual(2, doc['a'])
+
+        # writes through the same db are visible immediately
+        doc['a'] = 3
+        db.save(doc)
+        db.get('foo', callback=self.stop)
+        doc, status = self.wait()
+        self.assertEqual(3, doc['a'])
+        
+        # reads demanding a later seq than the feed has seen go to the server
+        self.assertTrue(db.cache.trusted())
+        self.assertFalse(db.cache.trusted(min_seq=db.cache.seq+100))
+        db.get('foo', min_seq=db.cache.seq+100, callback=self.stop)
+        doc, status = self.wait()
+        self.assertEqual(3, doc['a'])
+        db.cache.unfollow()
+
+    def test_cached_callbacks_are_deferred(self):
+        db = Database(self.db.resource, missing_cache=True)
+        db.get('nope', callback=self.stop)
+        doc, status = self.wait()
+        self.assertEqual(404, status.code)
+
+        # answers from the cache still arrive on a later pass through the loop
+        answered = []
+        db.get('nope', callback=lambda doc, status: (answered.append(status.code), self.stop()))
+        self.assertEqual([], answered)
+        self.wait()
+        self.assertEqual([404], answered)
+
     def test_purge(self):
         doc = {'a': 'b'}
         self.db['foo'] = doc
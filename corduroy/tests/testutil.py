@@ -4,10 +4,17 @@
 corduroy.tests.testutil
 """
 
+import os
 import random
 import sys
 from corduroy import *
 
+# set CORDUROY_FAKE=1 to run the suite against an in-memory server rather than a real
+# couch on localhost:5984 (tests that rely on javascript functions will error out)
+fake_couch = None
+if os.environ.get('CORDUROY_FAKE'):
+    from corduroy.fakecouch import FakeCouch
+    fake_couch = FakeCouch().start().install()
     
 # from couchdb-python
 class TempDatabaseMixin(object):
@@ -10,7 +10,7 @@ setup(
     version=VERSION,
     author='Christian Swinehart',
     author_email='drafting@samizdat.cc',
-    packages=['corduroy', 'corduroy.tests'],
+    packages=['corduroy', 'corduroy.tests', 'corduroy.bench'],
     url='http://samizdat.cc/corduroy',
     license=LICENSE,
     description='An asynchronous CouchDB client library',